@@ -1,12 +1,120 @@
+import logging
 import pprint
-import queue
-import time
 import matplotlib.pyplot as plt
 from datetime import datetime
 import pandas as pd
 from pathlib import Path
 from csv import DictWriter
 
+from .clock import BacktestClock, HeartbeatClock
+from .event import ACTION, FILL, MARKET, ORDER, SIGNAL
+from .event_bus import DequeEventBus
+
+logger = logging.getLogger(__name__)
+
+class StrategyRun(object):
+    """
+    StrategyRun holds one strategy of a Backtest together with its
+    own event queue, portfolio and execution handler, so several
+    strategies can trade the same bars without seeing each other's
+    signals, orders or fills.
+    """
+
+    def __init__(self, backtest, strategy, portfolio, kwargs):
+        """
+        Parameters:
+        backtest - The Backtest providing the data handler.
+        strategy - (Class) Generates signals based on market data.
+        portfolio - (Class) Keeps track of portfolio current and prior
+                    positions.
+        kwargs - The parameters passed to the strategy.
+        """
+        self.strategy_cls = strategy
+        self.portfolio_cls = portfolio
+        self.kwargs = kwargs
+        self.event_log = backtest.event_log
+
+        data_handler = backtest.data_handler
+        self.events = backtest.event_bus_cls()
+        self.strategy = strategy(data_handler, self.events, **kwargs)
+        self.portfolio = portfolio(data_handler, self.events,
+                                   backtest.start_date,
+                                   backtest.initial_capital)
+        self.execution_handler = backtest.execution_handler_cls(self.events,
+                                                                data_handler)
+
+        self.signals = 0
+        self.orders = 0
+        self.fills = 0
+
+        self.event_handlers = {
+            SIGNAL: self._on_signal,
+            ORDER: self._on_order,
+            ACTION: self._on_action,
+            FILL: self._on_fill,
+        }
+        if self.event_log is not None:
+            for event_type, handler in self.event_handlers.items():
+                self.event_handlers[event_type] = self.event_log.wrap(handler)
+
+    def on_market(self, event):
+        """
+        Fills triggered orders, lets the strategy and the portfolio
+        react to the new bars, then handles the events they raised.
+        """
+        fill_events = self.execution_handler.scan_open_orders(event)
+        if fill_events:
+            self.fills += len(fill_events)
+            # These fills bypass the event bus, so record them here
+            if self.event_log is not None:
+                for fill_event in fill_events:
+                    self.event_log.record(fill_event)
+            self.portfolio.update_fills(fill_events)
+        self.strategy.calculate_signals(event)
+        self.portfolio.update_timeindex(event)
+        self.events.dispatch(self.event_handlers)
+
+    def _on_signal(self, event):
+        """
+        Sizes a signal into an order.
+        """
+        logger.debug("Generate New Signal Event")
+        self.signals += 1
+        self.portfolio.update_signal(event)
+
+    def _on_order(self, event):
+        """
+        Sends an order to the execution handler.
+        """
+        self.orders += 1
+        logger.debug("Generate New Order Event")
+        self.execution_handler.execute_order(event)
+
+    def _on_action(self, event):
+        """
+        Passes an action such as CLOSE_ALL to the execution handler.
+        """
+        self.execution_handler.execute_action(event)
+
+    def _on_fill(self, event):
+        """
+        Updates the portfolio from a fill.
+        """
+        self.fills += 1
+        logger.debug("Generate New Fill Event")
+        self.portfolio.update_fill(event)
+
+    def summary_stats(self):
+        """
+        Builds the result dataframes of the portfolio and returns
+        its summary statistics.
+        """
+        self.portfolio.create_equity_curve_dataframe()
+        self.portfolio.create_trade_history_dataframe()
+        self.portfolio.create_order_history_dataframe()
+        return self.portfolio.output_summary_stats()
+
+
 class Backtest(object):
     """
     Enscapsulates the settings and components for carrying out an event-driven
@@ -15,7 +123,10 @@ class Backtest(object):
 
     def __init__(
         self, csv_dir, symbol_list, initial_capital, heartbeat, start_date,
-        data_handler, execution_handler, portfolio, strategy, kwargs=None
+        data_handler, execution_handler, portfolio, strategy, kwargs=None,
+        warmup=0, event_bus=DequeEventBus, event_log=None,
+        clock=None, end_date=None, progress=None, progress_every=100,
+        checkpoint=None, strategies=None
     ):
         """
         Initialises the backtest.
@@ -24,118 +135,181 @@ class Backtest(object):
         csv_dir - The hard root to the CSV data directory.
         symbol_list - The list of symbol strings.
         initial_capital - The starting capital for the portfolio.
-        heartbeat - Backtest "heartbeat" in seconds.
+        heartbeat - Backtest "heartbeat" in seconds, only used when no
+                    clock is given.
         start_date - The start datetime of the strategy.
         data_handler - (Class) Handles the market data feed.
         execution_handler - (Class) Handles the orders/fills for traders.
         portfolio - (Class) Keeps track of portfolio current and prior
                     positions.
         strategy - (Class) Generates signals based on market data.
+        kwargs - The parameters passed to the strategy.
+        warmup - Number of bars before start_date preloaded into the
+                 lookback window of the strategy.
+        event_bus - (Class) The event queue shared by the components.
+        event_log - Optional EventLog recording every handled event.
+        clock - The Clock pacing the bars, e.g. a ReplayClock or a
+                LiveClock. Defaults to running as fast as possible.
+        end_date - Optional datetime at which the backtest stops.
+        progress - Optional callable(backtest) called every
+                   progress_every bars, returning True stops the
+                   backtest early, e.g. an EarlyStopping.
+        progress_every - Number of bars between progress calls.
+        checkpoint - Optional Checkpoint the backtest is saved to
+                     periodically and resumed from.
+        strategies - Optional list of (strategy, portfolio, kwargs)
+                     tuples run side by side over one pass of the
+                     bars, instead of strategy, portfolio and kwargs.
+                     Each gets its own portfolio and execution
+                     handler. kwargs may be left out.
         """
         self.csv_dir = csv_dir
         self.symbol_list = symbol_list
         self.initial_capital = initial_capital
         self.heartbeat = heartbeat
         self.start_date = start_date
+        self.end_date = end_date
 
         self.data_handler_cls = data_handler
         self.execution_handler_cls = execution_handler
         self.portfolio_cls = portfolio
         self.strategy_cls = strategy
-        self.kwargs = kwargs
+        self.kwargs = kwargs if kwargs is not None else {}
+        if strategies is None:
+            strategies = [(strategy, portfolio, self.kwargs)]
+        self.strategies = [
+            (s[0], s[1], s[2] if len(s) > 2 and s[2] is not None else {})
+            for s in strategies
+        ]
+        self.warmup = warmup
+        if clock is None:
+            clock = HeartbeatClock(heartbeat) if heartbeat else BacktestClock()
+        self.clock = clock
+        self.progress = progress
+        self.progress_every = progress_every
+        self.stopped = False
+        self.checkpoint = checkpoint
+        self.bars_processed = 0
 
-        self.events = queue.Queue()
+        # The market events of the data handler, every strategy run
+        # has a queue of its own for the rest
+        self.event_bus_cls = event_bus
+        self.events = event_bus()
+        self.event_handlers = {MARKET: self._on_market}
+        self.event_log = event_log
+        if event_log is not None:
+            self.event_handlers[MARKET] = event_log.wrap(self._on_market)
 
-        self.signals = 0
-        self.orders = 0
-        self.fills = 0
-        self.num_strats = 1
+        self.num_strats = len(self.strategies)
 
         self._generate_trading_instances()
+        if checkpoint is not None:
+            checkpoint.check(self)
 
     def _generate_trading_instances(self):
         """
         Generates the trading instance objects from their class types.
         """
-        print("Creating DataHandler, Strategy, Portfolio and ExecutionHandler")
+        logger.info("Creating DataHandler, Strategy, Portfolio and ExecutionHandler")
 
         self.data_handler = self.data_handler_cls(self.events,
                                                   self.csv_dir,
                                                   self.symbol_list)
-        self.strategy = self.strategy_cls(self.data_handler, self.events, **self.kwargs)
-        self.portfolio = self.portfolio_cls(self.data_handler,
-                                            self.events,
-                                            self.start_date,
-                                            self.initial_capital)
-        self.execution_handler = self.execution_handler_cls(self.events,
-                                                            self.data_handler)
+        # Skip the history before start_date instead of replaying it
+        if (self.start_date is not None or self.end_date is not None) and \
+                hasattr(self.data_handler, 'seek'):
+            self.data_handler.seek(self.start_date, self.warmup, self.end_date)
+        self.strategy_runs = [
+            StrategyRun(self, strategy, portfolio, kwargs)
+            for strategy, portfolio, kwargs in self.strategies
+        ]
+        # The components of the first strategy, as a single strategy
+        # backtest has them
+        first = self.strategy_runs[0]
+        self.strategy = first.strategy
+        self.portfolio = first.portfolio
+        self.execution_handler = first.execution_handler
+
+    @property
+    def signals(self):
+        return sum(run.signals for run in self.strategy_runs)
+
+    @property
+    def orders(self):
+        return sum(run.orders for run in self.strategy_runs)
+
+    @property
+    def fills(self):
+        return sum(run.fills for run in self.strategy_runs)
+
+    def _on_market(self, event):
+        """
+        Passes the new bars to every strategy run in turn.
+        """
+        logger.debug("Generate New Market Event")
+        for strategy_run in self.strategy_runs:
+            strategy_run.on_market(event)
 
     def _run_backtest(self):
         """
         Executes the backtest.
         """
-        i = 0
-        while True:
-            i += 1
-            # print(i)
+        checkpoint = self.checkpoint
+        if checkpoint is not None:
+            checkpoint.restore(self)
+        self.clock.start()
+        while self.data_handler.continue_backtest:
             # Update the market bars
-            if self.data_handler.continue_backtest == True:
-                self.data_handler.update_bars()
-            else:
-                # TODO: Close all open orders 关闭所有未平仓订单
-                # e.g. self.execution_handler.clos_all_open_orders()
-                break
+            self.clock.update(self.data_handler)
 
             # Handle the events:
-            while True:
-                try:
-                    event = self.events.get(False)
-                except queue.Empty:
-                    break
-                else:
-                    if event is not None:
-                        if event.type == 'MARKET':
-                            print("Generate New Market Event")
-                            fill_events = self.execution_handler.scan_open_orders(event)
-                            if fill_events:
-                                self.fills += len(fill_events)
-                                self.portfolio.update_fills(fill_events)
-                            self.strategy.calculate_signals(event)
-                            self.portfolio.update_timeindex(event)
-
-                        elif event.type == 'SIGNAL':
-                            print("Generate New Signal Event")
-                            self.signals += 1
-                            self.portfolio.update_signal(event)
-
-                        elif event.type == 'ORDER':
-                            self.orders += 1
-                            print("Generate New Order Event")
-                            self.execution_handler.execute_order(event)
-
-                        elif event.type == 'ACTION':
-                            self.execution_handler.execute_action(event)
-
-                        elif event.type == 'FILL':
-                            self.fills += 1
-                            print("Generate New Fill Event")
-                            self.portfolio.update_fill(event)
-
-            time.sleep(self.heartbeat)
+            self.events.dispatch(self.event_handlers)
+
+            self.bars_processed += 1
+            if checkpoint is not None and \
+                    self.bars_processed % checkpoint.every == 0:
+                checkpoint.save(self)
+            if self.progress is not None and \
+                    self.bars_processed % self.progress_every == 0 and \
+                    self.progress(self):
+                logger.info("Backtest stopped early after %d bars",
+                            self.bars_processed)
+                self.stopped = True
+                break
+
+        # TODO: Close all open orders 关闭所有未平仓订单
+        # e.g. self.execution_handler.clos_all_open_orders()
+
+        if self.event_log is not None:
+            self.event_log.close()
+
+    def _summary_stats(self):
+        """
+        Returns the summary statistics of the portfolio, or a list of
+        them, one per strategy, when several strategies were run.
+        """
+        stats = [run.summary_stats() for run in self.strategy_runs]
+        return stats[0] if len(stats) == 1 else stats
 
     def _output_performance(self):
         """
-        Outputs the strategy performance from the backtest.
+        Outputs the performance of every strategy from the backtest.
         """
-        self.portfolio.create_equity_curve_dataframe()
-        self.portfolio.create_trade_history_dataframe()
-        self.portfolio.create_order_history_dataframe()
+        for strategy_run in self.strategy_runs:
+            self._output_run_performance(strategy_run)
+        plt.show()
 
-        print("Creating summary stats...")
-        stats = self.portfolio.output_summary_stats()
+    def _output_run_performance(self, strategy_run):
+        """
+        Outputs the performance of one strategy run.
+        """
+        logger.info("Creating summary stats...")
+        stats = strategy_run.summary_stats()
         pprint.pprint(stats)
+        portfolio = strategy_run.portfolio
+        kwargs = strategy_run.kwargs
 
-        print("Creating equity curve...")
+        logger.info("Creating equity curve...")
         # Plot the equity curve
         fig = plt.figure()
 
@@ -143,7 +317,7 @@ class Backtest(object):
         fig.patch.set_facecolor('white')
 
         ax1 = fig.add_subplot(211, ylabel='Portfolio value, %')
-        self.portfolio.equity_curve['equity_curve'].plot(ax=ax1, color="blue", lw=2.)
+        portfolio.equity_curve['equity_curve'].plot(ax=ax1, color="blue", lw=2.)
         plt.grid(True)
         plt.tight_layout()
 
@@ -157,32 +331,30 @@ class Backtest(object):
         self.data_handler.raw_data[symbol]['close'].plot(ax=ax2, color="black", lw=2.)
 
         # TODO: this may crash, need to make a formal short_cut name
-        s_name = self.strategy_cls.__name__[:3]
+        s_name = strategy_run.strategy_cls.__name__[:3]
         dt_string = datetime.now().strftime("%m%d_%H%M")
         para_str = ''
-        for key in self.kwargs:
+        for key in kwargs:
             para_str += '_'
             para_str += key
             para_str += '_'
-            para_str += str(self.kwargs[key])
+            para_str += str(kwargs[key])
         fd_name = "{}_{}{}".format(s_name, dt_string, para_str)
         Path("./results/{}".format(fd_name)).mkdir(parents=True, exist_ok=True)
 
         fig.savefig('./results/{}/PnL.png'.format(fd_name), dpi=100)
-        self.portfolio.equity_curve.to_csv('./results/{}/equity.csv'.format(fd_name))
-        self.portfolio.trade_history.to_csv('./results/{}/all_positions.csv'.format(fd_name))
-        self.portfolio.order_history.to_csv('./results/{}/all_orders.csv'.format(fd_name))
-        pd.DataFrame(self.portfolio.all_fills).to_csv('./results/{}/all_fills.csv'.format(fd_name))
+        portfolio.equity_curve.to_csv('./results/{}/equity.csv'.format(fd_name))
+        portfolio.trade_history.to_csv('./results/{}/all_positions.csv'.format(fd_name))
+        portfolio.order_history.to_csv('./results/{}/all_orders.csv'.format(fd_name))
+        pd.DataFrame(portfolio.all_fills).to_csv('./results/{}/all_fills.csv'.format(fd_name))
 
-        field_names = list(self.kwargs.keys()) + ['Profit', 'Sharpe', 'Max_Drawdown', 'Drawdown_Duration', 'Win_Rate',
+        field_names = list(kwargs.keys()) + ['Profit', 'Sharpe', 'Max_Drawdown', 'Drawdown_Duration', 'Win_Rate',
                                                   'Trade_No', 'Total_Profit', 'Total_Loss', 'Folder_Name',
                                                   'Profit_Factor']
-        stats.update(self.kwargs)
+        stats.update(kwargs)
         stats.update({'Folder_Name': fd_name})
         self.append_dict_as_row('./results/{}_stats.csv'.format(s_name), stats, field_names)
 
-        plt.show()
-
     @staticmethod
     def append_dict_as_row(file_name, dict_of_elem, field_names):
         # Open file in append mode
@@ -192,6 +364,15 @@ class Backtest(object):
             # Add dictionary as wor in the csv
             dict_writer.writerow(dict_of_elem)
 
+    def run(self):
+        """
+        Runs the backtest and returns the summary statistics, a list
+        of them when several strategies are run, without plotting or
+        writing any results. Used by parameter sweeps.
+        """
+        self._run_backtest()
+        return self._summary_stats()
+
     def simulate_trading(self):
         """
         Simulate the backtest and outputs portfolio performance.
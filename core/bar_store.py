@@ -0,0 +1,416 @@
+from datetime import datetime, timedelta
+import heapq
+
+import numpy as np
+import pandas as pd
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def epoch_to_datetime(epoch):
+    """
+    Converts UTC epoch nanoseconds into a naive Python datetime,
+    truncated to microseconds.
+    """
+    return EPOCH + timedelta(microseconds=int(epoch) // 1000)
+
+
+def to_epoch(dt):
+    """
+    Converts a datetime (naive ones are taken as UTC) or a date
+    string into UTC epoch nanoseconds.
+    """
+    ts = pd.Timestamp(dt)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert(None)
+    return int(ts.value)
+
+
+class BarStore(object):
+    """
+    BarStore holds the complete bar history of a single symbol as a
+    set of preloaded, read-only NumPy columns (one array per field)
+    together with a moving cursor that marks how many bars have been
+    "released" to the rest of the system so far.
+
+    Advancing the cursor is O(1) and no per-bar objects are created,
+    so memory does not grow with the length of a backtest. Lookback
+    queries return zero-copy slices of the underlying columns.
+    """
+
+    def __init__(self, epochs, columns):
+        """
+        Initialises the store from an array of timestamps and a
+        dictionary of equally sized column arrays.
+
+        Parameters:
+        epochs - Array of UTC epoch nanoseconds, sorted ascending.
+        columns - Dict of field name -> 1D array of values.
+        """
+        self.epochs = np.asarray(epochs, dtype=np.int64)
+        self.columns = {}
+        for name, values in columns.items():
+            values = np.ascontiguousarray(values, dtype=np.float64)
+            values.flags.writeable = False
+            self.columns[name] = values
+        self.fields = list(self.columns.keys())
+        self.cursor = 0
+        # Bars before the floor are hidden from lookback queries
+        self.floor = 0
+        # The datetime of the last released bar, converted on demand
+        self._datetime_cursor = 0
+        self._datetime = None
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Builds a store from a pandas DataFrame indexed on datetime.
+        """
+        index = pd.to_datetime(frame.index, utc=True).tz_convert(None)
+        return cls(
+            np.asarray(index.values, dtype='datetime64[ns]').view(np.int64),
+            dict((c, frame[c].values) for c in frame.columns)
+        )
+
+    @property
+    def index(self):
+        """
+        The timestamps of all bars as a pandas DatetimeIndex.
+        """
+        return pd.DatetimeIndex(self.epochs.view('datetime64[ns]'))
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def has_next(self):
+        """
+        Returns True while there are still unreleased bars.
+        """
+        return self.cursor < len(self.epochs)
+
+    def next_epoch(self):
+        """
+        Returns the timestamp of the next unreleased bar as
+        epoch nanoseconds.
+        """
+        return int(self.epochs[self.cursor])
+
+    def advance(self):
+        """
+        Releases the next bar by moving the cursor forward.
+        """
+        self.cursor += 1
+
+    def seek(self, epoch, warmup=0):
+        """
+        Moves the cursor with a binary search so that the next bar
+        released is the first one at or after epoch. The warmup
+        bars before it count as already released and stay visible
+        to lookback queries.
+
+        Parameters:
+        epoch - The start timestamp as epoch nanoseconds.
+        warmup - Number of bars before the start to expose.
+        """
+        self.cursor = int(np.searchsorted(self.epochs, epoch, side='left'))
+        self.floor = max(self.cursor - warmup, 0)
+
+    def get_state(self):
+        """
+        Returns the position of the store as a (cursor, floor) pair,
+        e.g. for a checkpoint.
+        """
+        return self.cursor, self.floor
+
+    def set_state(self, state):
+        """
+        Restores a position returned by get_state.
+        """
+        self.cursor, self.floor = state
+
+    def latest_epoch(self):
+        """
+        Returns the timestamp of the last released bar as
+        epoch nanoseconds.
+        """
+        if self.cursor == self.floor:
+            raise IndexError("No bars have been released yet.")
+        return int(self.epochs[self.cursor - 1])
+
+    def latest_datetime(self):
+        """
+        Returns the timestamp of the last released bar as a Python
+        datetime. It is converted once per bar and then cached.
+        """
+        if self._datetime_cursor != self.cursor:
+            self._datetime = epoch_to_datetime(self.latest_epoch())
+            self._datetime_cursor = self.cursor
+        return self._datetime
+
+    def latest_value(self, field):
+        """
+        Returns the value of a field for the last released bar.
+        """
+        if self.cursor == self.floor:
+            raise IndexError("No bars have been released yet.")
+        return self.columns[field][self.cursor - 1]
+
+    def latest_values(self, field, N=1):
+        """
+        Returns a read-only view on the values of a field for the
+        last N released bars, or fewer if less are available.
+        """
+        end = self.cursor
+        start = end - N
+        if start < self.floor:
+            start = self.floor
+        return self.columns[field][start:end]
+
+    def latest_bars(self, N=1):
+        """
+        Returns the last N released bars as a list of
+        (datetime, {field: value}) tuples.
+        """
+        end = self.cursor
+        start = max(end - N, self.floor)
+        return [
+            (epoch_to_datetime(self.epochs[i]),
+             dict((f, self.columns[f][i]) for f in self.fields))
+            for i in range(start, end)
+        ]
+
+
+class RingBarStore(object):
+    """
+    RingBarStore keeps only the most recent bars of a symbol in a
+    fixed size ring buffer, for feeds that are streamed rather than
+    preloaded. It offers the same read interface as BarStore.
+
+    Every bar is written twice, at its slot and at slot + capacity,
+    so any window of up to capacity bars ending at the newest bar
+    is a contiguous zero-copy slice of the buffer. The capacity
+    grows on demand to the largest lookback ever requested.
+    """
+
+    def __init__(self, fields, capacity=100):
+        """
+        Initialises an empty ring buffer.
+
+        Parameters:
+        fields - The list of field names.
+        capacity - The initial number of bars kept.
+        """
+        self.fields = list(fields)
+        self.rows = dict((f, i) for i, f in enumerate(self.fields))
+        self.capacity = capacity
+        self.count = 0
+        self.head = -1
+        self._epochs = np.zeros(2 * capacity, dtype=np.int64)
+        self._data = np.zeros((len(self.fields), 2 * capacity))
+        # The datetime of the newest bar, converted on demand
+        self._datetime_count = 0
+        self._datetime = None
+
+    def push(self, epoch, values):
+        """
+        Appends a bar, overwriting the oldest one when full.
+
+        Parameters:
+        epoch - The bar timestamp as epoch nanoseconds.
+        values - Array of the field values, in field order.
+        """
+        head = self.head + 1
+        if head == self.capacity:
+            head = 0
+        mirror = head + self.capacity
+        self._epochs[head] = self._epochs[mirror] = epoch
+        self._data[:, head] = values
+        self._data[:, mirror] = values
+        self.head = head
+        self.count += 1
+
+    def truncate(self, N):
+        """
+        Hides all but the newest N bars from lookback queries.
+        """
+        self.count = min(self.count, N)
+        self._datetime_count = -1
+
+    def grow(self, capacity):
+        """
+        Enlarges the buffer to hold capacity bars, keeping the
+        bars already stored.
+        """
+        if capacity <= self.capacity:
+            return
+        kept = min(self.count, self.capacity)
+        end = self.head + self.capacity + 1
+        epochs = np.zeros(2 * capacity, dtype=np.int64)
+        data = np.zeros((len(self.fields), 2 * capacity))
+        epochs[:kept] = self._epochs[end - kept:end]
+        data[:, :kept] = self._data[:, end - kept:end]
+        epochs[capacity:capacity + kept] = epochs[:kept]
+        data[:, capacity:capacity + kept] = data[:, :kept]
+        self._epochs, self._data = epochs, data
+        self.capacity = capacity
+        self.head = kept - 1
+        # Only the kept bars are in the new buffer, the rest of it is
+        # padding that must not show up in a window
+        self.count = kept
+        self._datetime_count = -1
+
+    def get_state(self):
+        """
+        Returns a copy of the retained bars and the number of bars
+        visible, e.g. for a checkpoint.
+        """
+        start, end = self._window(self.capacity)
+        return (self._epochs[start:end].copy(), self._data[:, start:end].copy(),
+                self.count)
+
+    def set_state(self, state):
+        """
+        Restores the bars returned by get_state.
+        """
+        epochs, data, count = state
+        self.count = 0
+        self.head = -1
+        self.grow(len(epochs))
+        for i in range(len(epochs)):
+            self.push(epochs[i], data[:, i])
+        self.count = min(count, len(epochs))
+        self._datetime_count = -1
+
+    def _window(self, N):
+        """
+        Returns the (start, end) buffer slice of the last N bars.
+        """
+        if N > self.capacity:
+            self.grow(N)
+        end = self.head + self.capacity + 1
+        return end - min(N, self.count, self.capacity), end
+
+    @property
+    def index(self):
+        """
+        The timestamps of all retained bars.
+        """
+        start, end = self._window(self.capacity)
+        return pd.DatetimeIndex(self._epochs[start:end].view('datetime64[ns]'))
+
+    @property
+    def columns(self):
+        """
+        The retained bars as a dict of field -> array.
+        """
+        start, end = self._window(self.capacity)
+        return dict((f, self._data[i, start:end]) for f, i in self.rows.items())
+
+    def latest_epoch(self):
+        """
+        Returns the timestamp of the newest bar as epoch nanoseconds.
+        """
+        if self.count == 0:
+            raise IndexError("No bars have been released yet.")
+        return int(self._epochs[self.head])
+
+    def latest_datetime(self):
+        """
+        Returns the timestamp of the newest bar as a Python datetime,
+        cached until the next bar is pushed.
+        """
+        if self._datetime_count != self.count:
+            self._datetime = epoch_to_datetime(self.latest_epoch())
+            self._datetime_count = self.count
+        return self._datetime
+
+    def latest_value(self, field):
+        """
+        Returns the value of a field for the newest bar.
+        """
+        if self.count == 0:
+            raise IndexError("No bars have been released yet.")
+        return self._data[self.rows[field], self.head]
+
+    def latest_values(self, field, N=1):
+        """
+        Returns a view on the values of a field for the last N
+        bars, or fewer if less are available.
+        """
+        start, end = self._window(N)
+        return self._data[self.rows[field], start:end]
+
+    def latest_bars(self, N=1):
+        """
+        Returns the last N bars as a list of
+        (datetime, {field: value}) tuples.
+        """
+        start, end = self._window(N)
+        return [
+            (epoch_to_datetime(self._epochs[i]),
+             dict((f, self._data[r, i]) for f, r in self.rows.items()))
+            for i in range(start, end)
+        ]
+
+
+class BarMerge(object):
+    """
+    BarMerge is a streaming, heap based k-way merge of the bar feeds
+    of several symbols on their timestamps.
+
+    Each call to advance releases every bar that shares the next
+    distinct timestamp and reports which symbols were updated.
+    Nothing is forward filled or copied, so the cost per step is
+    O(log k) in the number of symbols and memory stays flat.
+
+    A feed is any object providing has_next(), next_epoch() and
+    advance(), e.g. a BarStore.
+    """
+
+    def __init__(self, feeds):
+        """
+        Initialises the merge.
+
+        Parameters:
+        feeds - A list of (symbol, feed) pairs, ties on the same
+                timestamp are reported in this order.
+        """
+        self.feeds = feeds
+        self.heap = [
+            (feed.next_epoch(), i) for i, (s, feed) in enumerate(feeds)
+            if feed.has_next()
+        ]
+        heapq.heapify(self.heap)
+
+    def has_next(self):
+        """
+        Returns True while any feed has unreleased bars.
+        """
+        return len(self.heap) > 0
+
+    def next_epoch(self):
+        """
+        Returns the next distinct timestamp as epoch nanoseconds.
+        """
+        return self.heap[0][0]
+
+    def advance(self):
+        """
+        Advances every feed whose next bar carries the next distinct
+        timestamp and returns the list of updated symbols.
+        """
+        heap = self.heap
+        epoch = heap[0][0]
+        updated = []
+        while heap and heap[0][0] == epoch:
+            i = heapq.heappop(heap)[1]
+            symbol, feed = self.feeds[i]
+            feed.advance()
+            updated.append((i, symbol, feed))
+        # Push back after the loop so a duplicated timestamp within
+        # one feed is released as a separate step.
+        for i, symbol, feed in updated:
+            if feed.has_next():
+                heapq.heappush(heap, (feed.next_epoch(), i))
+        return [symbol for i, symbol, feed in updated]
@@ -0,0 +1,518 @@
+import heapq
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+
+from .costs import LIMIT, MARKET, STOP, CostModel
+from .event import ACTION, ORDER
+
+# The attributes of the orders replayed, and those of them that
+# are prices.
+ORDER_ATTRIBUTES = ('order_id', 'symbol', 'order_type', 'direction',
+                    'quantity', 'stop_loss', 'profit_target', 'limit_price',
+                    'stop_price')
+PRICES = ('stop_loss', 'profit_target', 'limit_price', 'stop_price')
+
+# How an order left the market, and the kind of fill of each way
+# as CostModel prices it.
+EXIT_REASONS = ('', 'stop_loss', 'profit_target', 'close_all', 'market')
+EXIT_KINDS = np.array(['', STOP, LIMIT, MARKET, MARKET], dtype=object)
+
+ORDER_FIELDS = ['order_id', 'symbol', 'order_type', 'direction', 'quantity',
+                'stop_loss', 'profit_target', 'limit_price', 'stop_price',
+                'entry_time', 'entry_price', 'exit_time', 'exit_price',
+                'profit', 'exit_reason']
+
+FILL_FIELDS = ['order_id', 'symbol', 'timeindex', 'price', 'quantity',
+               'direction', 'commission']
+
+
+def min_levels(values):
+    """
+    Returns the minima of values over aligned blocks of 1, 2, 4, ...
+    values, up to a single block covering all of them. Blocks at the
+    end are padded with inf.
+    """
+    levels = [np.asarray(values, dtype=np.float64)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.append(level, np.inf)
+        levels.append(level.reshape(-1, 2).min(axis=1))
+    return levels
+
+
+def first_below(levels, start, threshold, inclusive):
+    """
+    Returns, for every query, the first index i >= start with
+    values[i] < threshold, or values[i] <= threshold when inclusive,
+    or len(values) if there is none. values are the levels[0] of
+    min_levels.
+
+    The queries are answered together by binary lifting over the
+    block minima: each climbs the blocks aligned at its start as
+    long as they hold no crossing, then descends into the block
+    that does, in O(log n) vectorised steps.
+
+    Parameters:
+    levels - The block minima of min_levels.
+    start - Array of start indexes.
+    threshold - Array of thresholds, NaN never crosses.
+    inclusive - True to also stop at values equal to the threshold.
+    """
+    n = len(levels[0])
+    top = len(levels) - 1
+    pos = np.array(start, dtype=np.int64)
+    threshold = np.asarray(threshold, dtype=np.float64)
+    if n == 0:
+        return np.zeros_like(pos)
+    # Highest level a query may descend from, top + 1 for all levels
+    cap = np.full(len(pos), top + 1)
+    climbing = pos < n
+
+    for l in range(top):
+        idx = np.flatnonzero(climbing & ((pos >> l) & 1 == 1))
+        if len(idx) == 0:
+            continue
+        block = levels[l][pos[idx] >> l]
+        hit = block <= threshold[idx] if inclusive else block < threshold[idx]
+        cap[idx[hit]] = l
+        climbing[idx[hit]] = False
+        pos[idx[~hit]] += 1 << l
+        climbing &= pos < n
+
+    for l in range(top, -1, -1):
+        idx = np.flatnonzero((pos < n) & (l < cap))
+        if len(idx) == 0:
+            continue
+        block = levels[l][pos[idx] >> l]
+        hit = block <= threshold[idx] if inclusive else block < threshold[idx]
+        pos[idx[~hit]] += 1 << l
+
+    pos = np.minimum(pos, n)
+    found = pos < n
+    values = levels[0][np.minimum(pos, n - 1)]
+    crossed = values <= threshold if inclusive else values < threshold
+    return np.where(found & crossed, pos, n)
+
+
+def bar_arrays(data_handler):
+    """
+    Returns {symbol: {'epoch', 'high', 'low', 'close'}} of the bars
+    of a BarStore based data handler, up to its end_date.
+    """
+    arrays = {}
+    end_epoch = getattr(data_handler, 'end_epoch', None)
+    for s in data_handler.symbol_list:
+        store = data_handler.symbol_data[s]
+        end = len(store.epochs)
+        if end_epoch is not None:
+            end = int(np.searchsorted(store.epochs, end_epoch, side='left'))
+        arrays[s] = dict((f, store.columns[f][:end])
+                         for f in ('high', 'low', 'close'))
+        arrays[s]['epoch'] = store.epochs[:end]
+    return arrays
+
+
+class StreamRecorder(object):
+    """
+    StreamRecorder records the orders and actions of a Backtest with
+    the timestamp of the bar they were placed on, as the stream
+    BatchFillSimulator replays.
+    """
+
+    def __init__(self, backtest, run=0):
+        """
+        Parameters:
+        backtest - The Backtest to record, before it is run.
+        run - Index of the strategy run to record.
+        """
+        self.stream = []
+        self.bars = backtest.data_handler
+        handlers = backtest.strategy_runs[run].event_handlers
+        for event_type in (ORDER, ACTION):
+            handlers[event_type] = self._wrap(handlers[event_type])
+
+    def _wrap(self, handler):
+        stream = self.stream
+        bars = self.bars
+
+        def recorded(event):
+            stream.append((bars.get_latest_bar_epoch(event.symbol), event))
+            handler(event)
+        return recorded
+
+
+class BatchFillSimulator(object):
+    """
+    BatchFillSimulator computes the fills of a recorded stream of
+    orders and CLOSE_ALL actions against the bars at once with
+    NumPy, following the semantics of SimulatedExecutionHandler, so
+    execution assumptions can be varied without running the event
+    loop again.
+
+    Limit and stop entries, and stop loss and profit target exits,
+    are found as the first bar crossing their price with
+    first_below. A limit or stop order is checked from the bar after
+    it was placed, the exits of an order from the bar after its
+    entry, and a stop loss wins over a profit target on the same bar.
+    The next CLOSE_ALL of the symbol is found by a binary search,
+    cancelling pending orders and closing open ones at the close.
+
+    Only market orders depend on each other, as one closes the
+    oldest open order of its symbol or else opens a new one. They
+    are resolved in a sequential pass over the market orders with a
+    heap of the open orders.
+
+    The fills are then priced, delayed and charged by the same
+    CostModel as SimulatedExecutionHandler, the profits of the
+    orders following from the priced fills.
+    """
+
+    def __init__(self, bars, cost_model=None, data_handler=None):
+        """
+        Initialises the simulator.
+
+        Parameters:
+        bars - Dict of symbol -> {'epoch', 'high', 'low', 'close'}
+               arrays, e.g. from bar_arrays.
+        cost_model - Optional CostModel of the fills, CostModel() by
+                     default as in SimulatedExecutionHandler.
+        data_handler - The data handler to bind the cost model to.
+                       Leave None for a model already bound, e.g. the
+                       one of the execution handler recorded.
+        """
+        self.bars = bars
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        if data_handler is not None:
+            self.cost_model.bind(data_handler)
+        self._levels = {}
+
+    def _fill_costs(self, symbol, epochs, prices, directions, kinds,
+                    quantities):
+        """
+        Returns the prices and commissions of fills as the cost model
+        makes them, epochs being those of the bars of the fills.
+        """
+        model = self.cost_model
+        if type(model) is CostModel:
+            # The base model leaves the prices alone
+            return prices, np.where(kinds == MARKET, model.market_commission,
+                                    model.trigger_commission)
+        filled = np.empty(len(prices))
+        commissions = np.empty(len(prices))
+        for i, (epoch, price, direction, kind, quantity) in enumerate(zip(
+                (epochs + model.latency).tolist(), prices.tolist(),
+                directions.tolist(), kinds.tolist(), quantities.tolist())):
+            price = model.fill_price(symbol, epoch, price, direction, kind)
+            filled[i] = price
+            commissions[i] = model.commission(symbol, epoch, price, quantity,
+                                              kind)
+        return filled, commissions
+
+    def _first_crossing(self, symbol, start, prices, on_high, inclusive):
+        """
+        Returns the first bar from start on whose high rises above
+        the price, or whose low falls below it, len(bars) if none.
+        """
+        if symbol not in self._levels:
+            bars = self.bars[symbol]
+            self._levels[symbol] = (min_levels(-np.asarray(bars['high'])),
+                                    min_levels(bars['low']))
+        high_levels, low_levels = self._levels[symbol]
+        n = len(self.bars[symbol]['epoch'])
+        result = np.full(len(start), n, dtype=np.int64)
+        on_high = np.asarray(on_high, dtype=bool)
+        for side, levels, sign in ((True, high_levels, -1.0),
+                                   (False, low_levels, 1.0)):
+            idx = np.flatnonzero(on_high == side)
+            if len(idx):
+                result[idx] = first_below(levels, start[idx],
+                                          sign * prices[idx], inclusive)
+        return result
+
+    def run(self, stream):
+        """
+        Simulates the fills of a stream and returns the DataFrame of
+        its orders, cancelled orders left out. The fills are stored
+        in self.fills.
+
+        Parameters:
+        stream - List of (epoch, event) of the OrderEvents and
+                 ActionEvents in the order they were handled, epoch
+                 being the timestamp of the bar they were placed on,
+                 e.g. StreamRecorder.stream.
+        """
+        # Moments are ordered by bar, then by the position in the
+        # stream. The orders of a bar are checked before its stream.
+        self._scale = len(stream) + 1
+        order_seqs = []
+        order_events = []
+        action_seqs = []
+        action_events = []
+        for seq, (epoch, event) in enumerate(stream):
+            if event.type == ORDER:
+                if event.order_type in ('MKT', 'LMT', 'STP'):
+                    order_seqs.append((seq, epoch))
+                    order_events.append(event)
+            elif event.type == ACTION and event.action_type == 'CLOSE_ALL':
+                action_seqs.append((seq, epoch))
+                action_events.append(event.symbol)
+
+        # One column per order attribute, None prices become NaN
+        values = list(zip(*map(attrgetter(*ORDER_ATTRIBUTES), order_events)))
+        columns = dict((name, np.array(values[i] if values else []))
+                       for i, name in enumerate(ORDER_ATTRIBUTES))
+        for name in PRICES + ('quantity',):
+            columns[name] = np.array(columns[name], dtype=np.float64)
+        columns['seq'], columns['epoch'] = np.array(
+            order_seqs, dtype=np.int64).reshape(-1, 2).T
+        actions = np.array(action_seqs, dtype=np.int64).reshape(-1, 2)
+        action_symbols = np.array(action_events, dtype=object)
+
+        orders = []
+        fills = []
+        for symbol in set(columns['symbol'].tolist()) | set(action_events):
+            rows = columns['symbol'] == symbol
+            symbol_orders, symbol_fills = self._run_symbol(
+                symbol, dict((k, v[rows]) for k, v in columns.items()),
+                actions[action_symbols == symbol]
+            )
+            orders.append(symbol_orders)
+            fills.append(symbol_fills)
+        if orders:
+            orders = pd.concat(orders).sort_values('order_id')
+            fills = pd.concat(fills).sort_values(['timeindex', 'order_id'],
+                                                 kind='mergesort')
+        else:
+            orders = pd.DataFrame(columns=ORDER_FIELDS)
+            fills = pd.DataFrame(columns=FILL_FIELDS)
+        self.orders = orders.reset_index(drop=True)
+        self.fills = fills.reset_index(drop=True)
+        return self.orders
+
+    def _run_symbol(self, symbol, columns, actions):
+        """
+        Simulates the orders and CLOSE_ALL actions of one symbol.
+
+        Parameters:
+        symbol - The symbol.
+        columns - Dict of order attribute -> array, with the 'seq'
+                  and 'epoch' the orders were placed at.
+        actions - Array of the (seq, epoch) of the CLOSE_ALL actions.
+        """
+        bars = self.bars[symbol]
+        epochs = np.asarray(bars['epoch'], dtype=np.int64)
+        close = np.asarray(bars['close'], dtype=np.float64)
+        n = len(epochs)
+        scale = self._scale
+
+        close_all_bars = np.searchsorted(epochs, actions[:, 1]).astype(np.int64)
+        close_all_moments = close_all_bars * scale + actions[:, 0] + 1
+
+        order_ids = columns['order_id'].astype(np.int64)
+        m = len(order_ids)
+        placed = np.searchsorted(epochs, columns['epoch']).astype(np.int64)
+        moments = placed * scale + columns['seq'] + 1
+        order_type = columns['order_type']
+        direction = columns['direction']
+        quantity = columns['quantity']
+        stop_loss = columns['stop_loss']
+        profit_target = columns['profit_target']
+        limit_price = columns['limit_price']
+        stop_price = columns['stop_price']
+        buy = direction == 'BUY'
+        sell = direction == 'SELL'
+
+        # The next CLOSE_ALL after a moment, n if none
+        def next_close_all(after):
+            i = np.searchsorted(close_all_moments, after, side='right')
+            has = i < len(close_all_moments)
+            i = np.minimum(i, max(len(close_all_moments) - 1, 0))
+            if len(close_all_moments) == 0:
+                return np.full(len(after), n, dtype=np.int64), \
+                    np.full(len(after), np.iinfo(np.int64).max)
+            return np.where(has, close_all_bars[i], n), \
+                np.where(has, close_all_moments[i], np.iinfo(np.int64).max)
+
+        # Entries of the limit and stop orders
+        market = order_type == 'MKT'
+        entry_bar = np.where(market, placed, n)
+        entry_price = np.where(market, close[np.minimum(placed, n - 1)],
+                               np.nan)
+        pending = np.flatnonzero(~market)
+        cancelled = np.zeros(m, dtype=bool)
+        if len(pending):
+            trigger = np.where(order_type[pending] == 'LMT',
+                               limit_price[pending], stop_price[pending])
+            # Buy limits and sell stops wait for the low, the others
+            # for the high
+            stop = order_type[pending] == 'STP'
+            on_high = stop != sell[pending]
+            valid = buy[pending] | sell[pending]
+            trigger = np.where(valid, trigger, np.nan)
+            crossed = self._first_crossing(symbol, placed[pending] + 1,
+                                           trigger, on_high, False)
+            # A CLOSE_ALL before the entry cancels the order
+            ca_bar, ca_moment = next_close_all(moments[pending])
+            entered = (crossed < n) & (crossed <= ca_bar)
+            cancelled[pending] = ~entered & (ca_bar < n)
+            entry_bar[pending] = np.where(entered, crossed, n)
+            entry_price[pending] = np.where(entered, trigger, np.nan)
+        entered = entry_bar < n
+        entry_moment = np.where(market, moments, entry_bar * scale)
+
+        # Natural exits, as if no market order closed them
+        exit_bar = np.full(m, n, dtype=np.int64)
+        exit_price = np.full(m, np.nan)
+        exit_reason = np.zeros(m, dtype=np.int64)
+        exit_moment = np.full(m, np.iinfo(np.int64).max, dtype=np.int64)
+        idx = np.flatnonzero(entered)
+        if len(idx):
+            start = entry_bar[idx] + 1
+            first = np.full(len(idx), n, dtype=np.int64)
+            reason = np.zeros(len(idx), dtype=np.int64)
+            price = np.full(len(idx), np.nan)
+            valid = buy[idx] | sell[idx]
+            # The stop loss of a sell and the profit target of a buy
+            # wait for the high, the others for the low
+            for r, values, on_high in ((1, stop_loss, sell[idx]),
+                                       (2, profit_target, buy[idx])):
+                crossed = self._first_crossing(
+                    symbol, start, np.where(valid, values[idx], np.nan),
+                    on_high, True
+                )
+                # The stop loss wins a tie
+                better = crossed < first
+                first = np.where(better, crossed, first)
+                reason = np.where(better, r, reason)
+                price = np.where(better, values[idx], price)
+            ca_bar, ca_moment = next_close_all(entry_moment[idx])
+            by_trigger = (first < n) & (first <= ca_bar)
+            by_close_all = ~by_trigger & (ca_bar < n)
+            exit_bar[idx] = np.where(by_trigger, first,
+                                     np.where(by_close_all, ca_bar, n))
+            exit_price[idx] = np.where(
+                by_trigger, price,
+                np.where(by_close_all, close[np.minimum(ca_bar, n - 1)], np.nan)
+            )
+            exit_reason[idx] = np.where(by_trigger, reason,
+                                        np.where(by_close_all, 3, 0))
+            exit_moment[idx] = np.where(by_trigger, first * scale,
+                                        np.where(by_close_all, ca_moment,
+                                                 exit_moment[idx]))
+
+        # The market orders close the oldest open order or open one
+        stored = ~market & ~cancelled
+        closes = self._market_pass(market, entered, entry_moment,
+                                   exit_moment, moments, order_ids)
+        for i, closed in closes:
+            exit_bar[closed] = placed[i]
+            exit_price[closed] = close[placed[i]]
+            exit_reason[closed] = 4
+            stored[i] = False
+        opened = market.copy()
+        opened[[i for i, closed in closes]] = False
+        stored |= opened
+
+        # The fills closing an order are in the opposite direction,
+        # those of the market orders as those orders are.
+        close_direction = np.where(buy, 'SELL', 'BUY')
+        close_quantity = quantity.copy()
+        for i, closed in closes:
+            close_direction[closed] = direction[i]
+            close_quantity[closed] = quantity[i]
+
+        # Fills are priced by the cost model at the price triggered
+        exited = exit_reason > 0
+        entry_commission = np.zeros(m)
+        exit_commission = np.zeros(m)
+        idx = np.flatnonzero(entered & stored)
+        entry_price[idx], entry_commission[idx] = self._fill_costs(
+            symbol, epochs[entry_bar[idx]], entry_price[idx], direction[idx],
+            np.where(market[idx], MARKET, order_type[idx]), quantity[idx]
+        )
+        idx = np.flatnonzero(exited & stored)
+        exit_price[idx], exit_commission[idx] = self._fill_costs(
+            symbol, epochs[exit_bar[idx]], exit_price[idx],
+            close_direction[idx], EXIT_KINDS[exit_reason[idx]],
+            close_quantity[idx]
+        )
+        profit = np.where(exited, (exit_price - entry_price) * quantity, np.nan)
+        # Fills are stamped after the latency, to the microsecond
+        stamps = epochs + self.cost_model.latency // 1000 * 1000
+
+        def times(bar, has):
+            values = stamps[np.minimum(bar, n - 1)].astype('datetime64[ns]')
+            values[~has] = np.datetime64('NaT')
+            return values
+
+        rows = np.flatnonzero(stored)
+        orders = pd.DataFrame({
+            'order_id': order_ids[rows],
+            'symbol': symbol,
+            'order_type': order_type[rows],
+            'direction': direction[rows],
+            'quantity': quantity[rows],
+            'stop_loss': stop_loss[rows],
+            'profit_target': profit_target[rows],
+            'limit_price': limit_price[rows],
+            'stop_price': stop_price[rows],
+            'entry_time': times(entry_bar[rows], entered[rows]),
+            'entry_price': entry_price[rows],
+            'exit_time': times(exit_bar[rows], exited[rows]),
+            'exit_price': exit_price[rows],
+            'profit': profit[rows],
+            'exit_reason': np.array(EXIT_REASONS, dtype=object)[exit_reason[rows]],
+        }, columns=ORDER_FIELDS)
+
+        entries = rows[entered[rows]]
+        exits = rows[exited[rows]]
+        fills = pd.DataFrame({
+            'order_id': np.concatenate((order_ids[entries], order_ids[exits])),
+            'symbol': symbol,
+            'timeindex': np.concatenate((stamps[entry_bar[entries]],
+                                         stamps[exit_bar[exits]])),
+            'price': np.concatenate((entry_price[entries], exit_price[exits])),
+            'quantity': np.concatenate((quantity[entries],
+                                        close_quantity[exits])),
+            'direction': np.concatenate((direction[entries],
+                                         close_direction[exits])),
+            'commission': np.concatenate((entry_commission[entries],
+                                          exit_commission[exits])),
+        }, columns=FILL_FIELDS)
+        fills['timeindex'] = pd.to_datetime(fills['timeindex'])
+        return orders, fills
+
+    def _market_pass(self, market, entered, entry_moment, exit_moment,
+                     moments, order_ids):
+        """
+        Resolves the market orders of a symbol in stream order.
+        Returns the (market order, closed order) pairs of the market
+        orders that closed an open order, the others opened one.
+        """
+        triggered = np.flatnonzero(entered & ~market)
+        triggered = triggered[np.argsort(entry_moment[triggered], kind='stable')]
+        triggered_moments = entry_moment[triggered].tolist()
+        triggered = triggered.tolist()
+        exit_moment = exit_moment.tolist()
+        order_ids = order_ids.tolist()
+
+        closes = []
+        heap = []
+        t = 0
+        for i in np.flatnonzero(market).tolist():
+            now = int(moments[i])
+            while t < len(triggered) and triggered_moments[t] < now:
+                heapq.heappush(heap, (order_ids[triggered[t]], triggered[t]))
+                t += 1
+            while heap and exit_moment[heap[0][1]] <= now:
+                heapq.heappop(heap)
+            if heap:
+                closed = heapq.heappop(heap)[1]
+                exit_moment[closed] = now
+                closes.append((i, closed))
+            else:
+                heapq.heappush(heap, (order_ids[i], i))
+        return closes
@@ -0,0 +1,261 @@
+import io
+import logging
+import os
+import pickle
+import struct
+
+from . import event
+from .event import OrderEvent
+
+logger = logging.getLogger(__name__)
+
+# Portfolio lists that only ever grow, only their new items are
+# written to a checkpoint.
+APPENDED = ('all_positions', 'all_holdings', 'all_fills')
+
+# Portfolio attributes written in full to every checkpoint.
+SNAPSHOT = ('current_positions', 'current_holdings')
+
+# Strategy attributes that are components of the backtest, not state.
+STRATEGY_REFERENCES = ('bars', 'events')
+
+# Every record is prefixed with its length.
+HEADER = struct.Struct('<Q')
+
+
+def _order_state(order):
+    return tuple(getattr(order, name) for name in OrderEvent.__slots__
+                 if name != '_uuid')
+
+
+class _OrderPickler(pickle.Pickler):
+    """
+    Pickles orders as references to their order_id, the orders
+    themselves are written apart once they change.
+    """
+
+    def persistent_id(self, obj):
+        if isinstance(obj, OrderEvent):
+            return obj.order_id
+        return None
+
+
+class _OrderUnpickler(pickle.Unpickler):
+
+    def __init__(self, f, orders):
+        super(_OrderUnpickler, self).__init__(f)
+        self.orders = orders
+
+    def persistent_load(self, order_id):
+        return self.orders[order_id]
+
+
+class Checkpoint(object):
+    """
+    Checkpoint periodically saves the state of a running Backtest to
+    an append-only file, so a crashed or pre-empted run can resume
+    from its last checkpoint instead of from the start.
+
+    A checkpoint holds the data handler cursors, the portfolio
+    positions and holdings, the orders of the execution handler, the
+    strategy attributes and the counters of every strategy run.
+    Records are incremental: the growing portfolio lists, the closed
+    orders and the changed live orders are written, so a checkpoint
+    costs about as much as the bars since the previous one.
+
+    The data handler has to provide get_state() and set_state(), as
+    the BarStore based handlers do. The strategy attributes have to
+    be picklable.
+    """
+
+    def __init__(self, path, every=5000):
+        """
+        Parameters:
+        path - The checkpoint file, resumed from if it exists.
+        every - Number of bars between checkpoints.
+        """
+        self.path = path
+        self.every = every
+        self.lengths = {}
+        self.order_states = {}
+
+    def check(self, backtest):
+        """
+        Raises a ValueError unless the data handler of a backtest can
+        save its state, so an unsupported handler fails before the
+        run rather than at its first checkpoint.
+        """
+        handler = backtest.data_handler
+        try:
+            handler.get_state()
+        except (AttributeError, NotImplementedError) as e:
+            raise ValueError("Checkpoint: %s cannot be checkpointed (%s)"
+                             % (type(handler).__name__, e))
+
+    def _changed_orders(self, orders):
+        """
+        Returns the orders that changed since the last checkpoint.
+        """
+        changed = []
+        for order in orders:
+            state = _order_state(order)
+            if self.order_states.get(order.order_id) != state:
+                self.order_states[order.order_id] = state
+                changed.append(order)
+        return changed
+
+    def _appended(self, name, items):
+        """
+        Returns the items of a growing list added since the last
+        checkpoint.
+        """
+        start = self.lengths.get(name, 0)
+        self.lengths[name] = len(items)
+        return items[start:]
+
+    def _run_state(self, i, strategy_run):
+        """
+        Returns the state of the i-th strategy run of a backtest and
+        the orders it refers to.
+        """
+        portfolio = strategy_run.portfolio
+        handler = strategy_run.execution_handler
+        if hasattr(handler, 'closed_orders'):
+            # Only the live orders can still change, the archive of
+            # closed orders only grows
+            closed_orders = self._appended((i, 'closed_orders'),
+                                           handler.closed_orders)
+            execution_orders = handler.live_orders()
+        else:
+            closed_orders = []
+            execution_orders = list(getattr(handler, 'all_orders', []))
+        portfolio_orders = self._appended(
+            (i, 'portfolio_orders'),
+            list(getattr(portfolio, 'all_orders', {}).items())
+        )
+        state = {
+            'counters': (strategy_run.signals, strategy_run.orders,
+                         strategy_run.fills),
+            'snapshot': dict((name, getattr(portfolio, name))
+                             for name in SNAPSHOT if hasattr(portfolio, name)),
+            'appended': dict((name, self._appended((i, name),
+                                                   getattr(portfolio, name)))
+                             for name in APPENDED if hasattr(portfolio, name)),
+            'portfolio_orders': portfolio_orders,
+            'execution_orders': execution_orders,
+            'closed_orders': closed_orders,
+            'strategy': dict((k, v) for k, v in
+                             vars(strategy_run.strategy).items()
+                             if k not in STRATEGY_REFERENCES),
+        }
+        return state, execution_orders + closed_orders + \
+            [order for key, order in portfolio_orders]
+
+    def save(self, backtest):
+        """
+        Appends a checkpoint of the backtest to the file.
+        """
+        runs = []
+        orders = []
+        for i, strategy_run in enumerate(backtest.strategy_runs):
+            run_state, run_orders = self._run_state(i, strategy_run)
+            runs.append(run_state)
+            orders.extend(run_orders)
+        state = {
+            'bars': backtest.bars_processed,
+            'ids': event.next_ids(),
+            'data': backtest.data_handler.get_state(),
+            'runs': runs,
+        }
+        buf = io.BytesIO()
+        pickle.dump(self._changed_orders(orders), buf, pickle.HIGHEST_PROTOCOL)
+        _OrderPickler(buf, pickle.HIGHEST_PROTOCOL).dump(state)
+        record = buf.getvalue()
+        with open(self.path, 'ab') as f:
+            f.write(HEADER.pack(len(record)) + record)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _records(self):
+        """
+        Yields the payload of every complete record. A record cut
+        short by a crash is removed from the file.
+        """
+        with open(self.path, 'r+b') as f:
+            good = 0
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                record = f.read(HEADER.unpack(header)[0])
+                if len(record) < HEADER.unpack(header)[0]:
+                    break
+                good = f.tell()
+                yield record
+            if f.seek(0, os.SEEK_END) != good:
+                logger.warning("Checkpoint: dropping an incomplete record")
+                f.truncate(good)
+
+    def restore(self, backtest):
+        """
+        Restores the backtest from the last checkpoint in the file.
+        Returns False if there is none.
+        """
+        if not os.path.exists(self.path):
+            return False
+        # The latest copy of every order is read first, so the states
+        # of all records refer to it rather than to older copies
+        orders = {}
+        states = []
+        for record in self._records():
+            buf = io.BytesIO(record)
+            for order in pickle.load(buf):
+                orders[order.order_id] = order
+                self.order_states[order.order_id] = _order_state(order)
+            states.append(buf)
+        appended = {}
+        state = None
+        for buf in states:
+            state = _OrderUnpickler(buf, orders).load()
+            for i, run_state in enumerate(state['runs']):
+                for name, items in run_state['appended'].items():
+                    appended.setdefault((i, name), []).extend(items)
+                for name in ('portfolio_orders', 'closed_orders'):
+                    appended.setdefault((i, name), []).extend(
+                        run_state.get(name, [])
+                    )
+        if state is None:
+            return False
+
+        backtest.bars_processed = state['bars']
+        event.reset_ids(*state['ids'])
+        backtest.data_handler.set_state(state['data'])
+        for i, strategy_run in enumerate(backtest.strategy_runs):
+            self._restore_run(i, strategy_run, state['runs'][i], appended)
+        logger.info("Checkpoint: resumed after %d bars",
+                    backtest.bars_processed)
+        return True
+
+    def _restore_run(self, i, strategy_run, state, appended):
+        """
+        Restores the i-th strategy run of a backtest.
+        """
+        (strategy_run.signals, strategy_run.orders,
+         strategy_run.fills) = state['counters']
+        portfolio = strategy_run.portfolio
+        for name, value in state['snapshot'].items():
+            setattr(portfolio, name, value)
+        for name in state['appended']:
+            items = appended[(i, name)]
+            setattr(portfolio, name, items)
+            self.lengths[(i, name)] = len(items)
+        portfolio_orders = appended[(i, 'portfolio_orders')]
+        if hasattr(portfolio, 'all_orders'):
+            portfolio.all_orders = dict(portfolio_orders)
+        self.lengths[(i, 'portfolio_orders')] = len(portfolio_orders)
+        closed_orders = appended[(i, 'closed_orders')]
+        self.lengths[(i, 'closed_orders')] = len(closed_orders)
+        if hasattr(strategy_run.execution_handler, 'all_orders'):
+            strategy_run.execution_handler.all_orders = \
+                closed_orders + state['execution_orders']
+        strategy_run.strategy.__dict__.update(state['strategy'])
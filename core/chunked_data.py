@@ -0,0 +1,197 @@
+from concurrent.futures import ThreadPoolExecutor
+import os, os.path
+
+import numpy as np
+import pandas as pd
+
+from .bar_store import BarMerge, RingBarStore
+from .data import HistoricCSVDataHandler
+from .data_cache import frame_to_arrays
+
+
+class CSVChunkFeed(object):
+    """
+    CSVChunkFeed streams the bars of one CSV file in fixed size
+    chunks into a RingBarStore. The next chunk is parsed on a
+    background thread while the current one is being consumed.
+
+    The file is assumed to be sorted by time.
+    """
+
+    def __init__(self, fn, columns, store, executor, chunksize):
+        """
+        Initialises the feed and starts reading the first chunk.
+
+        Parameters:
+        fn - Path to the CSV file.
+        columns - Column names of the file, the first one is the index.
+        store - The RingBarStore that receives the bars.
+        executor - The executor used to prefetch chunks.
+        chunksize - Number of rows parsed per chunk.
+        """
+        self.fn = fn
+        self.columns = columns
+        self.store = store
+        self.executor = executor
+        self.chunksize = chunksize
+        self.reader = pd.read_csv(fn, header=0, index_col=0, names=columns,
+                                  chunksize=chunksize)
+        self.epochs = None
+        self.values = None
+        self.pos = 0
+        # Row of the file the current chunk starts at
+        self.start = 0
+        self.future = self.executor.submit(self._read_chunk)
+        self._next_chunk()
+
+    def _read_chunk(self):
+        """
+        Parses the next chunk, returns None at the end of the file.
+        """
+        try:
+            frame = next(self.reader)
+        except StopIteration:
+            return None
+        return frame_to_arrays(frame)
+
+    def _next_chunk(self):
+        """
+        Swaps in the prefetched chunk and starts reading the next.
+        """
+        chunk = self.future.result()
+        self.future = None
+        if self.epochs is not None:
+            self.start += len(self.epochs)
+        if chunk is None or len(chunk[0]) == 0:
+            self.epochs = None
+            self.values = None
+            return
+        self.epochs, values = chunk
+        # One row per bar, so a bar can be pushed with a single copy
+        self.values = values.T.copy()
+        self.pos = 0
+        self.future = self.executor.submit(self._read_chunk)
+
+    def has_next(self):
+        """
+        Returns True while there are still unreleased bars.
+        """
+        return self.epochs is not None
+
+    def next_epoch(self):
+        """
+        Returns the timestamp of the next bar as epoch nanoseconds.
+        """
+        return int(self.epochs[self.pos])
+
+    def seek(self, epoch, warmup=0):
+        """
+        Skips forward so that the next bar released is the first one
+        at or after epoch. Only the last warmup bars before it are
+        pushed into the ring buffer, earlier chunks are skipped.
+
+        Parameters:
+        epoch - The start timestamp as epoch nanoseconds.
+        warmup - Number of bars before the start to expose.
+        """
+        self.store.grow(warmup)
+        while self.epochs is not None:
+            stop = int(np.searchsorted(self.epochs, epoch, side='left'))
+            for i in range(max(self.pos, stop - warmup), stop):
+                self.store.push(self.epochs[i], self.values[i])
+            if stop < len(self.epochs):
+                self.pos = max(self.pos, stop)
+                break
+            self._next_chunk()
+        self.store.truncate(warmup)
+
+    def get_state(self):
+        """
+        Returns the row of the next bar, None at the end of the file,
+        and the state of the ring buffer, e.g. for a checkpoint.
+        """
+        row = self.start + self.pos if self.has_next() else None
+        return row, self.store.get_state()
+
+    def set_state(self, state):
+        """
+        Restores a position returned by get_state, reopening the
+        file at the row of the next bar.
+        """
+        row, store_state = state
+        if self.future is not None:
+            self.future.result()
+        self.epochs = None
+        self.values = None
+        self.pos = 0
+        if row is None:
+            self.future = None
+        else:
+            self.reader = pd.read_csv(self.fn, header=0, index_col=0,
+                                      names=self.columns,
+                                      chunksize=self.chunksize,
+                                      skiprows=range(1, row + 1))
+            self.start = row
+            self.future = self.executor.submit(self._read_chunk)
+            self._next_chunk()
+        self.store.set_state(store_state)
+
+    def advance(self):
+        """
+        Releases the next bar into the ring buffer.
+        """
+        pos = self.pos
+        self.store.push(self.epochs[pos], self.values[pos])
+        self.pos = pos + 1
+        if self.pos == len(self.epochs):
+            self._next_chunk()
+
+
+class HistoricCSVChunkedDataHandler(HistoricCSVDataHandler):
+    """
+    HistoricCSVChunkedDataHandler reads the CSV files of each
+    requested symbol in fixed size chunks instead of loading them
+    fully, for data sets larger than memory.
+
+    Only the lookback window the strategies request is kept per
+    symbol, so peak memory depends on the lookback and chunk size
+    rather than on the length of the data, and the first event is
+    available as soon as the first chunk is parsed.
+    """
+
+    def __init__(self, events, csv_dir, symbol_list, lookback=100,
+                 chunksize=50000, prefetch_workers=4):
+        """
+        Initialises the chunked data handler.
+
+        Parameters:
+        events - The Event Queue.
+        csv_dir - Absolute directory path to the CSV files.
+        symbol_list - A list of symbol strings.
+        lookback - Initial number of bars kept per symbol, grows to
+                   the largest N requested by the strategies.
+        chunksize - Number of rows parsed per chunk.
+        prefetch_workers - Number of threads parsing chunks ahead.
+        """
+        self.lookback = lookback
+        self.chunksize = chunksize
+        self.executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+        super(HistoricCSVChunkedDataHandler, self).__init__(
+            events, csv_dir, symbol_list, cache_dir=None
+        )
+
+    def _open_convert_csv_files(self):
+        """
+        Opens a chunked reader per symbol and merges the feeds
+        on their timestamps.
+        """
+        fields = self.csv_columns[1:]
+        self.feeds = []
+        for s in self.symbol_list:
+            fn = os.path.join(self.csv_dir, '%s.csv' % s)
+            self.symbol_data[s] = RingBarStore(fields, self.lookback)
+            self.feeds.append((s, CSVChunkFeed(
+                fn, self.csv_columns, self.symbol_data[s],
+                self.executor, self.chunksize
+            )))
+        self.merge = BarMerge(self.feeds)
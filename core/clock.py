@@ -0,0 +1,144 @@
+from abc import ABCMeta, abstractmethod
+import selectors
+import time
+
+
+class Clock(object):
+    """
+    Clock is an abstract base class deciding when the Backtest loop
+    releases the next bars of the data handler, so the same loop can
+    run a backtest as fast as possible, replay history paced against
+    the bar timestamps or wait for live data.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def start(self):
+        """
+        Called once before the first bars are released.
+        """
+        pass
+
+    @abstractmethod
+    def update(self, data_handler):
+        """
+        Releases the next bars of data_handler once they are due.
+        """
+        raise NotImplementedError("Should implement update()")
+
+
+class BacktestClock(Clock):
+    """
+    BacktestClock releases bars as fast as they can be processed.
+    """
+
+    def update(self, data_handler):
+        data_handler.update_bars()
+
+
+class HeartbeatClock(Clock):
+    """
+    HeartbeatClock waits a fixed heartbeat in seconds after each
+    step, the behaviour of Backtest before clocks were introduced.
+    """
+
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+
+    def update(self, data_handler):
+        data_handler.update_bars()
+        time.sleep(self.heartbeat)
+
+
+class ReplayClock(Clock):
+    """
+    ReplayClock replays history at speed times real time, e.g.
+    speed=60 plays one hour of bars per minute. The events of a bar
+    are handed out once the wall time elapsed since the first bar
+    reaches the bar time elapsed since then divided by speed.
+    """
+
+    def __init__(self, speed=1.0):
+        """
+        Parameters:
+        speed - Multiple of real time the bars are replayed at.
+        """
+        self.speed = float(speed)
+        self.start_epoch = None
+        self.start_time = None
+
+    def start(self):
+        self.start_epoch = None
+        self.start_time = None
+
+    def _latest_epoch(self, data_handler):
+        """
+        Returns the timestamp of the most recent bar of any symbol,
+        or None before the first bar.
+        """
+        latest = None
+        for s in data_handler.symbol_list:
+            try:
+                epoch = data_handler.get_latest_bar_epoch(s)
+            except IndexError:
+                continue
+            if latest is None or epoch > latest:
+                latest = epoch
+        return latest
+
+    def update(self, data_handler):
+        data_handler.update_bars()
+        epoch = self._latest_epoch(data_handler)
+        if epoch is None:
+            return
+        if self.start_epoch is None:
+            self.start_epoch = epoch
+            self.start_time = time.monotonic()
+            return
+        due = self.start_time + (epoch - self.start_epoch) / 1e9 / self.speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LiveClock(Clock):
+    """
+    LiveClock blocks until market data arrives instead of polling.
+
+    The sockets or pipes a live data handler reads from are
+    registered with register() and waited on with the selectors
+    module (epoll on Linux, kqueue on BSD). The data handler is only
+    asked for new bars once one of them is readable. An asyncio
+    program can register the same objects with loop.add_reader.
+
+    Data handlers that receive their data on a thread of a broker
+    API should block in update_bars() instead, e.g. on a queue.Queue,
+    in which case no file object is registered.
+    """
+
+    def __init__(self, timeout=None):
+        """
+        Parameters:
+        timeout - Seconds to wait for data before asking the data
+                  handler anyway, e.g. to close bars on time. None
+                  waits indefinitely.
+        """
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, callback=None):
+        """
+        Waits on fileobj for data. If given, callback(fileobj) is
+        called when it becomes readable, before update_bars().
+        """
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def unregister(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def update(self, data_handler):
+        if self.selector.get_map():
+            for key, mask in self.selector.select(self.timeout):
+                if key.data is not None:
+                    key.data(key.fileobj)
+        data_handler.update_bars()
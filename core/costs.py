@@ -0,0 +1,204 @@
+import bisect
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .bar_store import BarStore
+
+logger = logging.getLogger(__name__)
+
+# The kinds of fill a cost model prices: at the close for market
+# orders and CLOSE_ALL, at a limit price for limit entries and
+# profit targets, at a stop price for stop entries and stop losses.
+MARKET = 'MKT'
+LIMIT = 'LMT'
+STOP = 'STP'
+
+DAY = 24 * 60 * 60 * 10 ** 9
+
+
+class CostModel(object):
+    """
+    CostModel prices the fills of SimulatedExecutionHandler: the
+    spread and slippage that move a fill away from its close or
+    trigger price, the latency before it and its commission.
+
+    This base model has no spread, slippage or latency and charges
+    the commissions the handler always did, so backtests are
+    unchanged. Give a handler another model by binding it with
+    functools.partial(SimulatedExecutionHandler, cost_model=model),
+    so cost assumptions can be swept without handler subclasses.
+    """
+
+    # Delay between a bar and its fills in epoch nanoseconds
+    latency = 0
+
+    def __init__(self, trigger_commission=0.01, market_commission=0.0):
+        """
+        Parameters:
+        trigger_commission - Commission of a limit or stop fill.
+        market_commission - Commission of a fill at the close.
+        """
+        self.trigger_commission = trigger_commission
+        self.market_commission = market_commission
+
+    def bind(self, bars):
+        """
+        Called by the execution handler with its data handler before
+        the first bar. Models precompute what they look up per fill
+        here.
+        """
+        pass
+
+    def fill_price(self, symbol, epoch, price, direction, kind):
+        """
+        Returns the price a fill is made at.
+
+        Parameters:
+        symbol - The symbol filled.
+        epoch - The time of the fill as epoch nanoseconds.
+        price - The close or trigger price.
+        direction - 'BUY' or 'SELL'.
+        kind - MARKET, LIMIT or STOP.
+        """
+        return price
+
+    def commission(self, symbol, epoch, price, quantity, kind):
+        """
+        Returns the commission of a fill of quantity at price.
+        """
+        if kind == MARKET:
+            return self.market_commission
+        return self.trigger_commission
+
+
+class TableCostModel(CostModel):
+    """
+    TableCostModel charges a spread and a slippage that vary by
+    symbol and by time of day, looked up in tables precomputed once
+    when the model is bound to the data handler, so pricing a fill
+    is a bisection and a few list lookups.
+
+    Every fill pays half the spread against its direction. Market
+    and stop fills also pay the slippage, limit fills do not. The
+    slippage of a symbol at a time of day is a fraction of the mean
+    range, high - low, of the last slippage_window of its bars
+    starting at that time of day, so it follows the volatility of
+    the sessions. Only bars that started before the bar of the fill
+    are averaged, so no fill is priced with ranges of later bars.
+    Until a time of day has such a bar, the mean range of all the
+    earlier bars is used, and no slippage before the first bar.
+    """
+
+    def __init__(self, spread=0.0, spread_profile=None, slippage=0.0,
+                 commission=0.0, commission_rate=0.0, latency=0, buckets=24,
+                 slippage_window=20):
+        """
+        Parameters:
+        spread - The full spread in price units, or a dict of symbol
+                 -> spread.
+        spread_profile - Optional sequence of buckets multipliers of
+                         the spread by time of day, e.g. wider around
+                         the rollover.
+        slippage - Slippage of the market and stop fills as a fraction
+                   of the mean bar range.
+        commission - Commission per fill.
+        commission_rate - Commission as a fraction of the traded value.
+        latency - Delay between a bar and its fills, a timedelta or
+                  epoch nanoseconds. Fills are stamped and priced at
+                  the delayed time of day.
+        buckets - Number of time of day buckets of the tables.
+        slippage_window - Number of earlier bars of a time of day
+                          whose ranges are averaged.
+        """
+        super(TableCostModel, self).__init__(commission, commission)
+        self.spread = spread
+        if spread_profile is None:
+            spread_profile = np.ones(buckets)
+        self.spread_profile = np.asarray(spread_profile, dtype=np.float64)
+        if len(self.spread_profile) != buckets:
+            raise ValueError("spread_profile needs %d values" % buckets)
+        self.slippage = slippage
+        self.commission_rate = commission_rate
+        self.latency = int(pd.Timedelta(latency).value)
+        self.buckets = buckets
+        self.bucket_ns = DAY // buckets
+        self.slippage_window = slippage_window
+        # symbol -> (half spreads by time of day bucket, slippages)
+        self.tables = {}
+
+    def _trailing_means(self, epochs, ranges):
+        """
+        Returns the epochs and the slippages after each of them: the
+        i-th slippage is the fraction self.slippage of the mean of the
+        last slippage_window ranges before epochs[i], the first one 0.
+        """
+        totals = np.concatenate(([0.0], np.cumsum(ranges)))
+        ends = np.arange(len(ranges) + 1)
+        starts = np.maximum(ends - self.slippage_window, 0)
+        means = (totals[ends] - totals[starts]) / np.maximum(ends - starts, 1)
+        return epochs.tolist(), (self.slippage * means).tolist()
+
+    def _slippage_tables(self, store):
+        """
+        Returns the trailing slippages of a BarStore over all its bars
+        and by time of day bucket, as pairs of _trailing_means.
+        """
+        ranges = store.columns['high'] - store.columns['low']
+        bucket = (store.epochs // self.bucket_ns) % self.buckets
+        by_bucket = []
+        for i in range(self.buckets):
+            inside = bucket == i
+            by_bucket.append(
+                self._trailing_means(store.epochs[inside], ranges[inside])
+            )
+        return self._trailing_means(store.epochs, ranges), by_bucket
+
+    def bind(self, bars):
+        """
+        Precomputes the tables of the symbols of the data handler,
+        replacing those of any handler bound before.
+        """
+        self.tables = {}
+        for s in bars.symbol_list:
+            spread = self.spread
+            if isinstance(spread, dict):
+                spread = spread.get(s, 0.0)
+            half_spread = 0.5 * spread * self.spread_profile
+            slippage = None
+            if self.slippage:
+                store = bars.symbol_data[s]
+                if isinstance(store, BarStore):
+                    slippage = self._slippage_tables(store)
+                else:
+                    # Streamed stores do not hold the bars in advance
+                    logger.warning("TableCostModel: no bars to estimate "
+                                   "the slippage of %s", s)
+            self.tables[s] = (half_spread.tolist(), slippage)
+
+    def _slippage(self, slippage, epoch, i):
+        """
+        Returns the slippage of a fill at epoch in time of day bucket
+        i, from the bars that started before the bar of the fill.
+        """
+        # Fills are delayed by the latency after the start of their bar
+        start = epoch - self.latency
+        epochs, means = slippage[1][i]
+        j = bisect.bisect_left(epochs, start)
+        if j:
+            return means[j]
+        epochs, means = slippage[0]
+        return means[bisect.bisect_left(epochs, start)]
+
+    def fill_price(self, symbol, epoch, price, direction, kind):
+        half_spread, slippage = self.tables[symbol]
+        i = (epoch // self.bucket_ns) % self.buckets
+        cost = half_spread[i]
+        if kind != LIMIT and slippage is not None:
+            cost += self._slippage(slippage, epoch, i)
+        return price + cost if direction == 'BUY' else price - cost
+
+    def commission(self, symbol, epoch, price, quantity, kind):
+        return self.trigger_commission + \
+            self.commission_rate * abs(price * quantity)
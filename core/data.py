@@ -5,6 +5,8 @@ import os, os.path
 import pandas as pd
 import numpy as np
 
+from .bar_store import BarMerge, BarStore, to_epoch
+from .data_cache import DEFAULT_CACHE_DIR, load_csv
 from .event import MarketEvent
 
 class DataHandler(object):
@@ -44,6 +46,14 @@ class DataHandler(object):
         """
         raise NotImplementedError("Should implement get_latest_bar_datetime()")
 
+    @abstractmethod
+    def get_latest_bar_epoch(self, symbol):
+        """
+        Returns the timestamp of the last bar as int64 UTC epoch
+        nanoseconds.
+        """
+        raise NotImplementedError("Should implement get_latest_bar_epoch()")
+
     @abstractmethod
     def get_latest_bar_value(self, symbol, val_type):
         """
@@ -68,172 +78,237 @@ class DataHandler(object):
         """
         raise NotImplementedError("Should implement update_bars()")
 
-
-class HistoricCSVDataHandler(DataHandler):
-    """
-    HistoricCSVDataHandler is designed to read CSV files for
-    each requested symbol from disk and provide an interface
-    to obtain the "latest" bar in a manner identical to a live
-    trading interface.
-    """
-
-    def __init__(self, events, csv_dir, symbol_list):
+    def get_state(self):
         """
-        Initialises the historic data handler by requesting
-        the location of the CSV files and a list of symbols.
-
-        It will be assumed that all files are of the form
-        'symbol.csv', where symbol is a string in the list.
+        Returns the position of the data feed, e.g. for a checkpoint.
+        Only needed by the handlers that can be checkpointed.
+        """
+        raise NotImplementedError("Should implement get_state()")
 
-        Parameters:
-        events - The Event Queue.
-        csv_dir - Absolute directory path to the CSV files.
-        symbol_list - A list of symbol strings.
+    def set_state(self, state):
         """
-        self.events = events
-        self.csv_dir = csv_dir
-        self.symbol_list = symbol_list
+        Restores a position returned by get_state.
+        """
+        raise NotImplementedError("Should implement set_state()")
 
-        self.symbol_data = {}
-        self.raw_data = {}
-        self.latest_symbol_data = {}
-        self.continue_backtest = True
 
-        self._open_convert_csv_files()
+class BarStoreDataHandler(DataHandler):
+    """
+    BarStoreDataHandler implements the DataHandler interface on top
+    of one bar store per symbol (a BarStore or a RingBarStore) in
+    self.symbol_data, released in timestamp order by a BarMerge
+    over the feeds in self.feeds.
 
-    def _open_convert_csv_files(self):
-        """
-        Opens the CSV files from the data directory, converting
-        them into pandas DataFrames within a symbol dictionary.
+    Subclasses only have to fill self.symbol_data, self.feeds and
+    self.merge.
+    """
 
-        For this handler it will be assumed that the data is
-        taken from demo data csv data. Thus its format will be respected.
-        """
-        comb_index = None
-        for s in self.symbol_list:
-            # Load the CSV file with no header information, indexed on date
-            fn = os.path.join(self.csv_dir, '%s.csv' % s)
-            # print(fn)
-            self.symbol_data[s] = pd.io.parsers.read_csv(fn,
-                                      header=0, index_col=0,
-                                      names=['datetime','open',
-                                      'high','low','close']
-                                  )
-            self.raw_data[s] = pd.read_csv(fn,header=0, index_col=0,names=['datetime','open','high','low','close'])
-            self.raw_data[s].sort_index(inplace=True)
-            self.symbol_data[s].sort_index(inplace=True)
-
-            # Combine the index to pad forward values
-            if comb_index is None:
-                comb_index = self.symbol_data[s].index
-                # print(comb_index)
-            else:
-                comb_index.union(self.symbol_data[s].index)
-
-            # Set the latest symbol_data to None
-            self.latest_symbol_data[s] = []
-
-        # Reindex the dataframes
-        for s in self.symbol_list:
-            # 重新 index
-            self.symbol_data[s] = self.symbol_data[s].reindex(
-                index=comb_index, method='pad'
-            )
-            # 生成一个迭代器
-            self.symbol_data[s] = self.symbol_data[s].iterrows()
+    _market_event = None
+
+    # Bars at or after this timestamp are not released, see seek()
+    end_epoch = None
 
-    def _get_new_bar(self, symbol):
+    @property
+    def raw_data(self):
         """
-        Returns the latest bar from the data feed as a tuple of
-        (sybmbol, datetime, open, high, low, close, volume).
+        Returns a dictionary of symbol -> DataFrame of all bars,
+        built on demand from the bar stores (used for plotting).
         """
-        for b in self.symbol_data[symbol]:
-            yield b
-            # Code below used to deal with intraday data from Oanda
-            # there is simply no way that Python strptime could parse
-            # nanosecond. so tirm of the last 3 digits.
-            # ref: https://stackoverflow.com/questions/57086011/2019-07-17t000000-000000000z-does-not-match-format-y-m-dthms-fz
-            # yield tuple([symbol, datetime.datetime.strptime(b[0][:-4], "%Y-%m-%dT%H:%M:%S.%f"),
-            #             b[1][0], b[1][1], b[1][2], b[1][3], b[1][4]])\
+        return dict(
+            (s, pd.DataFrame(store.columns, index=store.index))
+            for s, store in self.symbol_data.items()
+        )
 
-    def get_latest_bar(self, symbol):
+    def _get_store(self, symbol):
         """
-        Returns the last bar from the latest_symbol list.
+        Returns the BarStore of a symbol.
         """
         try:
-            bars_list = self.latest_symbol_data[symbol]
+            return self.symbol_data[symbol]
         except KeyError:
             print("That symbol is not available in the historical data set.")
             raise
-        else:
-            return bars_list[-1]
+
+    def get_latest_bar(self, symbol):
+        """
+        Returns the last bar as a (datetime, {field: value}) tuple.
+        """
+        return self._get_store(symbol).latest_bars(1)[-1]
 
     def get_latest_bars(self, symbol, N=1):
         """
-        Returns the last N bars from the latest_symbol list,
-        or N-k if less available.
+        Returns the last N bars as (datetime, {field: value})
+        tuples, or N-k if less available.
         """
-        try:
-            bars_list = self.latest_symbol_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list[-N:]
+        return self._get_store(symbol).latest_bars(N)
 
     def get_latest_bar_datetime(self, symbol):
         """
         Returns a Python datetime object for the last bar.
         """
-        try:
-            bars_list = self.latest_symbol_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return bars_list[-1][0]
+        return self._get_store(symbol).latest_datetime()
+
+    def get_latest_bar_epoch(self, symbol):
+        """
+        Returns the timestamp of the last bar as int64 UTC epoch
+        nanoseconds.
+        """
+        return self._get_store(symbol).latest_epoch()
 
     def get_latest_bar_value(self, symbol, val_type):
         """
         Returns one of the Open, High, Low, Close, Volume or OpenInterest
         for the last bar.
         """
-        try:
-            bars_list = self.latest_symbol_data[symbol]
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return getattr(bars_list[-1][1], val_type)
+        return self._get_store(symbol).latest_value(val_type)
 
     def get_latest_bars_values(self, symbol, val_type, N=1):
         """
         Returns one of the Open, High, Low, Close, Volume or OpenInterest
         for the last N bars, N-k if less available.
+
+        The result is a read-only view, copy it before modifying.
         """
-        try:
-            bars_list = self.get_latest_bars(symbol, N)
-        except KeyError:
-            print("That symbol is not available in the historical data set.")
-            raise
-        else:
-            return np.array([getattr(b[1], val_type) for b in bars_list])
+        return self._get_store(symbol).latest_values(val_type, N)
+
+    def seek(self, start_date, warmup=0, end_date=None):
+        """
+        Positions every symbol at start_date with a binary search
+        on its timestamps, so a backtest can start at any date
+        without replaying the bars before it.
+
+        Parameters:
+        start_date - The datetime of the first bar to release, None
+                     for the first bar of the data.
+        warmup - Number of bars before start_date kept visible
+                 to lookback queries.
+        end_date - Optional datetime, bars at or after it are not
+                   released.
+        """
+        if start_date is not None:
+            epoch = to_epoch(start_date)
+            for s, feed in self.feeds:
+                feed.seek(epoch, warmup)
+            self.merge = BarMerge(self.feeds)
+        self.end_epoch = None if end_date is None else to_epoch(end_date)
+        self.continue_backtest = self._has_next()
+
+    def get_state(self):
+        """
+        Returns the position of every feed, e.g. for a checkpoint.
+        The feeds have to provide get_state(), as BarStores do.
+        """
+        return dict((s, feed.get_state()) for s, feed in self.feeds)
 
+    def set_state(self, state):
+        """
+        Restores the positions returned by get_state.
+        """
+        for s, feed in self.feeds:
+            feed.set_state(state[s])
+        self.merge = BarMerge(self.feeds)
+        self.continue_backtest = self._has_next()
+
+    def _has_next(self):
+        """
+        Returns True while there are bars left before the end date.
+        """
+        if not self.merge.has_next():
+            return False
+        return self.end_epoch is None or self.merge.next_epoch() < self.end_epoch
 
     def update_bars(self):
         """
-        Pushes the latest bar to the latest_symbol_data structure
-        for all symbols in the symbol list.
+        Pushes the bars of the next distinct timestamp to the
+        latest symbol structure and emits one MarketEvent that
+        lists the updated symbols. Symbols without a bar at that
+        timestamp keep their previous bar.
+        """
+        if not self._has_next():
+            self.continue_backtest = False
+            return
+        symbols = self.merge.advance()
+        if not self._has_next():
+            self.continue_backtest = False
+        timeindex = self.symbol_data[symbols[0]].latest_datetime()
+        self._put_market_event(timeindex, symbols)
+
+    def _put_market_event(self, timeindex, symbols, timeframes=None):
+        """
+        Puts the MarketEvent of a new step onto the event queue. The
+        same instance is reused for every step, as it is consumed
+        before the next bar is released.
         """
+        event = self._market_event
+        if event is None:
+            event = self._market_event = MarketEvent()
+        event.datetime = timeindex
+        event.symbols = symbols
+        event.timeframes = timeframes
+        self.events.put(event)
+
+
+class HistoricCSVDataHandler(BarStoreDataHandler):
+    """
+    HistoricCSVDataHandler is designed to read CSV files for
+    each requested symbol from disk and provide an interface
+    to obtain the "latest" bar in a manner identical to a live
+    trading interface.
+
+    The bars of each symbol are preloaded into a columnar BarStore
+    and released one by one by moving its cursor, so lookback
+    queries are served as zero-copy array slices.
+    """
+
+    # Column names of the CSV files, the first one is the index.
+    csv_columns = ['datetime', 'open', 'high', 'low', 'close']
+
+    def __init__(self, events, csv_dir, symbol_list,
+                 cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Initialises the historic data handler by requesting
+        the location of the CSV files and a list of symbols.
+
+        It will be assumed that all files are of the form
+        'symbol.csv', where symbol is a string in the list.
+
+        Parameters:
+        events - The Event Queue.
+        csv_dir - Absolute directory path to the CSV files.
+        symbol_list - A list of symbol strings.
+        cache_dir - Directory of the binary data cache, None disables it.
+        """
+        self.events = events
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+        self.cache_dir = cache_dir
+
+        self.symbol_data = {}
+        self.continue_backtest = True
+
+        self._open_convert_csv_files()
+
+    def _open_convert_csv_files(self):
+        """
+        Opens the CSV files from the data directory through the
+        binary data cache, converting them into a BarStore per
+        symbol. Timestamps are parsed once into UTC epoch nanoseconds.
+
+        The symbols keep their own timelines, a BarMerge releases
+        them in timestamp order without reindexing any of them.
+
+        For this handler it will be assumed that the data is
+        taken from demo data csv data. Thus its format will be respected.
+        """
+        fields = self.csv_columns[1:]
         for s in self.symbol_list:
-            try:
-                bar = next(self._get_new_bar(s))
-            except StopIteration:
-                self.continue_backtest = False
-            else:
-                if bar is not None:
-                    self.latest_symbol_data[s].append(bar)
-        self.events.put(MarketEvent())
+            fn = os.path.join(self.csv_dir, '%s.csv' % s)
+            index, values = load_csv(fn, self.csv_columns, self.cache_dir)
+            self.symbol_data[s] = BarStore(
+                index, dict((f, values[i]) for i, f in enumerate(fields))
+            )
+        self.feeds = [(s, self.symbol_data[s]) for s in self.symbol_list]
+        self.merge = BarMerge(self.feeds)
 
 
 if __name__ == "__main__":
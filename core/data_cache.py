@@ -0,0 +1,88 @@
+import hashlib
+import os, os.path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+# Default location of the binary market data cache.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'itrader')
+
+
+def frame_to_arrays(frame):
+    """
+    Converts a DataFrame of bars indexed on timestamp strings into
+    an int64 array of UTC epoch nanoseconds and a float64 array of
+    shape (fields, bars). Every row of the value array is one
+    contiguous field column.
+    """
+    index = pd.to_datetime(frame.index, utc=True).tz_convert(None)
+    index = np.asarray(index.values, dtype='datetime64[ns]').view(np.int64)
+    values = np.ascontiguousarray(frame.values.astype(np.float64).T)
+    return index, values
+
+
+def parse_csv(fn, columns):
+    """
+    Parses a bar CSV file into the arrays documented in
+    frame_to_arrays, sorted by time.
+
+    Parameters:
+    fn - Path to the CSV file.
+    columns - Column names of the file, the first one is the index.
+    """
+    frame = pd.read_csv(fn, header=0, index_col=0, names=columns)
+    index, values = frame_to_arrays(frame)
+    order = np.argsort(index, kind='mergesort')
+    return index[order], np.ascontiguousarray(values[:, order])
+
+
+def _cache_path(fn, columns, cache_dir):
+    """
+    Returns the cache directory of a CSV file, keyed by its
+    absolute path, size, modification time and column layout.
+    """
+    st = os.stat(fn)
+    fn = os.path.abspath(fn)
+    key = '%s|%d|%d|%s' % (fn, st.st_size, st.st_mtime_ns, ','.join(columns))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(fn))[0]
+    return os.path.join(cache_dir, '%s-%s' % (name, digest))
+
+
+def load_csv(fn, columns, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads a bar CSV file through the binary cache. The first load
+    parses the CSV and writes the result as .npy files, later
+    loads memory-map them read-only without any parsing.
+
+    Returns a tuple (index, values) as documented in parse_csv.
+
+    Parameters:
+    fn - Path to the CSV file.
+    columns - Column names of the file, the first one is the index.
+    cache_dir - Root directory of the cache, None disables it.
+    """
+    if cache_dir is None:
+        return parse_csv(fn, columns)
+
+    path = _cache_path(fn, columns, cache_dir)
+    index_fn = os.path.join(path, 'index.npy')
+    values_fn = os.path.join(path, 'values.npy')
+    if not os.path.exists(values_fn):
+        index, values = parse_csv(fn, columns)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write into a temporary directory and rename it into place,
+        # so concurrent runs never see a half written entry.
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        np.save(os.path.join(tmp, 'index.npy'), index)
+        np.save(os.path.join(tmp, 'values.npy'), values)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process has published the same entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+    return (np.load(index_fn, mmap_mode='r'),
+            np.load(values_fn, mmap_mode='r'))
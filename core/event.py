@@ -1,29 +1,102 @@
+import itertools
+import sys
 import uuid
 
 
+# Event type tags, interned so that comparing them is cheap.
+MARKET = sys.intern('MARKET')
+ACTION = sys.intern('ACTION')
+SIGNAL = sys.intern('SIGNAL')
+ORDER = sys.intern('ORDER')
+FILL = sys.intern('FILL')
+
+# Cheap, monotonically increasing ids of orders and fills.
+_order_ids = itertools.count(1)
+_fill_ids = itertools.count(1)
+
+
+def next_ids():
+    """
+    Returns the ids the next OrderEvent and FillEvent will get.
+    """
+    global _order_ids, _fill_ids
+    order_id, fill_id = next(_order_ids), next(_fill_ids)
+    _order_ids = itertools.count(order_id)
+    _fill_ids = itertools.count(fill_id)
+    return order_id, fill_id
+
+
+def reset_ids(order_id=1, fill_id=1):
+    """
+    Restarts the order and fill ids, e.g. when resuming a backtest.
+    """
+    global _order_ids, _fill_ids
+    _order_ids = itertools.count(order_id)
+    _fill_ids = itertools.count(fill_id)
+
+
 class Event(object):
   """
   Event is base class providing an interface for all subsequent
   (inherited) events, that will trigger further events in the
   trading infrastructure.
+
+  Events use __slots__ and keep their type tag on the class, so
+  creating one allocates no instance dictionary.
   """
-  pass
+
+  __slots__ = ()
+
+  type = None
+
+  def to_dict(self):
+      """
+      Returns the attributes of the event as a dictionary, led by
+      its type as vars() of the former unslotted events was.
+      """
+      attributes = {'type': self.type}
+      attributes.update(
+          (name, getattr(self, name))
+          for cls in type(self).__mro__
+          for name in getattr(cls, '__slots__', ())
+          if not name.startswith('_')
+      )
+      return attributes
 
 
 class MarketEvent(Event):
     """
     Handles the event of receiving a new market update with
     corresponding bars.
+
+    Data handlers may hand out the same instance for every bar, so
+    do not keep a reference to it beyond handling the event.
     """
 
-    def __init__(self):
+    __slots__ = ('datetime', 'symbols', 'timeframes')
+
+    type = MARKET
+
+    def __init__(self, datetime=None, symbols=None, timeframes=None):
         """
         Initialises the MarketEvent.
+
+        Parameters:
+        datetime - The timestamp of the new bars.
+        symbols - The symbols that received a new bar, None for all.
+        timeframes - The higher timeframes that completed a bar.
         """
-        self.type = 'MARKET'
+        self.datetime = datetime
+        self.symbols = symbols
+        self.timeframes = timeframes
 
 
 class ActionEvent(Event):
+
+    __slots__ = ('symbol', 'action_type')
+
+    type = ACTION
+
     def __init__(self, symbol, action_type):
         """
         Initialises the ActionEvent.
@@ -32,7 +105,6 @@ class ActionEvent(Event):
         action_type - 'CLOSE_ALL' close all unfilled and open orders. Usually used before the end of
                        each day or weekend to avoid risk or overnight fee.
         """
-        self.type = 'ACTION'
         self.symbol = symbol
         self.action_type = action_type
 
@@ -43,6 +115,12 @@ class SignalEvent(Event):
     This is received by a Portfolio object and acted upon.
     """
 
+    __slots__ = ('strategy_id', 'symbol', 'datetime', 'signal_type',
+                 'quantity', 'stop_loss', 'profit_target', 'limit_price',
+                 'stop_price', 'order_type')
+
+    type = SIGNAL
+
     def __init__(self, symbol, datetime, signal_type, order_type='MKT',
                 limit_price=None, stop_loss=None, profit_target=None,
                 stop_price=None, quantity=10000, strategy_id=1):
@@ -55,7 +133,6 @@ class SignalEvent(Event):
         signal_type - 'LONG' or 'SHORT' or 'EXIT'.
         """
 
-        self.type = 'SIGNAL'
         self.strategy_id = strategy_id
         self.symbol = symbol
         self.datetime = datetime
@@ -74,8 +151,18 @@ class OrderEvent(Event):
     Handles the event of sending an Order to an execution system.
     The order contains a symbol (e.g. GOOG), a type (market or limit),
     quantity and a direction.
+
+    Orders are numbered with a sequential integer order_id. A UUID
+    is only generated when an external broker asks for one.
     """
 
+    __slots__ = ('order_id', 'direction', 'quantity', 'symbol', 'order_type',
+                 'stop_loss', 'profit_target', 'limit_price', 'stop_price',
+                 'entry_price', 'exit_price', 'entry_time', 'exit_time',
+                 'profit', '_uuid')
+
+    type = ORDER
+
     def __init__(self, signal, quantity, direction):
         """
         Initialises the order type, setting whether it is
@@ -90,8 +177,8 @@ class OrderEvent(Event):
         direction - 'BUY' or 'SELL' for long or short.
         """
 
-        self.type = 'ORDER'
-        self.order_id = uuid.uuid4()
+        self.order_id = next(_order_ids)
+        self._uuid = None
         self.direction = direction
         self.quantity = quantity
         self.symbol = signal.symbol
@@ -106,6 +193,16 @@ class OrderEvent(Event):
         self.exit_time = None
         self.profit = None
 
+    @property
+    def uuid(self):
+        """
+        A UUID for the order, created on first use for brokers
+        that need globally unique client order ids.
+        """
+        if self._uuid is None:
+            self._uuid = uuid.uuid4()
+        return self._uuid
+
     def print_order(self):
         """
         Outputs the values within the Order.
@@ -122,6 +219,11 @@ class FillEvent(Event):
     the commission of the trade from the brokerage.
     """
 
+    __slots__ = ('fill_id', 'order', 'timeindex', 'price', 'symbol',
+                 'exchange', 'quantity', 'direction', 'commission')
+
+    type = FILL
+
     def __init__(self, order, timeindex, price, symbol, exchange, quantity,
                  direction, commission=None):
         """
@@ -142,8 +244,7 @@ class FillEvent(Event):
         commission - An optional commission sent from IB.
         """
 
-        self.type = 'FILL'
-        self.fill_id = uuid.uuid4()
+        self.fill_id = next(_fill_ids)
         self.order = order
         self.timeindex = timeindex
         self.price = price
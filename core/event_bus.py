@@ -0,0 +1,133 @@
+from abc import ABCMeta, abstractmethod
+from collections import deque
+import queue
+
+
+class EventBus(object):
+    """
+    EventBus is an abstract base class providing an interface for
+    the event queue shared by the components of the trading system.
+
+    Besides put and get, a bus can dispatch its pending events to a
+    table of handlers keyed by event type, which replaces comparing
+    the type of every event in an if/elif chain.
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def put(self, event):
+        """
+        Adds an event at the end of the bus.
+        """
+        raise NotImplementedError("Should implement put()")
+
+    @abstractmethod
+    def get(self):
+        """
+        Removes and returns the first event, or None if the bus
+        is empty.
+        """
+        raise NotImplementedError("Should implement get()")
+
+    @abstractmethod
+    def empty(self):
+        """
+        Returns True if there are no pending events.
+        """
+        raise NotImplementedError("Should implement empty()")
+
+    def dispatch(self, handlers):
+        """
+        Hands the pending events, including those put by the
+        handlers themselves, to the handler registered for their
+        type until the bus is empty. Events without a handler are
+        dropped.
+
+        Parameters:
+        handlers - Dict of event type -> callable taking the event.
+        """
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            handler = handlers.get(event.type)
+            if handler is not None:
+                handler(event)
+
+
+class DequeEventBus(EventBus):
+    """
+    DequeEventBus is a plain collections.deque without any locking,
+    for backtests where the data handler, strategy, portfolio and
+    execution handler all run on the same thread.
+    """
+
+    def __init__(self):
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, event):
+        self.queue.append(event)
+
+    def get(self):
+        if self.queue:
+            return self.queue.popleft()
+        return None
+
+    def empty(self):
+        return not self.queue
+
+    def dispatch(self, handlers):
+        """
+        Hands the pending events to their handlers, see
+        EventBus.dispatch. The loop only touches local names as it
+        runs for every event of a backtest.
+        """
+        events = self.queue
+        popleft = events.popleft
+        get_handler = handlers.get
+        while events:
+            event = popleft()
+            handler = get_handler(event.type)
+            if handler is not None:
+                handler(event)
+
+
+class QueueEventBus(EventBus):
+    """
+    QueueEventBus is backed by a thread-safe queue.Queue, for live
+    trading where market data and broker callbacks arrive on other
+    threads. Coroutines on an asyncio loop should hand events over
+    with loop.call_soon_threadsafe or run_in_executor rather than
+    block on get.
+    """
+
+    def __init__(self, maxsize=0):
+        """
+        Parameters:
+        maxsize - Upper bound of pending events, 0 for no bound.
+        """
+        self.queue = queue.Queue(maxsize)
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def put(self, event):
+        self.queue.put(event)
+
+    def get(self, block=False, timeout=None):
+        """
+        Removes and returns the first event, or None if the bus is
+        empty. With block=True, waits up to timeout seconds (forever
+        if None) for an event to arrive.
+        """
+        try:
+            return self.queue.get(block, timeout)
+        except queue.Empty:
+            return None
+
+    def empty(self):
+        return self.queue.empty()
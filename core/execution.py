@@ -1,9 +1,42 @@
 import datetime
+import logging
+from operator import attrgetter
 import queue
 
 from abc import ABCMeta, abstractmethod
 
+from .bar_store import epoch_to_datetime
+from .costs import LIMIT, MARKET, STOP, CostModel
 from .event import FillEvent, OrderEvent
+from .trigger_book import TriggerBook
+
+logger = logging.getLogger(__name__)
+
+# The trigger books of the pending orders by (order_type, direction),
+# with the price they wait for and the (on_high, inclusive) trigger
+# of the book. An entry has to trade through its price.
+ENTRY_BOOKS = {
+    ('LMT', 'BUY'): ('limit_price', False, False),
+    ('LMT', 'SELL'): ('limit_price', True, False),
+    ('STP', 'BUY'): ('stop_price', True, False),
+    ('STP', 'SELL'): ('stop_price', False, False),
+}
+
+# The exit prices of the open orders, stop losses first so they win
+# when a bar touches both.
+EXITS = ('stop_loss', 'profit_target')
+
+# The kind of fill of every exit price, as CostModel prices it.
+EXIT_KINDS = {'stop_loss': STOP, 'profit_target': LIMIT}
+
+# The trigger books of the open orders by (exit price, direction)
+# with their (on_high, inclusive) trigger. An exit is touched.
+EXIT_BOOKS = {
+    ('stop_loss', 'BUY'): (False, True),
+    ('stop_loss', 'SELL'): (True, True),
+    ('profit_target', 'BUY'): (True, True),
+    ('profit_target', 'SELL'): (False, True),
+}
 
 class ExecutionHandler(object):
     """
@@ -36,14 +69,23 @@ class SimulatedExecutionHandler(ExecutionHandler):
     """
     The simulated execution handler simply converts all order
     objects into their equivalent fill objects automatically
-    without latency, slippage or fill-ratio issues.
+    without fill-ratio issues. The spread, slippage, latency and
+    commission of the fills are left to a CostModel, none but the
+    commissions by default.
 
     This allows a straightforward "first go" test of any strategy,
     before implementation with a more sophisticated execution
     handler.
+
+    Orders are indexed by symbol and state: pending orders wait for
+    their limit or stop price, open orders have entered and wait for
+    their exit, and closed orders are moved to an archive. The prices
+    the live orders wait for are kept in TriggerBooks sorted by
+    price, so a bar finds the triggered orders of a symbol with one
+    bisect per book instead of comparing every resting order.
     """
 
-    def __init__(self, events, bars):
+    def __init__(self, events, bars, intrabar=None, cost_model=None):
         """
         Initialises the handler, setting the event queues
         up internally.
@@ -51,141 +93,277 @@ class SimulatedExecutionHandler(ExecutionHandler):
         Parameters:
         events - The Queue of Event objects.
         bars - The Data Handler that give the data feed.
+        intrabar - Optional IntrabarIndex of lower timeframe bars,
+                   resolving bars that touch both exits of an order
+                   and timing the fills. Bind it with
+                   functools.partial.
+        cost_model - Optional CostModel pricing the spread, slippage,
+                     latency and commission of the fills, CostModel()
+                     if None. Bind it with functools.partial.
         """
         self.events = events
         self.bars = bars
+        self.intrabar = intrabar
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.cost_model.bind(bars)
+
+        # symbol -> {order_id: order}
+        self.pending_orders = {}
+        self.open_orders = {}
+        self.closed_orders = []
+        # symbol -> {book key: TriggerBook} of the pending and open
+        # orders that wait for a price
+        self.books = {}
+
+    @property
+    def all_orders(self):
+        """
+        All orders that were not cancelled, in the order they were
+        placed.
+        """
+        orders = list(self.closed_orders)
+        orders.extend(self.live_orders())
+        orders.sort(key=attrgetter('order_id'))
+        return orders
+
+    @all_orders.setter
+    def all_orders(self, orders):
+        self.pending_orders = {}
+        self.open_orders = {}
+        self.closed_orders = []
+        self.books = {}
+        for order in sorted(orders, key=attrgetter('order_id')):
+            if order.entry_price is None:
+                self._add_pending(order)
+            elif order.exit_price is None:
+                self._add_open(order)
+            else:
+                self.closed_orders.append(order)
 
-        self.all_orders = []
+    def live_orders(self):
+        """
+        Returns the pending and open orders of all symbols.
+        """
+        orders = []
+        for index in (self.pending_orders, self.open_orders):
+            for symbol_orders in index.values():
+                orders.extend(symbol_orders.values())
+        return orders
+
+    def _book(self, symbol, key, on_high, inclusive):
+        books = self.books.setdefault(symbol, {})
+        book = books.get(key)
+        if book is None:
+            book = books[key] = TriggerBook(on_high, inclusive)
+        return book
+
+    def _add_pending(self, order):
+        """
+        Adds a limit or stop order waiting for its entry.
+        """
+        self.pending_orders.setdefault(order.symbol, {})[order.order_id] = order
+        key = (order.order_type, order.direction)
+        if key in ENTRY_BOOKS:
+            name, on_high, inclusive = ENTRY_BOOKS[key]
+            price = getattr(order, name)
+            if price is not None:
+                self._book(order.symbol, key, on_high, inclusive).add(price, order)
+
+    def _add_open(self, order):
+        """
+        Adds an order that entered and waits for its exit.
+        """
+        self.open_orders.setdefault(order.symbol, {})[order.order_id] = order
+        for name in EXITS:
+            price = getattr(order, name)
+            key = (name, order.direction)
+            if price is not None and key in EXIT_BOOKS:
+                self._book(order.symbol, key, *EXIT_BOOKS[key]).add(price, order)
+
+    def _archive(self, order):
+        """
+        Moves an order that exited from the open orders to the
+        archive.
+        """
+        del self.open_orders[order.symbol][order.order_id]
+        books = self.books.get(order.symbol, {})
+        for name in EXITS:
+            price = getattr(order, name)
+            book = books.get((name, order.direction))
+            if price is not None and book is not None:
+                book.remove(price, order)
+        self.closed_orders.append(order)
 
     def _find_open_order(self, symbol):
         # 找到当前所有订单中还开放的订单，即 entry_price 不是 None，
         # 但是 exit_price 是 None，返回。找不到返回 None。
-        for order in self.all_orders:
-            if order.symbol == symbol and order.entry_price is not None and \
-                order.exit_price is None:
-                return order
-        return None
+        opened = self.open_orders.get(symbol)
+        if not opened:
+            return None
+        return min(opened.values(), key=attrgetter('order_id'))
 
     def _close_sametype_pending_orders_for(self, new_order):
         # 遍历所有同类型的订单
-        for order in self.all_orders[:]:
-            if order.symbol == new_order.symbol and \
-                    order.entry_price is None and \
-                    order.order_type == new_order.order_type and \
-                    order.direction == new_order.direction:
-                # 找到同类型的限价单，从当前订单池中移除
-                self.all_orders.remove(order)
+        pending = self.pending_orders.get(new_order.symbol)
+        if pending:
+            # 找到同类型的限价单，从当前订单池中移除
+            for order_id, order in list(pending.items()):
+                if order.order_type == new_order.order_type and \
+                        order.direction == new_order.direction:
+                    del pending[order_id]
+            self.books.get(new_order.symbol, {}).pop(
+                (new_order.order_type, new_order.direction), None
+            )
 
     def scan_open_orders(self, event):
-        for symbol in self.bars.symbol_list:
-            fill_events = []
+        # 只需要检查这次有新 bar 的品种
+        symbols = event.symbols
+        if symbols is None:
+            symbols = self.bars.symbol_list
+        fill_events = []
+        for symbol in symbols:
+            books = self.books.get(symbol)
+            if not books:
+                continue
             timeindex = self.bars.get_latest_bar_datetime(symbol)
             latest_bar = self.bars.get_latest_bar(symbol)[1]
+            low = latest_bar['low']
+            high = latest_bar['high']
+
+            # The orders that entered before this bar may exit on it
+            symbol_fills = self._scan_exits(books, timeindex, low, high)
+            symbol_fills.extend(self._scan_entries(symbol, books, timeindex,
+                                                   low, high))
+            if len(symbol_fills) > 1:
+                # Report the fills in the order the orders were placed
+                symbol_fills.sort(key=lambda fill_event: fill_event.order.order_id)
+            fill_events.extend(symbol_fills)
+        return fill_events
 
-            for order in self.all_orders:
-                if order.symbol != symbol:
-                    continue
-                if order.entry_price is None:
-                    if order.order_type == 'LMT' and order.limit_price is not None:
-                        # Limit order 限价单的处理，确保还没进场，并且设置好了 limit price
-                        if order.direction == 'BUY' and latest_bar['low'] < order.limit_price:
-                            # 达到了进场条件，进场。实际应该是 ask low <= 才执行，买单要看 ask
-                            # TODO: 时间应该是当前bar和之前一个bar之间的某一个时间。
-                            order.entry_time = timeindex
-                            # 简单的使用了 limit price，实际情况可能会更好的价格
-                            order.entry_price = order.limit_price
-                            print("Buy {} size of {} @ {}, at {}".format(order.quantity, order.symbol, order.limit_price, timeindex))
-                            fill_event = FillEvent(order, timeindex, order.limit_price,order.symbol,'LOCAL', order.quantity, order.direction, 0.01)
-                            fill_events.append(fill_event)
-
-                        if order.direction == 'SELL' and latest_bar['high'] > order.limit_price:
-                            # 达到了进场条件，进场。实际应该是 bid high >= 才执行，卖单要看 bid
-                            # TODO: 时间应该是当前bar和之前一个bar之间的某一个时间。
-                            order.entry_time = timeindex
-                            # 简单的使用了 limit price，实际情况可能会更好的价格
-                            order.entry_price = order.limit_price
-                            fill_event = FillEvent(order, timeindex, order.limit_price,order.symbol,'LOCAL', order.quantity, order.direction, 0.01)
-                            fill_events.append(fill_event)
-                    elif order.order_type == 'STP' and order.stop_price is not None:
-                        # Stop order 限价单的处理，确保还没进场，并且设置好了 stop_price
-                        # Stop order 不是 Stop loss!!!
-                        # 具体区别查看 https://www.babypips.com/learn/forex/types-of-orders
-
-                        # stop order 限价单的处理，确保还没进场，并且设置好了 stop_price
-                        if order.direction == 'BUY' and latest_bar['high'] > order.stop_price:
-                            # 达到了进场条件，进场。实际应该是 ask high = stop price的时候
-                            # 触发一个 MKT 的买单，这里就略过了这个过程，直接把订单成交，
-                            # 确保这个订单发生在当前bar的时间结束之前
-
-                            # TODO: 时间应该是当前bar和之前一个bar之间的某一个时间。
-                            order.entry_time = timeindex
-                            # 简单的使用了 limit price，实际情况可能会更好的价格
-                            order.entry_price = order.stop_price
-                            fill_event = FillEvent(order, timeindex, order.stop_price,order.symbol,'LOCAL', order.quantity, order.direction, 0.01)
-                            fill_events.append(fill_event)
-
-                        if order.direction == 'SELL' and latest_bar['low'] < order.stop_price:
-                            # 达到了进场条件，进场。实际应该是 bid low = stop price 的时候
-                            # 触发一个 MKT 的卖单，这里就略过了这个过程，直接把订单成交，
-                            # 确保这个订单发生在当前bar的时间结束之前
-
-                            # TODO: 时间应该是当前bar和之前一个bar之间的某一个时间。
-                            order.entry_time = timeindex
-                            # 简单的使用了 limit price，实际情况可能会更好的价格
-                            order.entry_price = order.stop_price
-                            fill_event = FillEvent(order, timeindex, order.stop_price,order.symbol,'LOCAL', order.quantity, order.direction, 0.01)
-                            fill_events.append(fill_event)
-                elif order.entry_price is not None and order.exit_price is None:
-                    # 处理已经进场的单子，触发止损 stop 或者止盈 limit
-                    # stop_loss 和 profit target 的处理
-                    # 这里有一个问题是，止损和止盈如果同时出现在一个波动很大的 k 线内，怎么处理？
-                    # 用小的时间周期应该可以避免。这里的逻辑是按亏损处理。
-                    if order.stop_loss is not None:
-                        if order.direction == 'BUY' and latest_bar['low'] <= order.stop_loss:
-                            # 触发止损
-                            # 更新它的出场信息（价格，时间，盈亏）
-                            order.exit_time = timeindex
-                            order.exit_price = order.stop_loss
-                            order.profit = (order.exit_price - order.entry_price) * order.quantity
-                            # TODO: 这里的方向是 hardcoded，因为和order是反着的
-                            print("Sell {} size of {} @ {}, at {}".format(order.quantity, order.symbol, order.exit_price,timeindex))
-                            fill_event = FillEvent(order, timeindex, order.exit_price,order.symbol,'LOCAL', order.quantity,'SELL', 0.01)
-                            fill_events.append(fill_event)
-
-                        if order.direction == 'SELL' and latest_bar['high'] >= order.stop_loss:
-                           # 触发止损
-                           # 更新它的出场信息（价格，时间，盈亏）
-                           order.exit_time = timeindex
-                           order.exit_price = order.stop_loss
-                           order.profit = (order.exit_price - order.entry_price) * order.quantity
-                           # TODO: 这里的方向是 hardcoded，因为和order是反着的
-                           fill_event = FillEvent(order, timeindex, order.exit_price, order.symbol,'LOCAL', order.quantity,'BUY', 0.01)
-                           fill_events.append(fill_event)
-
-                    # 这里增加了一个额外的检查，来防止同时触发止损和止盈的情况
-                    if order.profit_target is not None and order.exit_price is None:
-                        if order.direction == 'BUY' and latest_bar['high'] >= order.profit_target:
-                            # 触发止盈
-                            # 更新它的出场信息（价格，时间，盈亏）
-                            order.exit_time = timeindex
-                            order.exit_price = order.profit_target
-                            order.profit = (order.profit_target - order.entry_price) * order.quantity
-                            # TODO: 这里的方向是 hardcoded，因为和order是反着的
-                            fill_event = FillEvent(order, timeindex, order.exit_price, order.symbol,'LOCAL', order.quantity,'SELL', 0.01)
-                            fill_events.append(fill_event)
-
-                        if order.direction == 'SELL' and latest_bar['low'] <= order.profit_target:
-                            # 触发止盈
-                            # 更新它的出场信息（价格，时间，盈亏）
-                            order.exit_time = timeindex
-                            order.exit_price = order.profit_target
-                            order.profit = (order.profit_target - order.entry_price) * order.quantity
-                            # TODO: 这里的方向是 hardcoded，因为和 order 是反着的
-                            fill_event = FillEvent(order, timeindex, order.exit_price, order.symbol,'LOCAL', order.quantity,'BUY', 0.01)
-                            fill_events.append(fill_event)
+    def _scan_entries(self, symbol, books, timeindex, low, high):
+        """
+        Enters the pending orders of a symbol whose limit or stop
+        price the bar traded through. Returns their fills.
+        """
+        # 限价单 LMT 和 stop order STP 进场。Stop order 不是 Stop loss!!!
+        # 具体区别查看 https://www.babypips.com/learn/forex/types-of-orders
+        # TODO: 时间应该是当前bar和之前一个bar之间的某一个时间。
+        # 简单的使用了 limit/stop price，实际情况可能会更好的价格
+        fill_events = []
+        for key, (name, on_high, inclusive) in ENTRY_BOOKS.items():
+            book = books.get(key)
+            if not book:
+                continue
+            for order in book.pop_triggered(low, high):
+                price = getattr(order, name)
+                fill_time = timeindex
+                if self.intrabar is not None and self.intrabar.fill_times:
+                    fill_time = self._touch_time(order, price, on_high,
+                                                 inclusive, timeindex)
+                fill_time, price, commission = self._fill_cost(
+                    order, fill_time, price, order.direction, order.order_type
+                )
+                order.entry_time = fill_time
+                order.entry_price = price
+                del self.pending_orders[symbol][order.order_id]
+                self._add_open(order)
+                logger.info("%s %s size of %s @ %s, at %s", order.direction,
+                            order.quantity, order.symbol, price, fill_time)
+                fill_event = FillEvent(order, fill_time, price, order.symbol, 'LOCAL', order.quantity, order.direction, commission)
+                fill_events.append(fill_event)
+        return fill_events
 
+    def _scan_exits(self, books, timeindex, low, high):
+        """
+        Exits the open orders of a symbol whose stop loss or profit
+        target the bar touched. Returns their fills.
+        """
+        # 处理已经进场的单子，触发止损 stop 或者止盈 limit
+        # 这里有一个问题是，止损和止盈如果同时出现在一个波动很大的 k 线内，怎么处理？
+        # 用小的时间周期可以避免：有 intrabar 时按先触发的出场，否则按亏损处理。
+        touched = {}
+        for name in EXITS:
+            for direction in ('BUY', 'SELL'):
+                book = books.get((name, direction))
+                if not book:
+                    continue
+                for order in book.pop_triggered(low, high):
+                    touched.setdefault(order.order_id, (order, []))[1].append(name)
+
+        fill_events = []
+        for order, names in touched.values():
+            name, fill_time = self._first_exit(order, names, timeindex)
+            # 出场的方向和 order 是反着的
+            close_direction = 'SELL' if order.direction == 'BUY' else 'BUY'
+            fill_time, price, commission = self._fill_cost(
+                order, fill_time, getattr(order, name), close_direction,
+                EXIT_KINDS[name]
+            )
+            order.exit_time = fill_time
+            order.exit_price = price
+            order.profit = (price - order.entry_price) * order.quantity
+            self._archive(order)
+            logger.info("%s %s size of %s @ %s, at %s", close_direction,
+                        order.quantity, order.symbol, price, fill_time)
+            fill_event = FillEvent(order, fill_time, price, order.symbol, 'LOCAL', order.quantity, close_direction, commission)
+            fill_events.append(fill_event)
         return fill_events
 
+    def _first_exit(self, order, names, timeindex):
+        """
+        Returns the exit price name, 'stop_loss' or 'profit_target',
+        an order left the bar by and the time of the fill. With an
+        IntrabarIndex the exit touched first wins, otherwise, or if
+        the lower timeframe bars cannot tell, the stop loss does.
+        """
+        intrabar = self.intrabar
+        if intrabar is None or (len(names) == 1 and not intrabar.fill_times):
+            return names[0], timeindex
+        epoch = self.bars.get_latest_bar_epoch(order.symbol)
+        first = None
+        for name in names:
+            on_high, inclusive = EXIT_BOOKS[(name, order.direction)]
+            touch = intrabar.first_touch(order.symbol, epoch,
+                                         getattr(order, name), on_high,
+                                         inclusive)
+            if touch is not None and (first is None or touch < first[1]):
+                first = (name, touch)
+        if first is None:
+            return names[0], timeindex
+        return first[0], epoch_to_datetime(first[1])
+
+    def _touch_time(self, order, price, on_high, inclusive, timeindex):
+        """
+        Returns the time the lower timeframe bars of the IntrabarIndex
+        reached the entry price of an order, or timeindex if they
+        did not.
+        """
+        touch = self.intrabar.first_touch(
+            order.symbol, self.bars.get_latest_bar_epoch(order.symbol),
+            price, on_high, inclusive
+        )
+        return timeindex if touch is None else epoch_to_datetime(touch)
+
+    def _fill_cost(self, order, fill_time, price, direction, kind):
+        """
+        Returns the time, price and commission of a fill of an order
+        at price, as the cost model makes them.
+
+        Parameters:
+        order - The order filled.
+        fill_time - The time of the fill before the latency.
+        price - The close or trigger price.
+        direction - The direction of the fill, 'BUY' or 'SELL'.
+        kind - The kind of fill, MARKET, LIMIT or STOP.
+        """
+        model = self.cost_model
+        epoch = self.bars.get_latest_bar_epoch(order.symbol) + model.latency
+        if model.latency:
+            fill_time = fill_time + datetime.timedelta(microseconds=model.latency // 1000)
+        price = model.fill_price(order.symbol, epoch, price, direction, kind)
+        return fill_time, price, model.commission(order.symbol, epoch, price,
+                                                  order.quantity, kind)
+
     def execute_order(self, event):
         """
         Simply converts Order objects into Fill objects naively,
@@ -196,55 +374,62 @@ class SimulatedExecutionHandler(ExecutionHandler):
         """
         if event.type == 'ORDER' and event.order_type == 'MKT':
             # Now we are opening a new order 按照市场价开新单
-            timeindex = self.bars.get_latest_bar_datetime(event.symbol)
-            price = self.bars.get_latest_bar_value(event.symbol, "close")
+            timeindex, price, commission = self._fill_cost(
+                event, self.bars.get_latest_bar_datetime(event.symbol),
+                self.bars.get_latest_bar_value(event.symbol, "close"),
+                event.direction, MARKET
+            )
             order = self._find_open_order(event.symbol)
             if order is None:
                 # 找不到，新建一个 order，更新它的进场时间和价格
                 order = event
                 order.entry_time = timeindex
                 order.entry_price = price
-                self.all_orders.append(event)
+                self._add_open(event)
             else:
                 # 找到了现有 order，更新它的信息
                 order.exit_time = timeindex
                 order.exit_price = price
                 order.profit = (price - order.entry_price) * order.quantity
+                self._archive(order)
             # 无论如何，这个订单要按照市场价执行。
             fill_event = FillEvent(order, timeindex, price,
                                    event.symbol, 'LOCAL', event.quantity,
-                                   event.direction)
+                                   event.direction, commission)
             self.events.put(fill_event)
 
         elif event.type == 'ORDER' and \
                 (event.order_type == 'LMT' or event.order_type == 'STP'):
-            # 如果是限价单 limit/stop order，直接把订单放入订单池 self.all_orders
+            # 如果是限价单 limit/stop order，直接把订单放入订单池 self.pending_orders
             # TODO: 理论上这个订单不会立即成交的吧？
             # self._close_sametype_pending_orders_for(event)
-            self.all_orders.append(event)
+            self._add_pending(event)
 
     def execute_action(self, event):
         if event.type == 'ACTION' and event.action_type == 'CLOSE_ALL':
             self._close_all_orders_for(event.symbol)
 
     def _close_all_orders_for(self, symbol):
-        # 遍历所有同类型的订单
-        for order in self.all_orders[:]:
-            if order.symbol != symbol:
-                continue
-            if order.entry_price is None:
-                # 没进场的取消
-                self.all_orders.remove(order)
-            elif order.exit_price is None:
-                # 进场的开市价单离场，立即执行
-                timeindex = self.bars.get_latest_bar_datetime(symbol)
-                price = self.bars.get_latest_bar_value(symbol, "close")
-                order.exit_time = timeindex
-                order.exit_price = price
-                order.profit = (price - order.entry_price) * order.quantity
-                close_direction = 'BUY' if order.direction == 'SELL' else 'SELL'
-                fill_event = FillEvent(order, timeindex, price,
-                                       symbol, 'LOCAL', order.quantity,
-                                       close_direction)
-                self.events.put(fill_event)
-
+        # 没进场的取消
+        self.pending_orders.pop(symbol, None)
+        self.books.pop(symbol, None)
+        opened = self.open_orders.pop(symbol, None)
+        if not opened:
+            return
+        # 进场的开市价单离场，立即执行
+        bar_time = self.bars.get_latest_bar_datetime(symbol)
+        close = self.bars.get_latest_bar_value(symbol, "close")
+        closed = sorted(opened.values(), key=attrgetter('order_id'))
+        for order in closed:
+            close_direction = 'BUY' if order.direction == 'SELL' else 'SELL'
+            timeindex, price, commission = self._fill_cost(
+                order, bar_time, close, close_direction, MARKET
+            )
+            order.exit_time = timeindex
+            order.exit_price = price
+            order.profit = (price - order.entry_price) * order.quantity
+            fill_event = FillEvent(order, timeindex, price,
+                                   symbol, 'LOCAL', order.quantity,
+                                   close_direction, commission)
+            self.events.put(fill_event)
+        self.closed_orders.extend(closed)
@@ -1,4 +1,5 @@
 import datetime
+import logging
 import numpy as np
 import pandas as pd
 import queue
@@ -10,6 +11,8 @@ from .event import FillEvent, OrderEvent
 from .performance import create_sharpe_ratio, create_drawdowns
 from .portfolio import Portfolio
 
+logger = logging.getLogger(__name__)
+
 
 class PortfolioHFT(Portfolio):
     """
@@ -39,13 +42,11 @@ class PortfolioHFT(Portfolio):
 
         self.all_positions = self.construct_all_positions()
         self.current_positions = dict( (k,v) for k, v in [(s, 0) for s in self.symbol_list] )
-        print(self.current_positions)
-        print(self.all_positions)
+        logger.debug("Positions: %s %s", self.current_positions, self.all_positions)
 
         self.all_holdings = self.construct_all_holdings()
         self.current_holdings = self.construct_current_holdings()
-        print(self.current_holdings)
-        print(self.all_holdings)
+        logger.debug("Holdings: %s %s", self.current_holdings, self.all_holdings)
 
     def construct_all_positions(self):
         """
@@ -90,9 +91,11 @@ class PortfolioHFT(Portfolio):
         Makes use of a MarketEvent from the events queue.
         """
 
-        latest_datetime = self.bars.get_latest_bar_datetime(
-            self.symbol_list[0]
-        )
+        latest_datetime = event.datetime
+        if latest_datetime is None:
+            latest_datetime = self.bars.get_latest_bar_datetime(
+                self.symbol_list[0]
+            )
 
         # Update positions
         # ===============
@@ -117,8 +120,11 @@ class PortfolioHFT(Portfolio):
             # Approximation to the real value, [5] = close price
             # print(s)
             # print(bars[s][0][1].values[4])
-            market_value = self.current_positions[s] * \
-                self.bars.get_latest_bar_value(s, "close")
+            # Symbols without a position may not have a bar yet
+            market_value = 0.0
+            if self.current_positions[s] != 0:
+                market_value = self.current_positions[s] * \
+                    self.bars.get_latest_bar_value(s, "close")
             dh[s] = market_value
             dh['total'] += market_value
 
@@ -254,10 +260,8 @@ class PortfolioHFT(Portfolio):
                  ("Sharpe Ratio", "%0.2f" % sharpe_ratio),
                  ("Max Drawdown", "%0.2f%%" % (max_dd * 100.0)),
                  ("Drawdown Duration", "%d" % dd_duration)]
-        print('======')
-        print(self.current_holdings)
-        print(self.current_positions)
-        print('======')
+        logger.info("Final holdings: %s", self.current_holdings)
+        logger.info("Final positions: %s", self.current_positions)
         self.equity_curve.to_csv('equity.csv')
         self.trade_history.to_csv('all_positions.csv')
         return stats
@@ -0,0 +1,83 @@
+import numpy as np
+
+from .data import HistoricCSVDataHandler
+from .event_bus import DequeEventBus
+from .resample import timeframe_to_ns
+
+
+class IntrabarIndex(object):
+    """
+    IntrabarIndex looks up the lower timeframe bars inside a bar of
+    the backtest, e.g. the M1 bars of an H4 bar, to tell when the
+    prices of that bar were traded.
+
+    SimulatedExecutionHandler uses it to resolve bars that touch
+    both the stop loss and the profit target of an order, and to
+    stamp fills with the time of the lower timeframe bar that
+    triggered them. The lower timeframe bars of a symbol are loaded
+    into a BarStore on first use and a bar is found with a binary
+    search on its timestamps, so bars without fills cost nothing.
+
+    Bars are taken to be labelled with their start time, as the CSV
+    files and the ResampledDataHandler label them.
+    """
+
+    def __init__(self, csv_dir, timeframe, symbols=None,
+                 data_handler=HistoricCSVDataHandler, fill_times=True):
+        """
+        Initialises the index.
+
+        Parameters:
+        csv_dir - Directory of the lower timeframe CSV files.
+        timeframe - The timeframe of the backtest bars, e.g. 'H4'.
+        symbols - Optional dict of backtest symbol -> lower timeframe
+                  symbol, e.g. {'AUD_USD_H4': 'AUD_USD_M1'}. Other
+                  symbols are looked up under their own name.
+        data_handler - (Class) Loads the lower timeframe bars.
+        fill_times - Look up the time of every triggered fill, not
+                     only of the bars touching two exits.
+        """
+        self.csv_dir = csv_dir
+        self.period = timeframe_to_ns(timeframe)
+        self.symbols = symbols if symbols is not None else {}
+        self.data_handler_cls = data_handler
+        self.fill_times = fill_times
+        self.stores = {}
+
+    def _store(self, symbol):
+        store = self.stores.get(symbol)
+        if store is None:
+            lower = self.symbols.get(symbol, symbol)
+            handler = self.data_handler_cls(DequeEventBus(), self.csv_dir,
+                                            [lower])
+            store = self.stores[symbol] = handler.symbol_data[lower]
+        return store
+
+    def first_touch(self, symbol, epoch, price, on_high, inclusive):
+        """
+        Returns the timestamp, as epoch nanoseconds, of the first
+        lower timeframe bar inside the bar starting at epoch that
+        reaches price, or None if none does.
+
+        Parameters:
+        symbol - The symbol of the backtest.
+        epoch - The start of the bar as epoch nanoseconds.
+        price - The price to reach.
+        on_high - True to find the high rising to price, False to
+                  find the low falling to it.
+        inclusive - True if touching price is enough, False if the
+                    bar has to trade through it.
+        """
+        store = self._store(symbol)
+        lo = np.searchsorted(store.epochs, epoch, side='left')
+        hi = np.searchsorted(store.epochs, epoch + self.period, side='left')
+        if on_high:
+            values = store.columns['high'][lo:hi]
+            hits = values >= price if inclusive else values > price
+        else:
+            values = store.columns['low'][lo:hi]
+            hits = values <= price if inclusive else values < price
+        i = int(np.argmax(hits)) if len(hits) else 0
+        if len(hits) == 0 or not hits[i]:
+            return None
+        return int(store.epochs[lo + i])
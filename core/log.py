@@ -0,0 +1,106 @@
+import json
+import logging
+
+
+def configure_logging(level=logging.INFO, filename=None):
+    """
+    Sends the log messages of the core modules to stderr, or to a
+    file, from the given level on. The modules log through
+    logging.getLogger(__name__), so nothing is formatted or written
+    below the configured level.
+
+    Parameters:
+    level - The lowest level written, e.g. logging.DEBUG to see
+            every event of the backtest loop.
+    filename - Optional log file, stderr if None.
+    """
+    logger = logging.getLogger(__package__)
+    if filename is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)s %(levelname)s %(message)s'
+    ))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
+
+
+def _json_default(value):
+    """
+    Converts the values json cannot write, orders by their id.
+    """
+    order_id = getattr(value, 'order_id', None)
+    if order_id is not None:
+        return order_id
+    return str(value)
+
+
+class EventLog(object):
+    """
+    EventLog records the events handled by a backtest as JSON lines
+    in a file. Records are kept in memory and written in a single
+    call once buffer_size of them have been collected, rather than
+    one write per event.
+
+    Each line holds the event type and its attributes. Orders are
+    written as their order_id and other values that are not JSON
+    types, such as datetimes, as strings.
+    """
+
+    def __init__(self, filename, buffer_size=10000, types=None):
+        """
+        Initialises the event log.
+
+        Parameters:
+        filename - The file the events are appended to.
+        buffer_size - Number of events buffered before a write.
+        types - Optional collection of the event types to record,
+                e.g. ('SIGNAL', 'ORDER', 'FILL'), all if None.
+        """
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.types = None if types is None else frozenset(types)
+        self.buffer = []
+
+    def record(self, event):
+        """
+        Adds an event to the buffer. The attributes are copied, as
+        data handlers reuse their MarketEvent instance.
+        """
+        if self.types is not None and event.type not in self.types:
+            return
+        record = event.to_dict()
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def wrap(self, handler):
+        """
+        Returns an event handler that records the event and then
+        passes it on to handler.
+        """
+        record = self.record
+
+        def logged(event):
+            record(event)
+            handler(event)
+        return logged
+
+    def flush(self):
+        """
+        Writes the buffered events to the file.
+        """
+        if not self.buffer:
+            return
+        lines = [json.dumps(r, default=_json_default) for r in self.buffer]
+        with open(self.filename, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.buffer = []
+
+    def close(self):
+        """
+        Writes the remaining events.
+        """
+        self.flush()
@@ -0,0 +1,226 @@
+import numpy as np
+
+from .bar_store import epoch_to_datetime
+from .data import HistoricCSVDataHandler
+from .data_cache import DEFAULT_CACHE_DIR
+from .resample import timeframe_to_ns
+
+
+class TimeframeIndex(object):
+    """
+    TimeframeIndex describes how the bars of a BarStore group into
+    the buckets of a higher timeframe, as the first and last bar
+    position of every bucket. No bar values are copied, they are
+    aggregated from the BarStore columns when queried.
+    """
+
+    def __init__(self, store, period, offset=0):
+        """
+        Initialises the index of one store on one timeframe.
+
+        Parameters:
+        store - The BarStore of the lower timeframe.
+        period - The length of the higher timeframe in nanoseconds.
+        offset - Shift of the bucket boundaries in nanoseconds.
+        """
+        self.store = store
+        self.period = period
+        self.offset = offset
+        buckets = (store.epochs - offset) // period
+        if len(buckets) > 0:
+            self.starts = np.flatnonzero(
+                np.concatenate(([True], buckets[1:] != buckets[:-1]))
+            )
+        else:
+            self.starts = np.zeros(0, dtype=np.int64)
+        self.ends = np.append(self.starts[1:] - 1, len(buckets) - 1)
+
+    def window(self, N):
+        """
+        Returns the (first, last) bucket numbers of the last N
+        buckets completed by the store cursor. A bucket is complete
+        once its last lower timeframe bar has been released.
+        """
+        store = self.store
+        last = int(np.searchsorted(self.ends, store.cursor - 1, side='right'))
+        first = int(np.searchsorted(self.starts, store.floor, side='left'))
+        return max(last - N, first), last
+
+    def closed(self):
+        """
+        Returns True if the last released bar completed a bucket.
+        """
+        last = int(np.searchsorted(self.ends, self.store.cursor - 1,
+                                   side='right'))
+        return last > 0 and self.ends[last - 1] == self.store.cursor - 1
+
+    def values(self, field, N=1):
+        """
+        Returns the values of a field for the last N completed
+        buckets, aggregated from the lower timeframe bars.
+        """
+        first, last = self.window(N)
+        if first >= last:
+            return np.zeros(0)
+        column = self.store.columns[field]
+        starts = self.starts[first:last]
+        ends = self.ends[first:last]
+        if field == 'open':
+            return column[starts]
+        if field not in ('high', 'low', 'volume'):
+            return column[ends]
+        segment = column[starts[0]:ends[-1] + 1]
+        offsets = starts - starts[0]
+        if field == 'high':
+            return np.maximum.reduceat(segment, offsets)
+        if field == 'low':
+            return np.minimum.reduceat(segment, offsets)
+        return np.add.reduceat(segment, offsets)
+
+    def epochs(self, N=1):
+        """
+        Returns the start timestamps of the last N completed buckets.
+        """
+        first, last = self.window(N)
+        epochs = self.store.epochs[self.starts[first:last]]
+        return (epochs - self.offset) // self.period * self.period + self.offset
+
+
+class MultiTimeframeDataHandler(HistoricCSVDataHandler):
+    """
+    MultiTimeframeDataHandler replays the CSV bars of a base
+    timeframe like HistoricCSVDataHandler and additionally serves
+    completed bars of higher timeframes, e.g. daily bars next to
+    H4 bars, through the optional timeframe argument of the
+    get_latest_* methods.
+
+    All timeframes read the same BarStore and follow its cursor, so
+    a higher timeframe bar only becomes visible once its last base
+    bar has been emitted (no look-ahead) and only the bucket
+    boundaries are stored per timeframe.
+
+    MarketEvents list the higher timeframes that closed a bar in
+    their timeframes attribute.
+    """
+
+    def __init__(self, events, csv_dir, symbol_list, timeframes=('D',),
+                 offset=None, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Initialises the multi-timeframe data handler.
+
+        Parameters:
+        events - The Event Queue.
+        csv_dir - Absolute directory path to the CSV files.
+        symbol_list - A list of symbol strings.
+        timeframes - The higher timeframes to serve, e.g. ('D', 'W').
+        offset - Optional timedelta shifting the bucket boundaries,
+                 e.g. 22 hours for a forex trading day.
+        cache_dir - Directory of the binary data cache, None disables it.
+        """
+        self.timeframes = list(timeframes)
+        self.offset = 0 if offset is None else int(offset.total_seconds() * 1e9)
+        super(MultiTimeframeDataHandler, self).__init__(
+            events, csv_dir, symbol_list, cache_dir
+        )
+        self.timeframe_data = {}
+        for s in self.symbol_list:
+            self.timeframe_data[s] = dict(
+                (tf, TimeframeIndex(self.symbol_data[s],
+                                    timeframe_to_ns(tf), self.offset))
+                for tf in self.timeframes
+            )
+
+    def _get_timeframe(self, symbol, timeframe):
+        """
+        Returns the TimeframeIndex of a symbol on a timeframe.
+        """
+        try:
+            return self.timeframe_data[symbol][timeframe]
+        except KeyError:
+            print("Timeframe %s of %s is not available." % (timeframe, symbol))
+            raise
+
+    def get_latest_bar(self, symbol, timeframe=None):
+        """
+        Returns the last bar as a (datetime, {field: value}) tuple.
+        """
+        if timeframe is None:
+            return super(MultiTimeframeDataHandler, self).get_latest_bar(symbol)
+        return self.get_latest_bars(symbol, 1, timeframe)[-1]
+
+    def get_latest_bars(self, symbol, N=1, timeframe=None):
+        """
+        Returns the last N bars as (datetime, {field: value})
+        tuples, or N-k if less available.
+        """
+        if timeframe is None:
+            return super(MultiTimeframeDataHandler, self).get_latest_bars(symbol, N)
+        index = self._get_timeframe(symbol, timeframe)
+        values = dict((f, index.values(f, N)) for f in self.symbol_data[symbol].fields)
+        return [
+            (epoch_to_datetime(epoch),
+             dict((f, values[f][i]) for f in values))
+            for i, epoch in enumerate(index.epochs(N))
+        ]
+
+    def get_latest_bar_datetime(self, symbol, timeframe=None):
+        """
+        Returns a Python datetime object for the last bar.
+        """
+        if timeframe is None:
+            return super(MultiTimeframeDataHandler, self).get_latest_bar_datetime(symbol)
+        return epoch_to_datetime(self.get_latest_bar_epoch(symbol, timeframe))
+
+    def get_latest_bar_epoch(self, symbol, timeframe=None):
+        """
+        Returns the timestamp of the last bar as int64 UTC epoch
+        nanoseconds.
+        """
+        if timeframe is None:
+            return super(MultiTimeframeDataHandler, self).get_latest_bar_epoch(symbol)
+        epochs = self._get_timeframe(symbol, timeframe).epochs(1)
+        if len(epochs) == 0:
+            raise IndexError("No %s bar has been completed yet." % timeframe)
+        return int(epochs[-1])
+
+    def get_latest_bar_value(self, symbol, val_type, timeframe=None):
+        """
+        Returns one of the Open, High, Low, Close, Volume or OpenInterest
+        for the last bar.
+        """
+        if timeframe is None:
+            return super(MultiTimeframeDataHandler, self).get_latest_bar_value(symbol, val_type)
+        values = self._get_timeframe(symbol, timeframe).values(val_type, 1)
+        if len(values) == 0:
+            raise IndexError("No %s bar has been completed yet." % timeframe)
+        return values[-1]
+
+    def get_latest_bars_values(self, symbol, val_type, N=1, timeframe=None):
+        """
+        Returns one of the Open, High, Low, Close, Volume or OpenInterest
+        for the last N bars, N-k if less available.
+
+        Base timeframe results are read-only views, higher timeframe
+        results are aggregated into a new array.
+        """
+        if timeframe is None:
+            return super(MultiTimeframeDataHandler, self).get_latest_bars_values(symbol, val_type, N)
+        return self._get_timeframe(symbol, timeframe).values(val_type, N)
+
+    def update_bars(self):
+        """
+        Pushes the bars of the next distinct timestamp and records
+        which higher timeframes closed a bar on the MarketEvent.
+        """
+        if not self._has_next():
+            self.continue_backtest = False
+            return
+        symbols = self.merge.advance()
+        if not self._has_next():
+            self.continue_backtest = False
+        timeframes = [
+            tf for tf in self.timeframes
+            if any(self.timeframe_data[s][tf].closed() for s in symbols)
+        ]
+        timeindex = self.symbol_data[symbols[0]].latest_datetime()
+        self._put_market_event(timeindex, symbols, timeframes)
@@ -28,15 +28,20 @@ def create_drawdowns(equity_curve):
     # Calculate the cumulative returns curve
     # and set up the High Water Mark
     # Then create the drawdown and duration series
-    hwm = [0]
     eq_idx = equity_curve.index
-    drawdown = pd.Series(index = eq_idx)
-    duration = pd.Series(index = eq_idx)
+    values = np.asarray(equity_curve, dtype=np.float64)
+    drawdown = pd.Series(np.nan, index=eq_idx)
+    duration = pd.Series(np.nan, index=eq_idx)
+    if len(values) < 2:
+        return drawdown, drawdown.max(), duration.max()
 
-    # Loop over the index range
-    for t in range(1, len(eq_idx)):
-        cur_hwm = max(hwm[t-1], equity_curve[t])
-        hwm.append(cur_hwm)
-        drawdown[t]= hwm[t] - equity_curve[t]
-        duration[t]= 0 if drawdown[t] == 0 else duration[t-1] + 1
+    # The water mark starts at zero and skips missing values
+    hwm = np.fmax.accumulate(np.concatenate(([0.0], values[1:])))[1:]
+    dd = hwm - values[1:]
+    # The duration counts the bars since the last bar at the water
+    # mark, it is undefined until the curve first reaches it
+    steps = np.arange(1, len(values))
+    last_high = np.maximum.accumulate(np.where(dd == 0, steps, 0))
+    drawdown.iloc[1:] = dd
+    duration.iloc[1:] = np.where(last_high > 0, steps - last_high, np.nan)
     return drawdown, drawdown.max(), duration.max()
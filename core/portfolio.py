@@ -117,9 +117,11 @@ class NaivePortfolio(Portfolio):
         Makes use of a MarketEvent from the events queue.
         """
 
-        latest_datetime = self.bars.get_latest_bar_datetime(
-            self.symbol_list[0]
-        )
+        latest_datetime = event.datetime
+        if latest_datetime is None:
+            latest_datetime = self.bars.get_latest_bar_datetime(
+                self.symbol_list[0]
+            )
 
         # Update positions
         # ===============
@@ -144,8 +146,11 @@ class NaivePortfolio(Portfolio):
             # Approximation to the real value, [5] = close price
             # print(s)
             # print(bars[s][0][1].values[4])
-            market_value = self.current_positions[s] * \
-                self.bars.get_latest_bar_value(s, "close")
+            # Symbols without a position may not have a bar yet
+            market_value = 0.0
+            if self.current_positions[s] != 0:
+                market_value = self.current_positions[s] * \
+                    self.bars.get_latest_bar_value(s, "close")
             dh[s] = market_value
             dh['total'] += market_value
 
@@ -208,7 +213,7 @@ class NaivePortfolio(Portfolio):
             self.update_positions_from_fill(event)
             self.update_holdings_from_fill(event)
             self.update_orders_from_fill(event)
-            fill = vars(event)
+            fill = event.to_dict()
             fill['order'] = event.order.order_id
             self.all_fills.append(fill)
 
@@ -283,7 +288,7 @@ class NaivePortfolio(Portfolio):
         Creates a pandas DataFrame from the all_positions
         list of dictionaries.
         """
-        orders = pd.DataFrame([vars(c) for c in self.all_orders.values()])
+        orders = pd.DataFrame([c.to_dict() for c in self.all_orders.values()])
         self.order_history = orders
 
     def output_summary_stats(self):
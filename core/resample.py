@@ -0,0 +1,289 @@
+import re
+
+import numpy as np
+
+from .bar_store import RingBarStore, epoch_to_datetime, to_epoch
+from .data import BarStoreDataHandler
+from .hft_data import HistoricCSVDataHandlerHFT
+
+
+# Nanoseconds per unit of a timeframe string such as 'M5' or 'H4'.
+TIMEFRAME_UNITS = {
+    'S': 1000000000,
+    'M': 60 * 1000000000,
+    'H': 3600 * 1000000000,
+    'D': 86400 * 1000000000,
+    'W': 7 * 86400 * 1000000000,
+}
+
+
+def timeframe_to_ns(timeframe):
+    """
+    Converts a timeframe string into its length in nanoseconds,
+    e.g. 'M1', 'M5', 'H1', 'H4', 'D' or 'D1'.
+    """
+    match = re.match(r'^([SMHDW])(\d*)$', timeframe)
+    if match is None:
+        raise ValueError("Unknown timeframe %s" % timeframe)
+    unit, count = match.groups()
+    return TIMEFRAME_UNITS[unit] * int(count or 1)
+
+
+class EventSink(object):
+    """
+    Stands in for the event queue of a wrapped data handler and
+    only keeps the last event it was given.
+    """
+
+    def __init__(self):
+        self.event = None
+
+    def put(self, event):
+        self.event = event
+
+
+class BarAggregator(object):
+    """
+    BarAggregator incrementally builds the bar of one symbol on a
+    higher timeframe from the bars of a lower one, with O(1) work
+    per incoming bar.
+
+    Buckets are aligned to multiples of the period since the epoch,
+    shifted by offset, and labelled with their start time.
+    """
+
+    def __init__(self, fields, period, offset=0):
+        """
+        Initialises the aggregator.
+
+        Parameters:
+        fields - The field names of the incoming bars.
+        period - The length of the higher timeframe in nanoseconds.
+        offset - Shift of the bucket boundaries in nanoseconds.
+        """
+        self.fields = fields
+        self.period = period
+        self.offset = offset
+        self.rows = dict((f, i) for i, f in enumerate(fields))
+        self.bucket = None
+        self.values = np.zeros(len(fields))
+
+    def bucket_of(self, epoch):
+        """
+        Returns the start of the bucket an epoch falls into.
+        """
+        return (epoch - self.offset) // self.period * self.period + self.offset
+
+    def update(self, epoch, bar):
+        """
+        Folds an incoming bar into the current bucket. If the bar
+        starts a new bucket, the previous one is returned as a
+        completed (epoch, values) pair, otherwise None.
+
+        Parameters:
+        epoch - The timestamp of the incoming bar.
+        bar - Dict of field -> value of the incoming bar.
+        """
+        bucket = self.bucket_of(epoch)
+        closed = None
+        if bucket != self.bucket:
+            closed = self.flush()
+            self.bucket = bucket
+            for f, i in self.rows.items():
+                self.values[i] = bar[f]
+            return closed
+        values = self.values
+        for f, i in self.rows.items():
+            if f == 'high':
+                if bar[f] > values[i]:
+                    values[i] = bar[f]
+            elif f == 'low':
+                if bar[f] < values[i]:
+                    values[i] = bar[f]
+            elif f == 'volume':
+                values[i] += bar[f]
+            elif f != 'open':
+                values[i] = bar[f]
+        return closed
+
+    def flush(self):
+        """
+        Closes the current bucket and returns it as an
+        (epoch, values) pair, or None if it is empty.
+        """
+        if self.bucket is None:
+            return None
+        closed = (self.bucket, self.values.copy())
+        self.bucket = None
+        return closed
+
+
+class ResampledDataHandler(BarStoreDataHandler):
+    """
+    ResampledDataHandler wraps any bar based DataHandler and
+    aggregates its bars on the fly into a higher timeframe, so a
+    single one-minute data set can drive H1, H4 or daily strategies
+    without pre-aggregated files.
+
+    A MarketEvent is emitted whenever a higher timeframe bar of at
+    least one symbol is complete. Only the lookback window of the
+    resampled bars is kept in memory.
+
+    As Backtest builds the data handler from (events, csv_dir,
+    symbol_list), bind the other arguments with functools.partial,
+    e.g. partial(ResampledDataHandler, timeframe='H4').
+    """
+
+    def __init__(self, events, csv_dir, symbol_list, timeframe='H1',
+                 source=HistoricCSVDataHandlerHFT, base_timeframe=None,
+                 offset=None, lookback=100, **source_kwargs):
+        """
+        Initialises the resampling data handler.
+
+        Parameters:
+        events - The Event Queue.
+        csv_dir - Absolute directory path to the CSV files.
+        symbol_list - A list of symbol strings.
+        timeframe - The target timeframe, e.g. 'M5', 'H1', 'H4' or 'D'.
+        source - (Class) The data handler providing the lower timeframe.
+        base_timeframe - The timeframe of the source bars. When given,
+                         a bar closes as soon as its last source bar
+                         arrives, otherwise when the next bar starts.
+        offset - Optional timedelta shifting the bucket boundaries,
+                 e.g. 22 hours for a forex trading day.
+        lookback - Initial number of resampled bars kept per symbol.
+        source_kwargs - Passed on to the source data handler.
+        """
+        self.events = events
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+        self.timeframe = timeframe
+        self.period = timeframe_to_ns(timeframe)
+        self.base_period = None
+        if base_timeframe is not None:
+            self.base_period = timeframe_to_ns(base_timeframe)
+        offset = 0 if offset is None else int(offset.total_seconds() * 1e9)
+
+        self.sink = EventSink()
+        self.source = source(self.sink, csv_dir, symbol_list, **source_kwargs)
+        self.fields = list(self.source.csv_columns[1:])
+
+        self.symbol_data = {}
+        self.aggregators = {}
+        for s in self.symbol_list:
+            self.symbol_data[s] = RingBarStore(self.fields, lookback)
+            self.aggregators[s] = BarAggregator(self.fields, self.period, offset)
+        self.start_epoch = None
+        self.ready = []
+        self.continue_backtest = True
+
+    def seek(self, start_date, warmup=0, end_date=None):
+        """
+        Seeks the source so that warmup resampled bars are built
+        before start_date, without emitting events for them.
+
+        Parameters:
+        start_date - The datetime of the first bar to release, None
+                     for the first bar of the data.
+        warmup - Number of resampled bars before start_date kept
+                 visible to lookback queries.
+        end_date - Optional datetime, source bars at or after it are
+                   not aggregated.
+        """
+        first = None
+        if start_date is not None:
+            self.start_epoch = to_epoch(start_date)
+            first = epoch_to_datetime(self.aggregators[self.symbol_list[0]].bucket_of(
+                self.start_epoch - warmup * self.period
+            ))
+        self.source.seek(first, end_date=end_date)
+        self.continue_backtest = self.source.continue_backtest
+
+    def get_state(self):
+        """
+        Returns the position of the source, the open buckets and the
+        resampled bars of every symbol, e.g. for a checkpoint. The
+        source has to provide get_state().
+        """
+        return {
+            'source': self.source.get_state(),
+            'buckets': dict((s, (agg.bucket, agg.values.copy()))
+                            for s, agg in self.aggregators.items()),
+            'stores': dict((s, store.get_state())
+                           for s, store in self.symbol_data.items()),
+            'ready': list(self.ready),
+            'start_epoch': self.start_epoch,
+            'continue_backtest': self.continue_backtest,
+        }
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state.
+        """
+        self.source.set_state(state['source'])
+        for s, (bucket, values) in state['buckets'].items():
+            self.aggregators[s].bucket = bucket
+            self.aggregators[s].values = values.copy()
+        for s, store_state in state['stores'].items():
+            self.symbol_data[s].set_state(store_state)
+        self.ready = list(state['ready'])
+        self.start_epoch = state['start_epoch']
+        self.continue_backtest = state['continue_backtest']
+
+    def _has_next(self):
+        """
+        Returns True while resampled bars are left, the source has no
+        feeds of its own here.
+        """
+        return self.continue_backtest
+
+    def _close(self, symbol, closed, updated):
+        """
+        Stores a completed bar and records the symbol as updated,
+        unless the bar is a warm-up bar before the start date.
+        """
+        if closed is None:
+            return
+        self.symbol_data[symbol].push(closed[0], closed[1])
+        if self.start_epoch is None or closed[0] >= self.start_epoch:
+            if symbol not in updated:
+                updated.append(symbol)
+
+    def update_bars(self):
+        """
+        Pulls bars from the source until at least one resampled bar
+        is complete and emits a MarketEvent for those symbols.
+        """
+        updated = []
+        # Buckets completed in the same step that closed the previous
+        # one are released on their own in the next call.
+        for s in self.ready:
+            self._close(s, self.aggregators[s].flush(), updated)
+        self.ready = []
+        while not updated:
+            if not self.source.continue_backtest:
+                # The last buckets are complete at the end of the data
+                for s in self.symbol_list:
+                    self._close(s, self.aggregators[s].flush(), updated)
+                self.continue_backtest = False
+                break
+            self.source.update_bars()
+            event = self.sink.event
+            self.sink.event = None
+            if event is None:
+                continue
+            for s in event.symbols or self.symbol_list:
+                agg = self.aggregators[s]
+                epoch = self.source.get_latest_bar_epoch(s)
+                bar = self.source.get_latest_bar(s)[1]
+                closed = agg.update(epoch, bar)
+                self._close(s, closed, updated)
+                if self.base_period is not None and \
+                        epoch + self.base_period >= agg.bucket + self.period:
+                    if closed is None:
+                        self._close(s, agg.flush(), updated)
+                    else:
+                        self.ready.append(s)
+        if updated:
+            timeindex = self.symbol_data[updated[0]].latest_datetime()
+            self._put_market_event(timeindex, updated)
@@ -0,0 +1,276 @@
+from functools import partial
+import logging
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from .bar_store import epoch_to_datetime, to_epoch
+from .shared_data import SharedBarData, SharedMemoryDataHandler
+from .sweep import (_run_params, bar_epochs, raise_if_all_failed,
+                    shares_bars, worker_pool)
+
+logger = logging.getLogger(__name__)
+
+
+def sample_params(space, n, rng):
+    """
+    Draws n random parameter sets from a search space.
+
+    Parameters:
+    space - Dict of parameter -> list of values to choose from, or
+            (low, high) tuple to draw uniformly from.
+    n - Number of parameter sets.
+    rng - A numpy.random.Generator.
+    """
+    samples = [{} for i in range(n)]
+    for name, values in space.items():
+        if isinstance(values, tuple):
+            drawn = rng.uniform(values[0], values[1], n).tolist()
+        else:
+            drawn = [values[i] for i in rng.integers(len(values), size=n)]
+        for params, value in zip(samples, drawn):
+            params[name] = value
+    return samples
+
+
+class EarlyStopping(object):
+    """
+    EarlyStopping is a Backtest progress callable that stops a run
+    once its running drawdown or Sharpe ratio is clearly worse than
+    a bound, so losing parameter sets do not use up a full backtest.
+
+    The statistics are updated incrementally from the holdings the
+    portfolio appended since the last call. An instance keeps the
+    state of one run, give every Backtest its own.
+    """
+
+    def __init__(self, max_drawdown=None, min_sharpe=None, min_bars=500,
+                 periods=252*6):
+        """
+        Parameters:
+        max_drawdown - Stop once the drawdown of the equity curve
+                       exceeds this, e.g. 0.3.
+        min_sharpe - Stop once the running Sharpe ratio is below this.
+        min_bars - Bars before the Sharpe ratio is checked.
+        periods - Bars per year used for the Sharpe ratio.
+        """
+        self.max_drawdown = max_drawdown
+        self.min_sharpe = min_sharpe
+        self.min_bars = min_bars
+        self.periods = periods
+
+        self.seen = 0
+        self.first = None
+        self.last = None
+        self.hwm = 0.0
+        self.drawdown = 0.0
+        # Welford's running mean and variance of the returns
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def sharpe(self):
+        """
+        Returns the running Sharpe ratio of the returns seen so far.
+        """
+        if self.count < 2 or self.m2 == 0:
+            return 0.0
+        std = math.sqrt(self.m2 / self.count)
+        return math.sqrt(self.periods) * self.mean / std
+
+    def __call__(self, backtest):
+        holdings = backtest.portfolio.all_holdings
+        for row in holdings[self.seen:]:
+            total = row['total']
+            if self.first is None:
+                self.first = total
+                self.hwm = 1.0
+            else:
+                # A wiped out account has no return to measure
+                ret = total / self.last - 1.0 if self.last else -1.0
+                self.count += 1
+                delta = ret - self.mean
+                self.mean += delta / self.count
+                self.m2 += delta * (ret - self.mean)
+                equity = total / self.first
+                self.hwm = max(self.hwm, equity)
+                self.drawdown = max(self.drawdown, self.hwm - equity)
+            self.last = total
+        self.seen = len(holdings)
+
+        if self.max_drawdown is not None and self.drawdown > self.max_drawdown:
+            return True
+        return self.min_sharpe is not None and self.count >= self.min_bars \
+            and self.sharpe() < self.min_sharpe
+
+
+class SuccessiveHalving(object):
+    """
+    SuccessiveHalving searches a parameter space with successive
+    halving: n randomly drawn parameter sets are backtested on the
+    first part of the period, the best 1/eta of them on a part eta
+    times longer, and so on until the survivors run on the whole
+    period. Most of the CPU time is spent on the promising region
+    instead of the whole grid.
+
+    The backtests of a rung run in parallel on one process pool over
+    bars published once in shared memory, and an optional
+    EarlyStopping ends clearly losing runs before the end of their
+    rung.
+    """
+
+    def __init__(
+        self, csv_dir, symbol_list, initial_capital, start_date,
+        data_handler, execution_handler, portfolio, strategy, space,
+        n=27, eta=3, objective='Sharpe', maximize=True,
+        early_stopping=None, end_date=None, processes=None, warmup=0,
+        seed=None
+    ):
+        """
+        Initialises the search.
+
+        Parameters:
+        csv_dir - The hard root to the CSV data directory.
+        symbol_list - The list of symbol strings.
+        initial_capital - The starting capital for the portfolio.
+        start_date - The start datetime of the strategy.
+        data_handler - (Class) Handles the market data feed.
+        execution_handler - (Class) Handles the orders/fills for traders.
+        portfolio - (Class) Keeps track of portfolio current and prior
+                    positions.
+        strategy - (Class) Generates signals based on market data.
+        space - The search space, see sample_params, or a list of
+                parameter dicts.
+        n - Number of parameter sets drawn for the first rung.
+        eta - Reduction factor between rungs.
+        objective - The statistic of output_summary_stats optimised.
+        maximize - Pick the largest objective, False for the smallest.
+        early_stopping - Optional EarlyStopping template, copied for
+                         every run.
+        end_date - Optional end datetime of the period.
+        processes - Number of worker processes, os.cpu_count() if None.
+        warmup - Number of bars before start_date preloaded into the
+                 lookback window of the strategy.
+        seed - Seed of the parameter sampling.
+        """
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+        self.initial_capital = initial_capital
+        self.start_date = start_date
+        self.end_date = end_date
+        self.data_handler_cls = data_handler
+        self.execution_handler_cls = execution_handler
+        self.portfolio_cls = portfolio
+        self.strategy_cls = strategy
+        if isinstance(space, dict):
+            space = sample_params(space, n, np.random.default_rng(seed))
+        self.candidates = list(space)
+        self.eta = eta
+        self.objective = objective
+        self.maximize = maximize
+        self.early_stopping = early_stopping
+        self.processes = processes or os.cpu_count()
+        self.warmup = warmup
+
+    def _rung_ends(self, data_handler):
+        """
+        Returns the end datetime of every rung, the last one being
+        the end of the period.
+        """
+        rungs = int(math.floor(math.log(len(self.candidates), self.eta) + 1e-9)) + 1
+        epochs = bar_epochs(data_handler, self.csv_dir, self.symbol_list)
+        first = 0
+        if self.start_date is not None:
+            first = int(np.searchsorted(epochs, to_epoch(self.start_date)))
+        last = len(epochs)
+        if self.end_date is not None:
+            last = int(np.searchsorted(epochs, to_epoch(self.end_date)))
+        ends = []
+        for r in range(rungs - 1):
+            bars = int((last - first) * self.eta ** (r - rungs + 1))
+            ends.append(epoch_to_datetime(epochs[min(first + max(bars, 1), last - 1)]))
+        ends.append(self.end_date)
+        return ends
+
+    def _score(self, stats):
+        """
+        Returns the objective of a run as a value to maximise, runs
+        that were stopped or have no objective rank last.
+        """
+        value = stats.get(self.objective)
+        if stats.get('Stopped') or value is None or np.isnan(value):
+            return -np.inf
+        return value if self.maximize else -value
+
+    def run(self):
+        """
+        Runs the search and returns a DataFrame of all runs, best
+        first. The best parameter set is stored in self.best, None
+        if every run of the last rung was stopped or failed.
+        """
+        if shares_bars(self.data_handler_cls):
+            with SharedBarData(self.csv_dir, self.symbol_list,
+                               self.data_handler_cls.csv_columns) as data:
+                return self._run_rungs(partial(
+                    SharedMemoryDataHandler, shared=data.descriptor
+                ))
+        return self._run_rungs(self.data_handler_cls)
+
+    def _run_rungs(self, data_handler):
+        """
+        Runs the rungs one after another on one pool, keeping the
+        best 1/eta of the parameter sets after each.
+        """
+        ends = self._rung_ends(data_handler)
+        pool = worker_pool(
+            self.processes, self.csv_dir, self.symbol_list,
+            self.initial_capital, data_handler, self.execution_handler_cls,
+            self.portfolio_cls, self.strategy_cls, self.warmup
+        )
+        rows = []
+        survivors = self.candidates
+        try:
+            for rung, end_date in enumerate(ends):
+                tasks = [(i, params, self.start_date, end_date, False,
+                          self.early_stopping)
+                         for i, params in enumerate(survivors)]
+                scored = []
+                errors = []
+                for i, params, stats, curve, error in pool.imap_unordered(
+                        _run_params, tasks):
+                    if error is not None:
+                        logger.error("Search: %s failed\n%s", params, error)
+                        errors.append(error)
+                        continue
+                    row = {'Rung': rung, 'End': end_date, 'Params': params}
+                    row.update(stats)
+                    rows.append(row)
+                    scored.append((self._score(stats), i, params))
+                raise_if_all_failed('Search', errors, len(tasks))
+                scored.sort(key=lambda x: (-x[0], x[1]))
+                logger.info("Search: rung %d ran %d parameter sets until %s",
+                            rung, len(tasks), end_date)
+                keep = max(int(math.ceil(len(scored) / float(self.eta))), 1)
+                if rung < len(ends) - 1:
+                    survivors = [p for score, i, p in scored[:keep]
+                                 if score > -np.inf] or \
+                        [p for score, i, p in scored[:1]]
+                else:
+                    # A run stopped early is no best parameter set
+                    self.best = None
+                    if scored and scored[0][0] > -np.inf:
+                        self.best = scored[0][2]
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        results = pd.DataFrame(rows)
+        if not results.empty:
+            results = results.sort_values(
+                ['Rung', self.objective], ascending=[False, not self.maximize]
+            )
+        self.results = results
+        return results
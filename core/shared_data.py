@@ -0,0 +1,128 @@
+from multiprocessing import shared_memory
+import os, os.path
+
+import numpy as np
+
+from .bar_store import BarMerge, BarStore
+from .data import BarStoreDataHandler, HistoricCSVDataHandler
+from .data_cache import DEFAULT_CACHE_DIR, load_csv
+
+
+def _arrays(shm, bars, fields):
+    """
+    Returns the (epochs, values) arrays laid out in a block.
+    """
+    epochs = np.ndarray((bars,), dtype=np.int64, buffer=shm.buf)
+    values = np.ndarray((len(fields), bars), dtype=np.float64,
+                        buffer=shm.buf, offset=bars * 8)
+    return epochs, values
+
+
+class SharedBarData(object):
+    """
+    SharedBarData loads the bars of a set of symbols once and
+    publishes them in multiprocessing.shared_memory, one block per
+    symbol holding the epochs followed by the field columns.
+
+    The descriptor attribute is a small picklable dictionary that
+    worker processes pass to SharedMemoryDataHandler to attach to
+    the data read-only, so an N worker parameter sweep holds a
+    single copy of the data.
+
+    The publisher owns the blocks and has to call unlink() (or use
+    it as a context manager) once all workers are done. Workers
+    are expected to be child processes of the publisher, so they
+    share its multiprocessing resource tracker.
+    """
+
+    def __init__(self, csv_dir, symbol_list,
+                 csv_columns=HistoricCSVDataHandler.csv_columns,
+                 cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Loads the CSV files and publishes them in shared memory.
+
+        Parameters:
+        csv_dir - Absolute directory path to the CSV files.
+        symbol_list - A list of symbol strings.
+        csv_columns - Column names of the CSV files.
+        cache_dir - Directory of the binary data cache, None disables it.
+        """
+        fields = list(csv_columns[1:])
+        self.blocks = []
+        self.descriptor = {}
+        for s in symbol_list:
+            fn = os.path.join(csv_dir, '%s.csv' % s)
+            index, values = load_csv(fn, csv_columns, cache_dir)
+            bars = len(index)
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(bars * 8 * (len(fields) + 1), 1)
+            )
+            epochs, shared = _arrays(shm, bars, fields)
+            epochs[:] = index
+            shared[:] = values
+            self.blocks.append(shm)
+            self.descriptor[s] = (shm.name, bars, fields)
+
+    def close(self):
+        """
+        Closes the mapping of the blocks in this process.
+        """
+        for shm in self.blocks:
+            shm.close()
+
+    def unlink(self):
+        """
+        Releases the shared memory blocks.
+        """
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.unlink()
+
+
+class SharedMemoryDataHandler(BarStoreDataHandler):
+    """
+    SharedMemoryDataHandler serves the bars published by a
+    SharedBarData instance. The BarStores are read-only views on
+    the shared memory blocks, so only the cursors and a few small
+    objects are private to the worker.
+
+    As Backtest builds the data handler from (events, csv_dir,
+    symbol_list), bind the descriptor with functools.partial,
+    e.g. partial(SharedMemoryDataHandler, shared=data.descriptor).
+    """
+
+    def __init__(self, events, csv_dir, symbol_list, shared=None):
+        """
+        Initialises the handler by attaching to the shared blocks.
+
+        Parameters:
+        events - The Event Queue.
+        csv_dir - Kept for interface compatibility, not read.
+        symbol_list - A list of symbol strings.
+        shared - The descriptor of a SharedBarData instance.
+        """
+        self.events = events
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+
+        self.blocks = []
+        self.symbol_data = {}
+        for s in self.symbol_list:
+            name, bars, fields = shared[s]
+            shm = shared_memory.SharedMemory(name=name)
+            # Keep the mapping alive as long as the views on it
+            self.blocks.append(shm)
+            epochs, values = _arrays(shm, bars, fields)
+            self.symbol_data[s] = BarStore(
+                epochs, dict((f, values[i]) for i, f in enumerate(fields))
+            )
+        self.feeds = [(s, self.symbol_data[s]) for s in self.symbol_list]
+        self.merge = BarMerge(self.feeds)
+        self.continue_backtest = self.merge.has_next()
@@ -31,6 +31,21 @@ class Strategy(object):
         """
         raise NotImplementedError("Should implement calculate_signals()")
 
+    def generate_signals(self, arrays):
+        """
+        Optionally computes the target position of every bar at once,
+        for the VectorizedBacktest engine.
+
+        Parameters:
+        arrays - Dict of symbol -> {field: array} with the bar values
+                 and timestamps ('epoch') of each symbol.
+
+        Returns:
+        Dict of symbol -> array of the signed position held after the
+        close of every bar.
+        """
+        raise NotImplementedError("Should implement generate_signals()")
+
 # demo strategy
 class BuyAndHoldStrategy(Strategy):
     """
@@ -0,0 +1,325 @@
+from csv import DictReader, DictWriter
+import itertools
+import json
+import logging
+import multiprocessing
+import os.path
+import traceback
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from .backtest import Backtest
+from .data import HistoricCSVDataHandler
+from .hft_data import HistoricCSVDataHandlerHFT
+from .event_bus import DequeEventBus
+from .shared_data import SharedBarData, SharedMemoryDataHandler
+
+logger = logging.getLogger(__name__)
+
+# Data handlers whose bars SharedMemoryDataHandler serves alike.
+# Subclasses are left out, they may add or change methods.
+SHARED_HANDLERS = (HistoricCSVDataHandler, HistoricCSVDataHandlerHFT)
+
+# Columns of output_summary_stats, in the order they are written.
+STATS_FIELDS = ['Profit', 'Sharpe', 'Max_Drawdown', 'Drawdown_Duration',
+                'Win_Rate', 'Trade_No', 'Total_Profit', 'Total_Loss',
+                'Profit_Factor']
+
+
+def parameter_grid(grid):
+    """
+    Expands a dict of parameter -> list of values into the list of
+    all combinations, e.g. {'k1': [0.1, 0.2], 'k2': [0.3]} into
+    [{'k1': 0.1, 'k2': 0.3}, {'k1': 0.2, 'k2': 0.3}].
+    """
+    names = list(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(grid[n] for n in names))]
+
+
+def params_key(params):
+    """
+    Returns the string identifying a parameter set in the results.
+    """
+    return json.dumps(params, sort_keys=True)
+
+
+# The configuration of the backtests run by a worker process, set
+# once per worker by _init_worker.
+_worker_config = None
+
+
+def _init_worker(config):
+    global _worker_config
+    _worker_config = config
+
+
+def _run_params(task):
+    """
+    Runs one backtest in a worker process.
+
+    Parameters:
+    task - A (key, params, start_date, end_date, curve) tuple, key
+           is passed through to identify the run and curve asks for
+           the equity curve along with the statistics. An optional
+           sixth item is the progress callable of the Backtest, the
+           statistics of a run it stopped have 'Stopped' set.
+
+    Returns:
+    The (key, params, stats, equity_curve, error) of the run, error
+    being the formatted exception if it failed.
+    """
+    key, params, start_date, end_date, curve = task[:5]
+    progress = task[5] if len(task) > 5 else None
+    config = _worker_config
+    try:
+        backtest = Backtest(
+            config['csv_dir'], config['symbol_list'],
+            config['initial_capital'], 0.0, start_date,
+            config['data_handler'], config['execution_handler'],
+            config['portfolio'], config['strategy'], kwargs=dict(params),
+            warmup=config['warmup'], end_date=end_date, progress=progress
+        )
+        stats = backtest.run()
+        if progress is not None:
+            stats['Stopped'] = backtest.stopped
+        equity_curve = backtest.portfolio.equity_curve if curve else None
+        return key, params, stats, equity_curve, None
+    except Exception:
+        return key, params, None, None, traceback.format_exc()
+
+
+def worker_pool(processes, csv_dir, symbol_list, initial_capital,
+                data_handler, execution_handler, portfolio, strategy,
+                warmup=0):
+    """
+    Returns a multiprocessing.Pool whose workers run _run_params
+    tasks with the given backtest configuration.
+    """
+    config = {
+        'csv_dir': csv_dir,
+        'symbol_list': symbol_list,
+        'initial_capital': initial_capital,
+        'data_handler': data_handler,
+        'execution_handler': execution_handler,
+        'portfolio': portfolio,
+        'strategy': strategy,
+        'warmup': warmup,
+    }
+    return multiprocessing.Pool(processes, _init_worker, (config,))
+
+
+def bar_epochs(data_handler, csv_dir, symbol_list):
+    """
+    Returns a copy of the bar timestamps of the first symbol.
+    """
+    handler = data_handler(DequeEventBus(), csv_dir, symbol_list)
+    return np.array(handler.symbol_data[symbol_list[0]].epochs)
+
+
+def shares_bars(data_handler):
+    """
+    Returns True if the bars of data_handler can be served from a
+    SharedBarData instead, i.e. it is one of SHARED_HANDLERS.
+    """
+    return data_handler in SHARED_HANDLERS
+
+
+def raise_if_all_failed(name, errors, runs):
+    """
+    Raises a RuntimeError with the first error if all of runs
+    backtests failed, rather than going on with no results.
+
+    Parameters:
+    name - Name of the runner in the message, e.g. 'Sweep'.
+    errors - The formatted errors of the failed runs.
+    runs - The number of runs.
+    """
+    if runs and len(errors) == runs:
+        raise RuntimeError("%s: all %d runs failed, the first with\n%s"
+                           % (name, runs, errors[0]))
+
+
+class ParameterSweep(object):
+    """
+    ParameterSweep runs a Backtest for every combination of a grid
+    of strategy parameters on a pool of worker processes.
+
+    The bars are loaded once and published in shared memory, so all
+    workers read the same copy rather than parsing the CSV files per
+    run. Statistics come back to the parent process, the single
+    writer of the results file, which appends one row per finished
+    run. A sweep that is run again skips the parameter sets already
+    in the results file, so it resumes after a crash.
+    """
+
+    def __init__(
+        self, csv_dir, symbol_list, initial_capital, start_date,
+        data_handler, execution_handler, portfolio, strategy, grid,
+        results_file, processes=None, warmup=0, shared=True, end_date=None
+    ):
+        """
+        Initialises the sweep.
+
+        Parameters:
+        csv_dir - The hard root to the CSV data directory.
+        symbol_list - The list of symbol strings.
+        initial_capital - The starting capital for the portfolio.
+        start_date - The start datetime of the strategy.
+        data_handler - (Class) Handles the market data feed.
+        execution_handler - (Class) Handles the orders/fills for traders.
+        portfolio - (Class) Keeps track of portfolio current and prior
+                    positions.
+        strategy - (Class) Generates signals based on market data.
+        grid - Dict of parameter -> list of values, or a list of
+               parameter dicts.
+        results_file - CSV file the statistics are appended to.
+        processes - Number of worker processes, os.cpu_count() if None.
+        warmup - Number of bars before start_date preloaded into the
+                 lookback window of the strategy.
+        shared - Serve the bars from shared memory. Only used with
+                 HistoricCSVDataHandler and its subclasses.
+        end_date - Optional datetime at which the backtests stop.
+        """
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+        self.initial_capital = initial_capital
+        self.start_date = start_date
+        self.data_handler_cls = data_handler
+        self.execution_handler_cls = execution_handler
+        self.portfolio_cls = portfolio
+        self.strategy_cls = strategy
+        if isinstance(grid, dict):
+            grid = parameter_grid(grid)
+        self.grid = list(grid)
+        self.results_file = results_file
+        self.processes = processes or os.cpu_count()
+        self.warmup = warmup
+        self.end_date = end_date
+        self.shared = shared and shares_bars(data_handler)
+
+    def _completed(self):
+        """
+        Returns the keys of the parameter sets in the results file.
+        """
+        if not os.path.exists(self.results_file):
+            return set()
+        with open(self.results_file, newline='') as f:
+            return set(row['Params'] for row in DictReader(f))
+
+    def _file_field_names(self):
+        """
+        Returns the header of the results file, None if there is no
+        file or it is empty.
+        """
+        if not os.path.exists(self.results_file):
+            return None
+        with open(self.results_file, newline='') as f:
+            return DictReader(f).fieldnames
+
+    def _resumed_field_names(self):
+        """
+        Returns the columns rows are written under. A resumed sweep
+        keeps the header of its results file, which has to hold the
+        same columns as the grid. Raises a ValueError otherwise, as
+        the new rows would not match the header.
+        """
+        field_names = self._field_names()
+        header = self._file_field_names()
+        if header is None:
+            return field_names
+        if set(header) != set(field_names):
+            raise ValueError(
+                "Sweep: %s has the columns %s, the grid needs %s. Use a "
+                "new results file for a changed grid."
+                % (self.results_file, header, field_names)
+            )
+        return header
+
+    def _field_names(self):
+        names = []
+        for params in self.grid:
+            for name in params:
+                if name not in names:
+                    names.append(name)
+        return names + STATS_FIELDS + ['Params']
+
+    def run(self, callback=None):
+        """
+        Runs the parameter sets not yet in the results file and
+        returns all results as a DataFrame. Raises a ValueError if
+        the results file was written for a grid with other
+        parameters, and a RuntimeError if every run failed.
+
+        Parameters:
+        callback - Optional callable(params, stats) called in the
+                   parent process after each finished run.
+        """
+        field_names = self._resumed_field_names()
+        completed = self._completed()
+        pending = [p for p in self.grid if params_key(p) not in completed]
+        logger.info("Sweep: %d of %d parameter sets to run",
+                    len(pending), len(self.grid))
+        if pending:
+            if self.shared:
+                with SharedBarData(self.csv_dir, self.symbol_list,
+                                   self.data_handler_cls.csv_columns) as data:
+                    self._run_pending(pending, partial(
+                        SharedMemoryDataHandler, shared=data.descriptor
+                    ), field_names, callback)
+            else:
+                self._run_pending(pending, self.data_handler_cls,
+                                  field_names, callback)
+        return self.results()
+
+    def _run_pending(self, pending, data_handler, field_names, callback):
+        """
+        Fans the pending parameter sets out to the workers and writes
+        the results as they arrive under field_names.
+        """
+        new_file = self._file_field_names() is None
+        pool = worker_pool(
+            min(self.processes, len(pending)), self.csv_dir,
+            self.symbol_list, self.initial_capital, data_handler,
+            self.execution_handler_cls, self.portfolio_cls,
+            self.strategy_cls, self.warmup
+        )
+        tasks = [(None, params, self.start_date, self.end_date, False)
+                 for params in pending]
+        try:
+            with open(self.results_file, 'a', newline='') as f:
+                writer = DictWriter(f, fieldnames=field_names,
+                                    extrasaction='ignore')
+                if new_file:
+                    writer.writeheader()
+                errors = []
+                for key, params, stats, curve, error in pool.imap_unordered(
+                        _run_params, tasks):
+                    if error is not None:
+                        logger.error("Sweep: %s failed\n%s", params, error)
+                        errors.append(error)
+                        continue
+                    row = dict(params)
+                    row.update(stats)
+                    row['Params'] = params_key(params)
+                    writer.writerow(row)
+                    # Flush every row, so a crash loses at most the runs
+                    # still in flight
+                    f.flush()
+                    if callback is not None:
+                        callback(params, stats)
+            raise_if_all_failed('Sweep', errors, len(tasks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def results(self):
+        """
+        Returns the results file as a DataFrame.
+        """
+        if not os.path.exists(self.results_file):
+            return pd.DataFrame(columns=self._field_names())
+        return pd.read_csv(self.results_file)
@@ -0,0 +1,79 @@
+from bisect import bisect_left, bisect_right
+
+
+class TriggerBook(object):
+    """
+    TriggerBook keeps the resting orders of one symbol that trigger
+    on the same side of a bar, e.g. the buy limit orders, sorted by
+    their trigger price.
+
+    A book is triggered either by the low of a bar falling to the
+    price of its orders or by the high rising to it, so the
+    triggered orders are always a run at one end of the book and a
+    bar finds them with a single bisect.
+    """
+
+    def __init__(self, on_high, inclusive):
+        """
+        Parameters:
+        on_high - True if the orders trigger when the high of a bar
+                  rises above their price, False if they trigger when
+                  the low falls below it.
+        inclusive - True if touching the price triggers an order,
+                    False if the bar has to trade through it.
+        """
+        self.on_high = on_high
+        self.inclusive = inclusive
+        # (price, order_id) of every order, sorted, and the orders
+        # in the same order
+        self.keys = []
+        self.orders = []
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, price, order):
+        """
+        Adds an order triggered at price.
+        """
+        key = (price, order.order_id)
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.orders.insert(i, order)
+
+    def remove(self, price, order):
+        """
+        Removes an order added at price, if it is in the book.
+        """
+        key = (price, order.order_id)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+            del self.orders[i]
+
+    def pop_triggered(self, low, high):
+        """
+        Removes and returns the orders triggered by a bar with the
+        given low and high, in order_id order.
+        """
+        if self.on_high:
+            # The orders priced below the high, or at it
+            if self.inclusive:
+                i = bisect_right(self.keys, (high, float('inf')))
+            else:
+                i = bisect_left(self.keys, (high, float('-inf')))
+            triggered = self.orders[:i]
+            del self.keys[:i]
+            del self.orders[:i]
+        else:
+            # The orders priced above the low, or at it
+            if self.inclusive:
+                i = bisect_left(self.keys, (low, float('-inf')))
+            else:
+                i = bisect_right(self.keys, (low, float('inf')))
+            triggered = self.orders[i:]
+            del self.keys[i:]
+            del self.orders[i:]
+        if len(triggered) > 1:
+            triggered.sort(key=lambda order: order.order_id)
+        return triggered
@@ -0,0 +1,329 @@
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import pandas as pd
+
+from .backtest import Backtest
+from .event_bus import DequeEventBus
+from .execution import SimulatedExecutionHandler
+from .performance import create_sharpe_ratio, create_drawdowns
+from .portfolio import NaivePortfolio
+
+logger = logging.getLogger(__name__)
+
+
+def rolling_mean(values, window):
+    """
+    Returns the mean of the last window values at every position,
+    over fewer values at the start, like np.mean on the result of
+    get_latest_bars_values(symbol, field, N=window).
+
+    Every window is summed on its own as np.mean sums it, rather
+    than from differences of a running sum, so the means are equal
+    to the last bit and crossovers of equal means fire in both
+    engines alike.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    means = np.empty(len(values))
+    for i in range(min(window - 1, len(values))):
+        means[i] = np.mean(values[:i + 1])
+    if len(values) >= window:
+        # The windows as a read-only view, one row per position
+        windows = as_strided(
+            values, shape=(len(values) - window + 1, window),
+            strides=(values.strides[0], values.strides[0]), writeable=False
+        )
+        means[window - 1:] = windows.mean(axis=1)
+    return means
+
+
+class VectorizedBacktest(object):
+    """
+    VectorizedBacktest evaluates a strategy over the whole data set
+    in a few NumPy passes instead of one event per bar, to screen
+    many parameter sets quickly.
+
+    The strategy exposes generate_signals(arrays), returning the
+    target position of every bar. Position changes are filled at
+    the close of the bar that produced them, which is how
+    NaivePortfolio and SimulatedExecutionHandler fill market orders,
+    and the holdings, equity curve and summary statistics are built
+    the same way as by NaivePortfolio.
+
+    Only strategies trading market orders can be expressed this way,
+    limit, stop and exit orders need the event engine. parity()
+    runs both engines and reports where they diverge, to confirm the
+    finalists of a screen.
+    """
+
+    def __init__(
+        self, csv_dir, symbol_list, initial_capital, start_date,
+        data_handler, strategy, kwargs=None, warmup=0, commission=0.0,
+        periods=252*6
+    ):
+        """
+        Initialises the vectorised backtest.
+
+        Parameters:
+        csv_dir - The hard root to the CSV data directory.
+        symbol_list - The list of symbol strings.
+        initial_capital - The starting capital for the portfolio.
+        start_date - The start datetime of the strategy.
+        data_handler - (Class) A data handler serving BarStores, e.g.
+                       HistoricCSVDataHandler.
+        strategy - (Class) Implements generate_signals().
+        kwargs - The parameters passed to the strategy.
+        warmup - Number of bars before start_date passed to
+                 generate_signals as lookback.
+        commission - Commission charged per fill.
+        periods - Bars per year used for the Sharpe ratio.
+        """
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+        self.initial_capital = initial_capital
+        self.start_date = start_date
+        self.data_handler_cls = data_handler
+        self.strategy_cls = strategy
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.warmup = warmup
+        self.commission = commission
+        self.periods = periods
+
+        self.events = DequeEventBus()
+        self.data_handler = self.data_handler_cls(self.events,
+                                                  self.csv_dir,
+                                                  self.symbol_list)
+        if self.start_date is not None:
+            self.data_handler.seek(self.start_date, self.warmup)
+        self.strategy = self.strategy_cls(self.data_handler, self.events,
+                                          **self.kwargs)
+
+    def _arrays(self):
+        """
+        Returns {symbol: {field: array}} of the bars from the start
+        of the warm-up window on, the timestamps under 'epoch', and
+        the offset of the first traded bar of each symbol.
+        """
+        arrays = {}
+        offsets = {}
+        for s in self.symbol_list:
+            store = self.data_handler.symbol_data[s]
+            bars = dict((f, store.columns[f][store.floor:]) for f in store.fields)
+            bars['epoch'] = store.epochs[store.floor:]
+            arrays[s] = bars
+            offsets[s] = store.cursor - store.floor
+        return arrays, offsets
+
+    def run(self):
+        """
+        Runs the strategy and builds the equity curve, trade history
+        and order history. Returns the summary statistics.
+        """
+        arrays, offsets = self._arrays()
+        targets = self.strategy.generate_signals(arrays)
+
+        symbols = []
+        for s in self.symbol_list:
+            start = offsets[s]
+            epochs = arrays[s]['epoch'][start:]
+            close = np.asarray(arrays[s]['close'][start:], dtype=np.float64)
+            target = np.asarray(targets[s], dtype=np.float64)[start:]
+            symbols.append((s, epochs, close, target))
+
+        # The steps of the event engine, one per distinct timestamp,
+        # except that BarMerge releases the k-th bar of a timestamp
+        # repeated within one feed in a step of its own. A step is
+        # therefore a distinct (timestamp, k) pair.
+        keys = []
+        for s, epochs, close, target in symbols:
+            repeat = np.arange(len(epochs)) - \
+                np.searchsorted(epochs, epochs, side='left')
+            keys.append(np.column_stack((epochs, repeat)))
+        steps, inverse = np.unique(np.concatenate(keys), axis=0,
+                                   return_inverse=True)
+        inverse = inverse.ravel()
+        bounds = np.cumsum([0] + [len(k) for k in keys])
+        step_numbers = np.arange(len(steps))
+        cash = np.full(len(steps), float(self.initial_capital))
+        commission = np.zeros(len(steps))
+        positions = {}
+        holdings = {}
+        orders = []
+        for i, (s, epochs, close, target) in enumerate(symbols):
+            # The step of every bar of the symbol, increasing
+            bar_steps = inverse[bounds[i]:bounds[i + 1]]
+            trades = np.diff(target, prepend=0.0)
+            fees = np.where(trades != 0, self.commission, 0.0)
+            flows = np.concatenate(([0.0], np.cumsum(trades * close + fees)))
+            fees = np.concatenate(([0.0], np.cumsum(fees)))
+            # Holdings are recorded before the fills of a step
+            before = np.searchsorted(bar_steps, step_numbers, side='left')
+            latest = np.searchsorted(bar_steps, step_numbers, side='right') - 1
+            position = np.concatenate(([0.0], target))[before]
+            cash -= flows[before]
+            commission += fees[before]
+            positions[s] = position
+            holdings[s] = np.where(position != 0,
+                                   position * close[np.maximum(latest, 0)], 0.0)
+            orders.extend(self._round_trips(s, epochs, close, target))
+
+        index = pd.DatetimeIndex(
+            [pd.Timestamp(self.start_date)] + list(pd.to_datetime(steps[:, 0]))
+        )
+        curve = pd.DataFrame(index=index)
+        trade = pd.DataFrame(index=index)
+        total = cash.copy()
+        for s in self.symbol_list:
+            curve[s] = np.concatenate(([0.0], holdings[s]))
+            trade[s] = np.concatenate(([0.0], positions[s]))
+            total += holdings[s]
+        curve['cash'] = np.concatenate(([self.initial_capital], cash))
+        curve['commission'] = np.concatenate(([0.0], commission))
+        curve['total'] = np.concatenate(([self.initial_capital], total))
+        curve['returns'] = curve['total'].pct_change()
+        curve['equity_curve'] = (1.0+curve['returns']).cumprod()
+        curve.index.name = 'datetime'
+        trade.index.name = 'datetime'
+        self.equity_curve = curve
+        self.trade_history = trade
+        self.order_history = pd.DataFrame(orders, columns=[
+            'symbol', 'direction', 'quantity', 'entry_time', 'entry_price',
+            'exit_time', 'exit_price', 'profit'
+        ])
+        return self.output_summary_stats()
+
+    def _round_trips(self, symbol, epochs, close, target):
+        """
+        Returns the trades of one symbol, a trade lasting as long as
+        the target position stays the same nonzero value. Trades
+        still open at the end have no exit and no profit.
+        """
+        changes = np.flatnonzero(np.diff(target, prepend=0.0) != 0)
+        times = pd.to_datetime(epochs[changes])
+        trades = []
+        for i, bar in enumerate(changes):
+            quantity = target[bar]
+            if quantity == 0:
+                continue
+            entry = close[bar]
+            if i + 1 < len(changes):
+                exit_bar = changes[i + 1]
+                exit_time, exit_price = times[i + 1], close[exit_bar]
+                profit = (exit_price - entry) * quantity
+            else:
+                exit_time, exit_price, profit = None, None, None
+            trades.append((symbol, 'BUY' if quantity > 0 else 'SELL',
+                           abs(quantity), times[i], entry, exit_time,
+                           exit_price, profit))
+        return trades
+
+    def output_summary_stats(self):
+        """
+        Creates the summary statistics of NaivePortfolio from the
+        vectorised results.
+        """
+        returns = self.equity_curve['returns']
+        pnl = self.equity_curve['equity_curve']
+
+        sharpe_ratio = create_sharpe_ratio(returns, periods=self.periods)
+        drawdown, max_dd, dd_duration = create_drawdowns(pnl)
+        self.equity_curve['drawdown'] = drawdown
+
+        profits = self.order_history['profit'].astype(np.float64)
+        profit = round(profits.sum(), 1)
+        total_profit = round(profits[profits > 0].sum(), 1)
+        total_loss = round(profits[profits < 0].sum(), 1)
+        trade_no = len(self.order_history)
+        winrate = 0.0
+        if trade_no > 0:
+            winrate = round(len(profits[profits > 0])/trade_no, 3)
+        profit_factor = np.nan
+        if total_loss != 0:
+            profit_factor = round(total_profit / total_loss, 2)
+        stats = {"Profit": profit,
+                 "Sharpe": sharpe_ratio,
+                 "Max_Drawdown": max_dd,
+                 "Drawdown_Duration": dd_duration,
+                 "Win_Rate": winrate,
+                 "Trade_No": trade_no,
+                 "Total_Profit": total_profit,
+                 "Total_Loss": total_loss,
+                 "Profit_Factor": profit_factor}
+        return stats
+
+    def parity(self, execution_handler=SimulatedExecutionHandler,
+               portfolio=NaivePortfolio, tolerance=1e-6):
+        """
+        Runs the strategy in both engines and returns the divergences
+        as a list of (name, vectorised, event) tuples, empty if they
+        agree within tolerance.
+
+        The summary statistics are compared one by one, the equity
+        curves by the first bar whose timestamp or total differs.
+
+        Parameters:
+        execution_handler - (Class) Execution handler of the event run.
+        portfolio - (Class) Portfolio of the event run.
+        tolerance - Relative tolerance of the comparisons.
+        """
+        stats = self.run()
+        backtest = Backtest(
+            self.csv_dir, self.symbol_list, self.initial_capital, 0.0,
+            self.start_date, self.data_handler_cls, execution_handler,
+            portfolio, self.strategy_cls, kwargs=self.kwargs,
+            warmup=self.warmup
+        )
+        backtest._run_backtest()
+        event_portfolio = backtest.portfolio
+        event_portfolio.create_equity_curve_dataframe()
+        event_portfolio.create_trade_history_dataframe()
+        event_portfolio.create_order_history_dataframe()
+        event_stats = event_portfolio.output_summary_stats()
+
+        divergences = []
+        for name, value in stats.items():
+            other = event_stats.get(name)
+            if not np.isclose(value, other, rtol=tolerance, equal_nan=True):
+                divergences.append((name, value, other))
+
+        totals = self.equity_curve['total']
+        event_totals = event_portfolio.equity_curve['total']
+        if len(totals) != len(event_totals):
+            divergences.append(('Bars', len(totals), len(event_totals)))
+        divergence = self._first_divergence(totals, event_totals, tolerance)
+        if divergence is not None:
+            divergences.append(divergence)
+
+        for name, value, other in divergences:
+            logger.warning("Parity: %s differs, vectorized %s, event %s",
+                           name, value, other)
+        return divergences
+
+    def _first_divergence(self, totals, event_totals, tolerance):
+        """
+        Returns the first bar where two equity curve totals diverge
+        as a (name, vectorised, event) tuple, or None. A bar only one
+        engine has diverges at its timestamp, with None as the total
+        of the other engine.
+        """
+        index, event_index = totals.index, event_totals.index
+        n = min(len(index), len(event_index))
+        differ = np.flatnonzero(
+            (index[:n] != event_index[:n]) |
+            ~np.isclose(totals.values[:n], event_totals.values[:n],
+                        rtol=tolerance)
+        )
+        if len(differ) > 0:
+            i = differ[0]
+        elif len(index) != len(event_index):
+            i = n
+        else:
+            return None
+        times = [x[i] for x in (index, event_index) if i < len(x)]
+        time = min(times)
+        value = totals.values[i] if i < len(index) and index[i] == time \
+            else None
+        other = event_totals.values[i] \
+            if i < len(event_index) and event_index[i] == time else None
+        return ('Total at %s' % time, value, other)
@@ -0,0 +1,248 @@
+from datetime import timedelta
+from functools import partial
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .bar_store import epoch_to_datetime
+from .performance import create_sharpe_ratio, create_drawdowns
+from .shared_data import SharedBarData, SharedMemoryDataHandler
+from .sweep import (_run_params, bar_epochs, parameter_grid,
+                    raise_if_all_failed, shares_bars,
+                    worker_pool)
+
+logger = logging.getLogger(__name__)
+
+
+def walk_forward_windows(epochs, in_sample, out_of_sample, anchored=False):
+    """
+    Splits a timeline into consecutive walk-forward windows.
+
+    Parameters:
+    epochs - Sorted bar timestamps as epoch nanoseconds.
+    in_sample - Length of the in-sample window, a number of bars or
+                a timedelta.
+    out_of_sample - Length of the out-of-sample window, a number of
+                    bars or a timedelta.
+    anchored - If True every in-sample window starts at the first
+               bar, otherwise it rolls forward with the windows.
+
+    Returns:
+    A list of (in_start, in_end, out_start, out_end) datetimes, each
+    window covering [start, end). The out-of-sample windows follow
+    each other without gaps.
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    # Window bounds as bar positions, the end being exclusive
+    if isinstance(in_sample, timedelta):
+        length = int(in_sample.total_seconds() * 1e9)
+        step = int(out_of_sample.total_seconds() * 1e9)
+        starts = np.arange(epochs[0] + length, epochs[-1] + 1, step)
+        out_firsts = np.searchsorted(epochs, starts, side='left')
+        in_firsts = np.searchsorted(epochs, starts - length, side='left')
+        out_ends = np.append(out_firsts[1:], len(epochs))
+    else:
+        out_firsts = np.arange(in_sample, len(epochs), out_of_sample)
+        in_firsts = out_firsts - in_sample
+        out_ends = np.minimum(out_firsts + out_of_sample, len(epochs))
+    if anchored:
+        in_firsts = np.zeros_like(in_firsts)
+
+    def at(i):
+        # The end of the last window is just after the last bar
+        if i >= len(epochs):
+            return epoch_to_datetime(epochs[-1] + 1000)
+        return epoch_to_datetime(epochs[i])
+    return [(at(a), at(b), at(b), at(c))
+            for a, b, c in zip(in_firsts, out_firsts, out_ends) if b < c]
+
+
+class WalkForward(object):
+    """
+    WalkForward runs a walk-forward optimisation: the parameter grid
+    is optimised on each in-sample window, the best parameters are
+    traded on the following out-of-sample window, and the
+    out-of-sample equity curves are stitched into one.
+
+    The bars are loaded once and, for CSV data handlers, published
+    in shared memory. Every window is a Backtest that seeks to its
+    start and stops at its end with a binary search, so no CSV file
+    is read per window. The in-sample runs of all windows are spread
+    over one process pool.
+    """
+
+    def __init__(
+        self, csv_dir, symbol_list, initial_capital, data_handler,
+        execution_handler, portfolio, strategy, grid, in_sample,
+        out_of_sample, anchored=False, objective='Sharpe', maximize=True,
+        processes=None, warmup=0, periods=252*6
+    ):
+        """
+        Initialises the walk-forward optimisation.
+
+        Parameters:
+        csv_dir - The hard root to the CSV data directory.
+        symbol_list - The list of symbol strings.
+        initial_capital - The starting capital of every window.
+        data_handler - (Class) Handles the market data feed.
+        execution_handler - (Class) Handles the orders/fills for traders.
+        portfolio - (Class) Keeps track of portfolio current and prior
+                    positions.
+        strategy - (Class) Generates signals based on market data.
+        grid - Dict of parameter -> list of values, or a list of
+               parameter dicts.
+        in_sample - Length of the in-sample windows, a number of bars
+                    of the first symbol or a timedelta.
+        out_of_sample - Length of the out-of-sample windows, likewise.
+        anchored - Grow the in-sample windows from the first bar
+                   instead of rolling them.
+        objective - The statistic of output_summary_stats optimised.
+        maximize - Pick the largest objective, False for the smallest.
+        processes - Number of worker processes, os.cpu_count() if None.
+        warmup - Number of bars before each window preloaded into the
+                 lookback window of the strategy.
+        periods - Bars per year used for the stitched Sharpe ratio.
+        """
+        self.csv_dir = csv_dir
+        self.symbol_list = symbol_list
+        self.initial_capital = initial_capital
+        self.data_handler_cls = data_handler
+        self.execution_handler_cls = execution_handler
+        self.portfolio_cls = portfolio
+        self.strategy_cls = strategy
+        if isinstance(grid, dict):
+            grid = parameter_grid(grid)
+        self.grid = list(grid)
+        self.in_sample = in_sample
+        self.out_of_sample = out_of_sample
+        self.anchored = anchored
+        self.objective = objective
+        self.maximize = maximize
+        self.processes = processes or os.cpu_count()
+        self.warmup = warmup
+        self.periods = periods
+
+    def _best(self, results):
+        """
+        Returns the params with the best objective of a list of
+        (params, stats), ignoring runs without a valid objective.
+        """
+        best, best_value = None, None
+        for params, stats in results:
+            value = stats.get(self.objective)
+            if value is None or np.isnan(value):
+                continue
+            if best is None or (value > best_value if self.maximize
+                                else value < best_value):
+                best, best_value = params, value
+        return best
+
+    def run(self):
+        """
+        Runs the optimisation. Returns the DataFrame of the windows
+        with their best parameters and statistics, and stores the
+        stitched out-of-sample equity curve in self.equity_curve.
+        """
+        if shares_bars(self.data_handler_cls):
+            with SharedBarData(self.csv_dir, self.symbol_list,
+                               self.data_handler_cls.csv_columns) as data:
+                return self._run_windows(partial(
+                    SharedMemoryDataHandler, shared=data.descriptor
+                ))
+        return self._run_windows(self.data_handler_cls)
+
+    def _run_windows(self, data_handler):
+        """
+        Optimises every window in sample and runs the winners out of
+        sample on one pool.
+        """
+        self.windows = walk_forward_windows(
+            bar_epochs(data_handler, self.csv_dir, self.symbol_list),
+            self.in_sample, self.out_of_sample, self.anchored
+        )
+        pool = worker_pool(
+            self.processes, self.csv_dir, self.symbol_list,
+            self.initial_capital, data_handler, self.execution_handler_cls,
+            self.portfolio_cls, self.strategy_cls, self.warmup
+        )
+        try:
+            tasks = [(w, params, window[0], window[1], False)
+                     for w, window in enumerate(self.windows)
+                     for params in self.grid]
+            in_sample = dict((w, []) for w in range(len(self.windows)))
+            errors = []
+            for w, params, stats, curve, error in pool.imap_unordered(
+                    _run_params, tasks):
+                if error is not None:
+                    logger.error("Walk-forward: %s failed in window %d\n%s",
+                                 params, w, error)
+                    errors.append(error)
+                    continue
+                in_sample[w].append((params, stats))
+            raise_if_all_failed('Walk-forward', errors, len(tasks))
+
+            best = dict((w, self._best(in_sample[w])) for w in in_sample)
+            tasks = [(w, best[w], window[2], window[3], True)
+                     for w, window in enumerate(self.windows)
+                     if best[w] is not None]
+            out_of_sample = {}
+            errors = []
+            for w, params, stats, curve, error in pool.imap_unordered(
+                    _run_params, tasks):
+                if error is not None:
+                    logger.error("Walk-forward: %s failed out of sample in "
+                                 "window %d\n%s", params, w, error)
+                    errors.append(error)
+                    continue
+                out_of_sample[w] = (stats, curve)
+            raise_if_all_failed('Walk-forward', errors, len(tasks))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        rows = []
+        curves = []
+        for w, window in enumerate(self.windows):
+            row = {'In_Start': window[0], 'In_End': window[1],
+                   'Out_Start': window[2], 'Out_End': window[3],
+                   'Params': best[w]}
+            if w in out_of_sample:
+                stats, curve = out_of_sample[w]
+                row.update(stats)
+                # The first row of a window is its initial capital
+                returns = curve['returns'].iloc[1:].to_frame()
+                returns['window'] = w
+                curves.append(returns)
+            rows.append(row)
+        self._stitch(curves)
+        self.results = pd.DataFrame(rows)
+        return self.results
+
+    def _stitch(self, curves):
+        """
+        Chains the returns of the out-of-sample windows into one
+        equity curve and computes its statistics.
+        """
+        if not curves:
+            self.equity_curve = pd.DataFrame(
+                columns=['returns', 'window', 'equity_curve', 'drawdown']
+            )
+            self.stats = {}
+            return
+        curve = pd.concat(curves)
+        curve['equity_curve'] = (1.0+curve['returns'].fillna(0.0)).cumprod()
+        # create_drawdowns skips the first row, the initial capital
+        # row of an event backtest
+        equity = pd.concat([pd.Series([1.0]), curve['equity_curve']])
+        drawdown, max_dd, dd_duration = create_drawdowns(equity)
+        curve['drawdown'] = drawdown.values[1:]
+        self.equity_curve = curve
+        self.stats = {
+            'Sharpe': create_sharpe_ratio(curve['returns'], periods=self.periods),
+            'Max_Drawdown': max_dd,
+            'Drawdown_Duration': dd_duration,
+            'Return': curve['equity_curve'].iloc[-1] - 1.0,
+        }
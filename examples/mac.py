@@ -1,11 +1,19 @@
+import sys
+
+sys.path.append("./")
+
 from datetime import datetime as dt
+import logging
 import numpy as np
-from strategy import Strategy
-from event import SignalEvent
-from backtest import Backtest
-from data import HistoricCSVDataHandler
-from execution import SimulatedExecutionHandler
-from portfolio import NaivePortfolio
+from core.strategy import Strategy
+from core.event import SignalEvent
+from core.backtest import Backtest
+from core.data import HistoricCSVDataHandler
+from core.execution import SimulatedExecutionHandler
+from core.portfolio import NaivePortfolio
+from core.vectorized import rolling_mean
+
+logger = logging.getLogger(__name__)
 
 # Moving Average Strategy
 class MovingAverageCrossStrategy(Strategy):
@@ -56,8 +64,8 @@ class MovingAverageCrossStrategy(Strategy):
                 bars = self.bars.get_latest_bars_values(
                     s, "close", N=self.long_window
                 )
-                bar_date = self.bars.get_latest_bar_datetime(s)
                 if bars is not None and bars.size > 0:
+                    bar_date = self.bars.get_latest_bar_datetime(s)
                     short_sma = np.mean(bars[-self.short_window:])
                     long_sma = np.mean(bars[-self.long_window:])
 
@@ -66,28 +74,50 @@ class MovingAverageCrossStrategy(Strategy):
                     sig_dir = ""
 
                     if short_sma > long_sma and self.bought[s] == "OUT":
-                        print("LONG: %s" % bar_date)
+                        logger.info("LONG: %s", bar_date)
                         sig_dir = 'LONG'
                         signal = SignalEvent(
-                            1, symbol, cur_date, sig_dir, 10000
+                            symbol, cur_date, sig_dir, quantity=10000
                         )
                         self.events.put(signal)
                         self.bought[s] = 'LONG'
                     elif short_sma < long_sma and self.bought[s] == "LONG":
-                        print("SHORT: %s" % bar_date)
+                        logger.info("SHORT: %s", bar_date)
                         sig_dir = 'EXIT'
                         signal = SignalEvent(
-                            1, symbol, cur_date, sig_dir, 10000
+                            symbol, cur_date, sig_dir, quantity=10000
                         )
                         self.events.put(signal)
                         self.bought[s] = 'OUT'
 
+    def generate_signals(self, arrays):
+        """
+        Computes the positions of calculate_signals for all bars at
+        once: long 10000 units while the short SMA is above the long
+        one, flat while it is below, unchanged when they are equal.
+
+        Parameters
+        arrays - Dict of symbol -> {field: array} of the bars.
+        """
+        positions = {}
+        for s in self.symbol_list:
+            close = arrays[s]['close']
+            short_sma = rolling_mean(close, self.short_window)
+            long_sma = rolling_mean(close, self.long_window)
+            state = np.where(short_sma > long_sma, 1.0,
+                             np.where(short_sma < long_sma, 0.0, np.nan))
+            # Carry the last state over bars where the SMAs are equal
+            known = np.where(np.isnan(state), 0, np.arange(len(state)))
+            state = np.nan_to_num(state[np.maximum.accumulate(known)])
+            positions[s] = state * 10000
+        return positions
+
 if __name__ == "__main__":
     csv_dir = './data/H4' # CHANGE THIS!
     symbol_list = ['AUD_USD_H4']
     initial_capital = 100000.0
     heartbeat = 0.0
-    start_date = dt(2019, 4, 24, 0, 0, 0)
+    start_date = dt(2015, 5, 5, 0, 0, 0)
     backtest = Backtest(csv_dir, symbol_list, initial_capital,
                         heartbeat,start_date, HistoricCSVDataHandler,
                         SimulatedExecutionHandler, NaivePortfolio,
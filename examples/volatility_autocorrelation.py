@@ -4,7 +4,7 @@ sys.path.append("./")
 
 import numpy as np
 from datetime import datetime as dt
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 from core.strategy import Strategy
 from core.event import SignalEvent
@@ -79,11 +79,10 @@ class VolatilityAutocorrelationStrategy(Strategy):
                 lows = self.bars.get_latest_bars_values(
                     s, "low", N=self.long_window
                 )
-                close = self.bars.get_latest_bar_value(s, 'close')
-                bar_date = self.bars.get_latest_bar_datetime(s)
-                bar_date = datetime.strptime(bar_date[:-4], "%Y-%m-%dT%H:%M:%S.%f")
                 if highs is not None and len(highs) == self.long_window and \
                    lows is not None and len(lows) == self.long_window:
+                   close = self.bars.get_latest_bar_value(s, 'close')
+                   bar_date = self.bars.get_latest_bar_datetime(s)
 
                    # close all orders before the end of weekend, Friday 17:00 in this case
                    # uncomment this chunk of code if not
@@ -0,0 +1,63 @@
+import os.path
+
+import numpy as np
+
+from core.chunked_data import HistoricCSVChunkedDataHandler
+from core.data import HistoricCSVDataHandler
+from core.event_bus import DequeEventBus
+
+CSV_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'H4')
+SYMBOL = 'AUD_USD_H4'
+
+
+def _handlers(**kwargs):
+    full = HistoricCSVDataHandler(DequeEventBus(), CSV_DIR, [SYMBOL],
+                                  cache_dir=None)
+    chunked = HistoricCSVChunkedDataHandler(DequeEventBus(), CSV_DIR,
+                                            [SYMBOL], **kwargs)
+    return full, chunked
+
+
+def _assert_tail_of(full, chunked, N):
+    """
+    The chunked handler may keep fewer than N bars, but those it
+    returns are the latest bars of the full handler.
+    """
+    values = chunked.get_latest_bars_values(SYMBOL, 'close', N)
+    expected = full.get_latest_bars_values(SYMBOL, 'close', N)
+    assert 0 < len(values) <= N
+    np.testing.assert_array_equal(values, expected[len(expected) - len(values):])
+    bars = chunked.get_latest_bars(SYMBOL, N)
+    expected_bars = full.get_latest_bars(SYMBOL, N)
+    assert bars == expected_bars[len(expected_bars) - len(bars):]
+
+
+def test_lookback_beyond_capacity():
+    full, chunked = _handlers(lookback=100, chunksize=70)
+    for i in range(500):
+        full.update_bars()
+        chunked.update_bars()
+    _assert_tail_of(full, chunked, 150)
+    _assert_tail_of(full, chunked, 101)
+    # The buffer grew to 150, the next bars fill it up
+    for i in range(60):
+        full.update_bars()
+        chunked.update_bars()
+    _assert_tail_of(full, chunked, 150)
+    assert len(chunked.get_latest_bars_values(SYMBOL, 'close', 150)) == 150
+
+
+def test_lookback_beyond_capacity_after_seek():
+    full, chunked = _handlers(lookback=10, chunksize=70)
+    start = full.symbol_data[SYMBOL].index[400].to_pydatetime()
+    full.seek(start, warmup=30)
+    chunked.seek(start, warmup=30)
+    for i in range(20):
+        full.update_bars()
+        chunked.update_bars()
+    _assert_tail_of(full, chunked, 40)
+    for i in range(5):
+        full.update_bars()
+        chunked.update_bars()
+        _assert_tail_of(full, chunked, 40)
+        _assert_tail_of(full, chunked, 3)